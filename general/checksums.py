@@ -0,0 +1,175 @@
+# Single-pass file checksums
+# Reads each file once, in large buffers (or through mmap), and feeds every buffer to adler32, md5
+#     and any other requested hashlib algorithm, instead of reading the file once per checksum.
+#     Files are spread over a process pool.
+#
+# As a tool, prints the "<name> <adler32> <bytes>" lines rbipi.py takes as a file list:
+#     python3 checksums.py --num-procs 16 /data/run1 > run1.list
+#     python3 checksums.py --benchmark /data/run1/*.fits
+#
+# Scripts outside this directory import it like scheduler.py (see there).
+
+import argparse
+import hashlib
+import logging
+import mmap
+import os
+import sys
+import time
+import zlib
+from multiprocessing import Pool
+
+logger = logging.getLogger('checksums')
+
+DEFAULT_ALGORITHMS = ('adler32', 'md5')
+BUFFER_SIZE = 16 * 1024 * 1024
+
+
+class MultiChecksum:
+    # adler32 plus any hashlib algorithms, all updated from the same buffer
+    def __init__(self, algorithms=DEFAULT_ALGORITHMS):
+        self.adler32 = 1 if 'adler32' in algorithms else None
+        self.hashes = {name: hashlib.new(name) for name in algorithms if name != 'adler32'}
+        self.size = 0
+
+    def update(self, data):
+        if self.adler32 is not None:
+            self.adler32 = zlib.adler32(data, self.adler32)
+        for h in self.hashes.values():
+            h.update(data)
+        self.size += len(data)
+
+    def hexdigests(self):
+        result = {'bytes': self.size}
+        if self.adler32 is not None:
+            result['adler32'] = f'{self.adler32:08x}'
+        for name, h in self.hashes.items():
+            result[name] = h.hexdigest()
+        return result
+
+
+def checksum_file(path, algorithms=DEFAULT_ALGORITHMS, buffer_size=BUFFER_SIZE, use_mmap=False):
+    """
+    Checksums a file in one read pass.
+
+    :returns: dict with 'bytes' and a hex digest per algorithm
+    """
+    checksum = MultiChecksum(algorithms)
+    with open(path, 'rb', buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        if use_mmap and size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+                view = memoryview(mm)
+                try:
+                    for offset in range(0, size, buffer_size):
+                        checksum.update(view[offset:offset + buffer_size])
+                finally:
+                    view.release()
+        else:
+            buf = bytearray(buffer_size) # Reused for every read, no per-chunk allocation
+            view = memoryview(buf)
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                checksum.update(view[:n])
+    return checksum.hexdigests()
+
+
+def _checksum_or_error(task):
+    path, algorithms, buffer_size, use_mmap = task
+    try:
+        return path, checksum_file(path, algorithms, buffer_size, use_mmap), None
+    except OSError as error:
+        return path, None, str(error)
+
+
+def checksum_files(paths, algorithms=DEFAULT_ALGORITHMS, num_procs=os.cpu_count(), buffer_size=BUFFER_SIZE, use_mmap=False):
+    """
+    Checksums many files over a process pool.
+
+    Yields (path, result, error) in input order; result is None and error a message for files that could not be read.
+    """
+    tasks = ((path, tuple(algorithms), buffer_size, use_mmap) for path in paths)
+    if num_procs <= 1:
+        yield from map(_checksum_or_error, tasks)
+        return
+    with Pool(num_procs) as pool:
+        yield from pool.imap(_checksum_or_error, tasks, chunksize=8)
+
+
+def iter_paths(paths):
+    # Files as given, and every file below directories
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for name in sorted(filenames):
+                    yield os.path.join(dirpath, name)
+        else:
+            yield path
+
+
+def benchmark(paths, buffer_size, use_mmap):
+    # One pass computing both checksums against one pass per checksum, single process.
+    #     Every run after the first is served from the page cache, so an untimed warm-up read comes first.
+    paths = list(paths)
+    for path in paths:
+        checksum_file(path, ('adler32',), buffer_size)
+    total = sum(os.path.getsize(path) for path in paths)
+    runs = {
+        'two passes (adler32, then md5)': lambda path: (checksum_file(path, ('adler32',), buffer_size, use_mmap),
+                                                        checksum_file(path, ('md5',), buffer_size, use_mmap)),
+        'one pass (adler32 + md5)': lambda path: checksum_file(path, DEFAULT_ALGORITHMS, buffer_size, use_mmap),
+    }
+    for label, run in runs.items():
+        start = time.monotonic()
+        for path in paths:
+            run(path)
+        elapsed = max(time.monotonic() - start, 1e-6)
+        print(f'{label:<32} {elapsed:8.2f}s {total / elapsed / 1e6:10.1f} MB/s')
+
+
+def get_program_arguments():
+    parser = argparse.ArgumentParser(description='Print "<name> <adler32> <bytes>" for files, reading each file once.')
+    parser.add_argument('paths', nargs='*', help='Files, or directories to checksum everything below.')
+    parser.add_argument('--files-from', type=str, default=None, help='File with one path per line, in addition to paths.')
+    parser.add_argument('--num-procs', type=int, default=os.cpu_count(), help='Processes checksumming files. Default: one per CPU')
+    parser.add_argument('--buffer-size', type=int, default=BUFFER_SIZE, help=f'Read size in bytes. Default: {BUFFER_SIZE}')
+    parser.add_argument('--mmap', default=False, action='store_true', help='Read files through mmap.')
+    parser.add_argument('--full-path', default=False, action='store_true', help='Print the path rather than the file name.')
+    parser.add_argument('--with-md5', default=False, action='store_true', help='Append the md5 as a fourth column.')
+    parser.add_argument('--benchmark', default=False, action='store_true', help='Time one pass against two separate passes instead.')
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    logging.basicConfig(format='%(asctime)-15s %(name)s %(levelname)s %(message)s', level=logging.INFO)
+    args = get_program_arguments()
+    paths = iter_paths(args.paths)
+    if args.files_from:
+        with open(args.files_from) as f:
+            paths = list(paths) + [line.strip() for line in f if line.strip()]
+    if args.benchmark:
+        benchmark(paths, args.buffer_size, args.mmap)
+        return
+
+    failed = 0
+    for path, result, error in checksum_files(paths, DEFAULT_ALGORITHMS, args.num_procs, args.buffer_size, args.mmap):
+        if error is not None:
+            logger.error(f'Could not checksum {path}: {error}')
+            failed += 1
+            continue
+        name = path if args.full_path else os.path.basename(path)
+        line = f'{name} {result["adler32"]} {result["bytes"]}'
+        if args.with_md5:
+            line += f' {result["md5"]}'
+        print(line)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,22 +3,13 @@
 # Brandon White, 2022
 
 import argparse
-import threading
+
+from scheduler import WorkScheduler, read_items
 
 def do_processing(tid, files, args):
     for f in files:
         print(f'(tid {tid})f: {f}')
 
-def get_file_queues(num_threads, f):
-    # Splits the list of files into (almost) equal buckets of work per thread
-    queues = [ [] for i in range(num_threads) ]
-    i = 0
-    for filename in f:
-        which_queue = i % num_threads
-        queues[which_queue].append(filename.strip())
-        i += 1
-    return queues
-
 def get_program_arguments():
     parser = argparse.ArgumentParser(description="Use n threads to print lines from a file.")
     parser.add_argument('filelist', help='Text file with lines to be printed.')
@@ -28,15 +19,9 @@ def get_program_arguments():
 
 def main():
     args = get_program_arguments()
-    threads = []
-    with open(args.filelist) as f: # Obtain the work distribution and hand it to the threads
-        file_queues =  get_file_queues(args.num_threads, f)
-        for i in range(args.num_threads):
-            t = threading.Thread(target=do_processing, args=(i, file_queues[i], args))
-            t.start()
-            threads.append(t)
-    for t in threads:
-        t.join()
+    with open(args.filelist) as f: # Stream the lines to whichever thread is free
+        with WorkScheduler(do_processing, args.num_threads, args=(args,)) as scheduler:
+            scheduler.feed(read_items(f))
 
 if __name__ == "__main__":
     main()
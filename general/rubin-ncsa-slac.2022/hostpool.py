@@ -0,0 +1,81 @@
+# Shared remote host scheduler for the transfer tools
+# Lives in shared memory so every forked worker sees the same picture: transfers in flight per host,
+#     recent throughput per host, and which hosts are benched after repeated failures.
+# Work goes to the healthy host expected to finish it soonest, never past the per-host cap.
+
+import logging
+import time
+from multiprocessing import Array, Condition
+
+logger = logging.getLogger()
+
+THROUGHPUT_SMOOTHING = 0.3 # Weight of the newest sample in the moving average
+WAIT_SECONDS = 1
+
+class HostPool:
+    def __init__(self, hosts, max_per_host=None, max_failures=3, bench_seconds=300):
+        self.hosts = hosts
+        self.max_per_host = max_per_host
+        self.max_failures = max_failures
+        self.bench_seconds = bench_seconds
+        self.condition = Condition()
+        self.in_flight = Array('i', len(hosts), lock=False)
+        self.throughput = Array('d', len(hosts), lock=False) # bytes/sec, 0 until the first transfer finishes
+        self.failures = Array('i', len(hosts), lock=False) # Consecutive failures
+        self.benched_until = Array('d', len(hosts), lock=False) # time.monotonic() is system-wide, so it works across processes
+
+    def _pick(self, exclude):
+        # Least expected time to drain: (transfers in flight + this one) / throughput.
+        #     Hosts without a measurement yet are assumed to be average.
+        now = time.monotonic()
+        known = [rate for rate in self.throughput if rate > 0]
+        average = sum(known) / len(known) if known else 1.0
+        best, best_cost = None, None
+        for i in range(len(self.hosts)):
+            if i in exclude or self.benched_until[i] > now:
+                continue
+            if self.max_per_host and self.in_flight[i] >= self.max_per_host:
+                continue
+            cost = (self.in_flight[i] + 1) / (self.throughput[i] or average)
+            if best is None or cost < best_cost:
+                best, best_cost = i, cost
+        return best
+
+    def acquire(self, exclude=()):
+        """
+        Blocks until a host can take another transfer and returns its index.
+
+        Hosts in exclude are skipped, unless every other host is benched.
+        """
+        with self.condition:
+            while True:
+                i = self._pick(exclude)
+                if i is None and exclude and all(self.benched_until[j] > time.monotonic()
+                                                 for j in range(len(self.hosts)) if j not in exclude):
+                    i = self._pick(())
+                if i is not None:
+                    self.in_flight[i] += 1
+                    return i
+                self.condition.wait(WAIT_SECONDS) # Also wakes up hosts whose bench has expired
+
+    def release(self, i, ok, nbytes=0, seconds=0):
+        with self.condition:
+            self.in_flight[i] -= 1
+            if ok:
+                self.failures[i] = 0
+                if nbytes and seconds > 0:
+                    rate = nbytes / seconds
+                    previous = self.throughput[i]
+                    self.throughput[i] = rate if not previous else \
+                            THROUGHPUT_SMOOTHING * rate + (1 - THROUGHPUT_SMOOTHING) * previous
+            else:
+                self.failures[i] += 1
+                if self.failures[i] >= self.max_failures:
+                    self.benched_until[i] = time.monotonic() + self.bench_seconds
+                    self.failures[i] = 0
+                    logger.warning(f'Benching {self.hosts[i]} for {self.bench_seconds}s after {self.max_failures} consecutive failures')
+            self.condition.notify_all()
+
+    def summary(self):
+        with self.condition:
+            return ', '.join(f'{host}: {self.throughput[i] / 1e6:.1f} MB/s' for i, host in enumerate(self.hosts))
@@ -0,0 +1,169 @@
+# Transfer telemetry for the parallel tools
+# Workers push one event per finished item (or batch of items) onto a queue; a collector thread
+#     in the parent aggregates them into totals, rolling throughput, ETA and per-item latency
+#     percentiles, logs a progress line, and periodically writes a Prometheus textfile or JSON file.
+
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from multiprocessing import Queue
+from queue import Empty
+
+logger = logging.getLogger()
+
+LATENCY_BUCKET_RATIO = 2 ** 0.25 # ~19% wide buckets from 1ms up, so percentiles cost no memory per item
+PERCENTILES = (50, 95, 99)
+
+class LatencyHistogram:
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+
+    def record(self, seconds, weight=1):
+        bucket = max(0, math.ceil(math.log(max(seconds * 1000, 1), LATENCY_BUCKET_RATIO)))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + weight
+        self.count += weight
+
+    def percentile(self, pct):
+        # Upper bound of the bucket holding the pct-th percentile, in seconds
+        target = self.count * pct / 100
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= target:
+                return LATENCY_BUCKET_RATIO ** bucket / 1000
+        return 0.0
+
+class Metrics:
+    """
+    Parent-side aggregator. Create it before the worker processes are forked so they share its queue;
+    workers call report(), the parent calls start() and stop().
+    """
+    def __init__(self, tool, total_items=None, output_path=None, output_format='prom', interval=10, window=60):
+        self.tool = tool
+        self.total_items = total_items
+        self.output_path = output_path
+        self.output_format = output_format
+        self.interval = interval
+        self.window = window
+        self.queue = Queue()
+        self.items = {True: 0, False: 0}
+        self.bytes = 0
+        self.recent = deque() # (time, items, bytes) inside the rolling window
+        self.latency = LatencyHistogram()
+        self.start_time = time.time()
+        self.thread = None
+
+    def report(self, items, nbytes, seconds, ok):
+        # Called in the workers: items finished by one operation that moved nbytes and took seconds
+        self.queue.put((time.time(), items, nbytes, seconds, ok))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.collect, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.write()
+        logger.info(self.progress_line())
+
+    def collect(self):
+        next_write = time.monotonic() + self.interval
+        while True:
+            try:
+                event = self.queue.get(timeout=max(0, next_write - time.monotonic()))
+            except Empty:
+                event = ()
+            if event is None:
+                return
+            if event:
+                self.add(*event)
+            if time.monotonic() >= next_write:
+                self.write()
+                logger.info(self.progress_line())
+                next_write = time.monotonic() + self.interval
+
+    def add(self, timestamp, items, nbytes, seconds, ok):
+        self.items[ok] += items
+        if not ok:
+            return
+        self.bytes += nbytes
+        self.recent.append((timestamp, items, nbytes))
+        if items:
+            self.latency.record(seconds / items, weight=items)
+
+    def snapshot(self):
+        now = time.time()
+        while self.recent and self.recent[0][0] < now - self.window:
+            self.recent.popleft()
+        span = max(min(self.window, now - self.start_time), 1e-6)
+        items_per_second = sum(items for _, items, _ in self.recent) / span
+        bytes_per_second = sum(nbytes for _, _, nbytes in self.recent) / span
+        done = self.items[True] + self.items[False]
+        eta = None
+        if self.total_items is not None and items_per_second > 0:
+            eta = max(self.total_items - done, 0) / items_per_second
+        return {
+            'tool': self.tool,
+            'elapsed_seconds': now - self.start_time,
+            'items_ok': self.items[True],
+            'items_failed': self.items[False],
+            'items_total': self.total_items,
+            'bytes': self.bytes,
+            'bytes_per_second': bytes_per_second,
+            'items_per_second': items_per_second,
+            'eta_seconds': eta,
+            'latency_seconds': {str(pct / 100): self.latency.percentile(pct) for pct in PERCENTILES},
+        }
+
+    def progress_line(self):
+        s = self.snapshot()
+        done = s['items_ok'] + s['items_failed']
+        total = f'/{s["items_total"]}' if s['items_total'] is not None else ''
+        eta = time.strftime('%H:%M:%S', time.gmtime(s['eta_seconds'])) if s['eta_seconds'] is not None else '?'
+        latency = '/'.join(f'{seconds:.2f}' for seconds in s['latency_seconds'].values())
+        return (f'Progress: {done}{total} items ({s["items_failed"]} failed), {s["bytes_per_second"] / 1e6:.1f} MB/s, '
+                f'{s["items_per_second"]:.1f} items/s, ETA {eta}, p50/p95/p99 {latency}s per item')
+
+    def write(self):
+        if not self.output_path:
+            return
+        s = self.snapshot()
+        if self.output_format == 'json':
+            data = json.dumps(s, indent=1) + '\n'
+        else:
+            data = format_prometheus(s)
+        # Written whole and renamed into place so the node exporter never reads half a file
+        temp_path = f'{self.output_path}.tmp'
+        with open(temp_path, 'w') as temp_f:
+            temp_f.write(data)
+        os.replace(temp_path, self.output_path)
+
+def format_prometheus(s):
+    tool = f'tool="{s["tool"]}"'
+    lines = []
+    def metric(name, metric_type, help_text, samples):
+        lines.append(f'# HELP rubin_transfer_{name} {help_text}')
+        lines.append(f'# TYPE rubin_transfer_{name} {metric_type}')
+        for labels, value in samples:
+            lines.append(f'rubin_transfer_{name}{{{labels}}} {value}')
+    metric('items_total', 'counter', 'Items finished, by result.',
+           [(f'{tool},result="ok"', s['items_ok']), (f'{tool},result="failed"', s['items_failed'])])
+    metric('bytes_total', 'counter', 'Bytes moved by successful items.', [(tool, s['bytes'])])
+    metric('bytes_per_second', 'gauge', 'Rolling throughput.', [(tool, s['bytes_per_second'])])
+    metric('items_per_second', 'gauge', 'Rolling item rate.', [(tool, s['items_per_second'])])
+    if s['eta_seconds'] is not None:
+        metric('eta_seconds', 'gauge', 'Estimated time to finish the input.', [(tool, s['eta_seconds'])])
+    metric('item_duration_seconds', 'summary', 'Per-item latency.',
+           [(f'{tool},quantile="{quantile}"', seconds) for quantile, seconds in s['latency_seconds'].items()])
+    return '\n'.join(lines) + '\n'
+
+def add_metrics_arguments(parser):
+    parser.add_argument('--metrics-file', type=str, default=None, help='Periodically write progress metrics here (e.g. a node exporter textfile). Default: off')
+    parser.add_argument('--metrics-format', choices=('prom', 'json'), default='prom', help='Format of --metrics-file. Default: prom')
+    parser.add_argument('--metrics-interval', type=float, default=10, help='Seconds between progress lines and metrics writes. Default: 10')
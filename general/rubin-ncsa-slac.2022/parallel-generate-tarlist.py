@@ -5,44 +5,55 @@
 
 import argparse
 import logging
+import json
 import os.path
-import subprocess
+import tarfile
 from multiprocessing import Queue
 
-from util import Sentinel, start_processes, end_processes, get_start_offset,\
-        set_logger, at_offset, write_offset_file
+from tarstream import iter_members
+from util import Sentinel, start_processes, end_processes, set_logger,\
+        open_journal, open_input, pending_items
 
 logging.basicConfig(format='%(asctime)-15s %(name)s %(levelname)s %(message)s', level=logging.INFO)
 logger = logging.getLogger()
 
-def execute_listing(pid, archive_path, listing_dest_path, fail_logger):
+def escape_tsv(field):
+    return field.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+def format_member(tarinfo, listing_format):
+    if listing_format == 'jsonl':
+        return json.dumps({
+            'size': tarinfo.size,
+            'path': tarinfo.name,
+            'mtime': tarinfo.mtime,
+            'header_offset': tarinfo.offset,
+        })
+    # Path last so it can hold anything; tabs, newlines and backslashes in it are escaped
+    return f'{tarinfo.size}\t{tarinfo.mtime}\t{tarinfo.offset}\t{escape_tsv(tarinfo.name)}'
+
+def execute_listing(pid, archive_path, listing_dest_path, fail_logger, listing_format):
     logger.info(f'(pid:{pid}) Executing listing of files specified in {archive_path} and sending to file {listing_dest_path}')
-    with open(listing_dest_path, 'w') as final_listing_file:
-        logger.info(f'listing_dest_path: listing_dest_path')
-        tar_process = subprocess.Popen([
-            'tar',
-            '--list',
-            '--verbose',
-            f'--file={archive_path}',
-        ], stdout=subprocess.PIPE)
-        # We only need the file size and path for our purposes
-        awk_process = subprocess.Popen(
-            ['awk', '{print $3"    "$6}'],
-            stdin=tar_process.stdout,
-            stdout=final_listing_file
-        )
-        listing_stdout, listing_stderr = awk_process.communicate()
-    if awk_process.returncode != 0:
-        logger.info(f'!!! AWK FAILURE: Failed to include file {archive_path} in archive {listing_dest_path} !!!')
+    num_members = 0
+    try:
+        with open(listing_dest_path, 'w', encoding='utf-8', errors='surrogateescape') as final_listing_file:
+            for tarinfo in iter_members(archive_path): # Walks the headers only
+                final_listing_file.write(format_member(tarinfo, listing_format) + '\n')
+                num_members += 1
+    except (OSError, tarfile.TarError) as error:
+        logger.info(f'!!! LISTING FAILURE: Failed to list archive {archive_path} into {listing_dest_path}: {error} !!!')
         fail_logger.error(archive_path.encode(encoding='UTF-8'))
-    logger.info(f'(pid:{pid}): TAR LISTING COMPLETE: {archive_path}')
+        return False
+    logger.info(f'(pid:{pid}): TAR LISTING COMPLETE: {archive_path} ({num_members} members)')
+    return True
 
-def do_processing(pid, list_queue, args):
+def do_processing(pid, list_queue, args, journal):
     while True:
-        archive_path = list_queue.get()
-        if isinstance(archive_path, Sentinel):
+        list_item = list_queue.get()
+        if isinstance(list_item, Sentinel):
+            journal.close()
             logger.info(f'PID: {pid} complete. Waiting to join.')
             return
+        line_no, next_offset, archive_path = list_item
 
         # Create a path for storing the per-archive listings 
         listing_dest_path = os.path.join(
@@ -54,7 +65,8 @@ def do_processing(pid, list_queue, args):
         fh = logging.FileHandler(fail_log_path)
         fail_logger.addHandler(fh)
         # Do the thing
-        execute_listing(pid, archive_path, listing_dest_path, fail_logger) # DO THE TAR
+        if execute_listing(pid, archive_path, listing_dest_path, fail_logger, args.listing_format): # DO THE TAR
+            journal.record(line_no, next_offset)
 
 def get_program_arguments():
     parser = argparse.ArgumentParser(description='Transfers a directory from a remote host(s) in parallel to a given local filesystem using rsync')
@@ -62,7 +74,9 @@ def get_program_arguments():
     parser.add_argument('--num-procs', type=int, default=1, help='Number of procs to divy up lines .')
     parser.add_argument('--listing-prefix', type=str, default='tarlist_', help='Name to prepend to files used to accumulate the per-archive file listings.')
     parser.add_argument('--listing-dest-dir', type=str, default='/tmp', help='Number of procs to divy up lines.')
+    parser.add_argument('--listing-format', choices=['tsv', 'jsonl'], default='tsv', help='tsv: "<size>\\t<mtime>\\t<header offset>\\t<path>" per member, jsonl: one JSON object per member. Default: tsv')
     parser.add_argument('--ignore-checkpoint', default=False, action='store_true')
+    parser.add_argument('--mmap', default=False, action='store_true', help='Read the input file through mmap.')
     args = parser.parse_args()
     return args
 
@@ -74,19 +88,15 @@ def main():
 
     list_queue = Queue(args.num_procs)
     logger.info(f'Starting {args.num_procs} procs')
-    procs = start_processes(list_queue, do_processing, args.num_procs, args)
+    journal, checkpoint = open_journal(args.listing_info_f, args.ignore_checkpoint)
+    procs = start_processes(list_queue, do_processing, args.num_procs, args, journal)
 
-    # See if there is a point in the input file we should resume at
-    start_from, offset_file_path = get_start_offset(args.listing_info_f, args.ignore_checkpoint)
-    logger.info(f'Starting processing from {start_from} lines into the input file...')
+    # Seek past whatever a previous run already finished
+    logger.info(f'Skipping {checkpoint.line_count} lines and {len(checkpoint.completed)} more items already completed...')
 
-    with open(args.listing_info_f) as f:
-        for i, item in enumerate(f):
-            while not at_offset(i, start_from, f):
-                continue
-            list_item = item.strip()
-            list_queue.put(list_item)
-            write_offset_file(i, offset_file_path) # TODO: should probably do after the tar completes instead
+    with open_input(args.listing_info_f, args.mmap) as f:
+        for i, next_offset, list_item in pending_items(f, checkpoint, journal):
+            list_queue.put((i, next_offset, list_item))
             
     logger.info('All transfer items produced to consumer processes. Dispatching Sentinel.')
     end_processes(list_queue, procs)
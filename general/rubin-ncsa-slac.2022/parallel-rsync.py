@@ -1,6 +1,10 @@
 # Parallel rsync Transfer Program
 # Transfers files/directories from remote rsync servers load-balanced
-#     round-robin in parallel to a local filesystem using rsync
+#     in parallel to a local filesystem using rsync
+# Every process draws hosts from one shared HostPool, which sends each transfer to the least-loaded
+#     healthy host, caps transfers per host, and benches hosts that keep failing
+# Many small paths can share one rsync session (--batch-files / --batch-bytes); paths a batch
+#     fails on are picked out of the --out-format output and retried on their own
 # Brandon White, 2022
 
 # Note: This will currently only with with an rsync daemon running on the remote end.
@@ -13,75 +17,210 @@ import logging
 import os
 import os.path
 import subprocess
+import tempfile
+import time
 from multiprocessing import Queue
 
-from util import Sentinel, start_processes, end_processes, get_start_offset, set_logger, at_offset, write_offset_file
+from hostpool import HostPool
+from metrics import Metrics, add_metrics_arguments
+from util import Sentinel, start_processes, end_processes, set_logger, open_journal, open_input, pending_items, count_pending
 
 logging.basicConfig(format='%(asctime)-15s %(name)s %(levelname)s %(message)s', level=logging.INFO)
 logger = logging.getLogger()
 
-def execute_transfer(pid, local_directory, remote_host, transfer_path, user, pwd_f, fail_logger):
-    #module = 'LSSTUser' # TODO: Make this an actual argument
-    #module = 'LSSTScratch' # TODO: Make this an actual argument
-    #module = 'LSSTScratch' # TODO: Make this an actual argument
-    #module = 'LSSTTarballs'
-    module = 'LSSTktl'
-    remote_source = f'{user}@{remote_host}::{module}/{transfer_path}'
+#MODULE = 'LSSTUser' # TODO: Make this an actual argument
+#MODULE = 'LSSTScratch' # TODO: Make this an actual argument
+#MODULE = 'LSSTTarballs'
+MODULE = 'LSSTktl'
+PARTIAL_TRANSFER_CODES = (0, 23, 24) # Some files failed or vanished: their problem, not the host's
+
+def parse_out_format(line):
+    # One line of --out-format="%o %m %i %n %l %C" as (operation, path, length), or None if it isn't one.
+    #     Paths may contain spaces; %C is blank unless rsync knows the checksum.
+    fields = line.strip().strip('"').split(' ', 3)
+    if len(fields) < 4:
+        return None
+    operation, module, itemized, rest = fields
+    rest = rest.rstrip()
+    name, _, last = rest.rpartition(' ')
+    if len(last) >= 32: # %C
+        name, _, last = name.rstrip().rpartition(' ')
+    if not last.isdigit():
+        return None
+    return operation, name, int(last)
+
+def transferred_bytes(rsync_stdout):
+    total = 0
+    for line in rsync_stdout.splitlines():
+        parsed = parse_out_format(line)
+        if parsed is not None and parsed[0] == 'recv':
+            total += parsed[2]
+    return total
+
+def run_rsync(pid, remote_source, local_directory, pwd_f, extra_args=()):
     format_string = '--out-format=\"%o %m %i %n %l %C\"' # TODO: Make this an actual argument
     pwd_arg = f'--password-file={pwd_f}'
-    logger.info(f'(pid:{pid}) Executing transfer of {transfer_path} from {remote_host} to {local_directory}\n\t\
-            rsync --archive --remove-source-files --xattrs {pwd_arg} {format_string} {remote_source} {local_directory}')
+    extra = ''.join(f' {arg}' for arg in extra_args)
+    logger.info(f'(pid:{pid}) rsync --archive --remove-source-files --xattrs{extra} {pwd_arg} {format_string} {remote_source} {local_directory}')
     xfer_process = subprocess.Popen([
         'rsync',
         '--archive',
         '--remove-source-files',
         #'--relative',
         '--xattrs',
+        *extra_args,
         pwd_arg,
         format_string,
         remote_source,
         local_directory
     ], stdout=subprocess.PIPE)
     xfer_stdout, xfer_stderr = xfer_process.communicate()
-    logger.info(f'(pid:{pid}) {xfer_stdout.decode().strip()}')
-    if xfer_process.returncode != 0:
-        logger.info(f'!!!  TRANSFER FAILURE: {remote_source}')
-        fail_logger.error(transfer_path)
+    xfer_stdout = xfer_stdout.decode(errors='replace')
+    logger.info(f'(pid:{pid}) {xfer_stdout.strip()}')
+    return xfer_process.returncode, xfer_stdout
+
+def execute_transfer(pid, local_directory, remote_host, transfer_path, user, pwd_f):
+    # Returns (rsync exit code, bytes transferred)
+    remote_source = f'{user}@{remote_host}::{MODULE}/{transfer_path}'
+    logger.info(f'(pid:{pid}) Executing transfer of {transfer_path} from {remote_host} to {local_directory}')
+    returncode, xfer_stdout = run_rsync(pid, remote_source, local_directory, pwd_f)
+    if returncode != 0:
+        logger.info(f'!!!  TRANSFER FAILURE (rsync exit {returncode}): {remote_source}')
+        return returncode, 0
+    return returncode, transferred_bytes(xfer_stdout)
+
+def execute_batch_transfer(pid, local_directory, remote_host, transfer_paths, user, pwd_f):
+    """
+    Transfers many paths in one rsync session through --files-from.
+
+    --no-relative keeps the layout of single transfers (each path lands in local_directory by its last component).
 
-def do_processing(pid, transfer_queue, args):
+    :returns: (whether the host did its job, paths that did not transfer, bytes transferred)
+    """
+    remote_source = f'{user}@{remote_host}::{MODULE}/'
+    logger.info(f'(pid:{pid}) Executing batch transfer of {len(transfer_paths)} paths from {remote_host} to {local_directory}')
+    with tempfile.NamedTemporaryFile('w', prefix='rsync-batch-', suffix='.list') as files_from:
+        files_from.write(''.join(f'{path}\n' for path in transfer_paths))
+        files_from.flush()
+        returncode, xfer_stdout = run_rsync(pid, remote_source, local_directory, pwd_f,
+                ['--recursive', '--no-relative', f'--files-from={files_from.name}'])
+    if returncode == 0:
+        return True, [], transferred_bytes(xfer_stdout)
+    # Anything rsync didn't report receiving is treated as failed; unchanged files just get a cheap retry
+    received = set()
+    for line in xfer_stdout.splitlines():
+        parsed = parse_out_format(line)
+        if parsed is not None and parsed[0] == 'recv':
+            received.add(parsed[1].rstrip('/').split('/')[0])
+    failed = [path for path in transfer_paths if os.path.basename(path.rstrip('/')) not in received]
+    logger.info(f'!!!  BATCH TRANSFER FAILURE (rsync exit {returncode}): {len(failed)} of {len(transfer_paths)} paths from {remote_host}')
+    return returncode in PARTIAL_TRANSFER_CODES, failed, transferred_bytes(xfer_stdout)
+
+def transfer_with_retries(pid, transfer_path, args, fail_logger):
+    host_pool = args.host_pool
+    tried = []
+    for attempt in range(1 + args.host_retries): # A failed transfer is retried on a different host
+        host = host_pool.acquire(exclude=tried)
+        tried.append(host)
+        start = time.monotonic()
+        returncode, nbytes = None, 0
+        try:
+            returncode, nbytes = execute_transfer(pid, args.localdirectory, host_pool.hosts[host], transfer_path, args.user, args.password_file)
+        finally:
+            # Missing or vanished source files don't count against the host, as in batch mode
+            host_pool.release(host, returncode in PARTIAL_TRANSFER_CODES, nbytes, time.monotonic() - start)
+        if returncode == 0:
+            args.metrics.report(1, nbytes, time.monotonic() - start, True)
+            return True
+    args.metrics.report(1, 0, time.monotonic() - start, False)
+    fail_logger.error(transfer_path)
+    return False
+
+def transfer_batch(pid, batch, args, journal, fail_logger):
+    # batch is a list of (line number, offset of the next line, path); failed paths are retried one by one
+    host_pool = args.host_pool
+    host = host_pool.acquire()
+    start = time.monotonic()
+    host_ok, failed, nbytes = False, [path for _, _, path in batch], 0
+    try:
+        host_ok, failed, nbytes = execute_batch_transfer(pid, args.localdirectory, host_pool.hosts[host],
+                [path for _, _, path in batch], args.user, args.password_file)
+    finally:
+        host_pool.release(host, host_ok, nbytes, time.monotonic() - start)
+    args.metrics.report(len(batch) - len(failed), nbytes, time.monotonic() - start, True)
+    failed = set(failed)
+    for line_no, next_offset, path in batch:
+        if path not in failed or transfer_with_retries(pid, path, args, fail_logger):
+            journal.record(line_no, next_offset)
+
+def split_sized(transfer_item):
+    # "<size> <path>" lines, as in the parallel-tar.py input
+    size, path = transfer_item.replace('\t', ' ').split(' ', 1)
+    return int(size), path.lstrip(' ')
+
+def do_processing(pid, transfer_queue, args, journal):
     fail_log_path = os.path.join(args.fail_log_path, f'{os.path.basename(args.transfer_info_f)}.{pid}.error') 
     fail_logger = logging.getLogger('fail_log')
     fh = logging.FileHandler(fail_log_path)
     fail_logger.addHandler(fh)
 
-    remote_hosts = args.remotehosts.split(',')
-    i = 0
+    batch, batch_bytes = [], 0
     while True:
-        transfer_path = transfer_queue.get()
-        if isinstance(transfer_path, Sentinel):
+        transfer_item = transfer_queue.get()
+        if isinstance(transfer_item, Sentinel):
+            if batch:
+                transfer_batch(pid, batch, args, journal, fail_logger)
+            journal.close()
             logger.info(f'PID: {pid} complete. Waiting to join.')
             return
-        remote_host_index = i % len(remote_hosts) # Incrementally select the next host round-robin for load-balancing
-        execute_transfer(pid, args.localdirectory, remote_hosts[remote_host_index], transfer_path, args.user, args.password_file, fail_logger)
-        i += 1
+        line_no, next_offset, transfer_path = transfer_item
+        size = 0
+        if args.sized_input:
+            size, transfer_path = split_sized(transfer_path)
+        if args.batch_files <= 1 and not args.batch_bytes:
+            if transfer_with_retries(pid, transfer_path, args, fail_logger):
+                journal.record(line_no, next_offset)
+            continue
+        # Batch by count and by byte budget, whichever fills first
+        if batch and args.batch_bytes and batch_bytes + size > args.batch_bytes:
+            transfer_batch(pid, batch, args, journal, fail_logger)
+            batch, batch_bytes = [], 0
+        batch.append((line_no, next_offset, transfer_path))
+        batch_bytes += size
+        if len(batch) >= args.batch_files:
+            transfer_batch(pid, batch, args, journal, fail_logger)
+            batch, batch_bytes = [], 0
 
 def get_program_arguments():
     parser = argparse.ArgumentParser(description='Transfers a directory from a remote host(s) in parallel to a given local filesystem using rsync')
     parser.add_argument('remotehosts', type=str, help='Remote hostname to transfer from. \
-            May be provided as a comma-separated list of hostnames to cycle through.\n\
+            May be provided as a comma-separated list of hostnames to balance across.\n\
             All hostnames must have the same view of the transfer source filesystem.')
     parser.add_argument('localdirectory', type=str, help='Local directory that is the \
             destination of the transfer operation.')
     parser.add_argument('transfer_info_f', type=str, help='File containing one file path on the remote host per line')
     parser.add_argument('password_file', type=str, help='When running in daemon mode, you are gonna want this.')
     parser.add_argument('--num-procs', type=int, default=1, help='Number of procs to divy up lines .')
+    parser.add_argument('--max-per-host', type=int, default=None, help='Most transfers running against one host at a time. Default: no cap')
+    parser.add_argument('--host-retries', type=int, default=1, help='Times a failed transfer is retried on another host. Default: 1')
+    parser.add_argument('--host-failures', type=int, default=3, help='Consecutive failures before a host is benched. Default: 3')
+    parser.add_argument('--bench-seconds', type=float, default=300, help='How long a failing host sits out. Default: 300')
+    parser.add_argument('--batch-files', type=int, default=1, help='Paths sent per rsync session via --files-from. Default: 1 (no batching)')
+    parser.add_argument('--batch-bytes', type=int, default=None, help='Byte budget per batch; needs --sized-input. Default: no budget')
+    parser.add_argument('--sized-input', default=False, action='store_true', help='Input lines are "<size> <path>", as for parallel-tar.py.')
     parser.add_argument('--ignore-checkpoint', default=False, action='store_true')
+    parser.add_argument('--mmap', default=False, action='store_true', help='Read the input file through mmap.')
     parser.add_argument('--user', type=str, default=getpass.getuser(), help='User to execute the rsync as. \
             Defaults to current linux user.')
     parser.add_argument('--fail-log-path', type=str, default=f'/sdf/group/rubin/scratch/transfer_lists/error_files',
             help='User to execute the rsync as. Defaults to current linux user.')
 
+    add_metrics_arguments(parser)
     args = parser.parse_args()
+    if args.batch_bytes and not args.sized_input:
+        parser.error('--batch-bytes needs --sized-input')
+    if args.batch_bytes and args.batch_files <= 1:
+        args.batch_files = float('inf') # Budget only
     return args
 
 def main():
@@ -97,24 +236,27 @@ def main():
     if not os.path.isdir(args.localdirectory):
         os.mkdir(args.localdirectory)
     
+    # Created before the fork so every process shares it
+    args.host_pool = HostPool(args.remotehosts.split(','), args.max_per_host, args.host_failures, args.bench_seconds)
     transfer_queue = Queue(args.num_procs)
     logger.info(f'Starting {args.num_procs} procs')
-    procs = start_processes(transfer_queue, do_processing, args.num_procs, args)
-
-    # See if there is a point in the input file we should resume at
-    start_from, offset_file_path = get_start_offset(args.transfer_info_f, args.ignore_checkpoint)
-    logger.info(f'Starting processing from {start_from} lines into the input file...')
-
-    with open(args.transfer_info_f) as f: # Obtain the work distribution and hand it to the procs
-        for i, item in enumerate(f):
-            while not at_offset(i, start_from, f):
-                continue
-            transfer_item = item.strip()
-            transfer_queue.put(transfer_item)
-            write_offset_file(i, offset_file_path)
+    journal, checkpoint = open_journal(args.transfer_info_f, args.ignore_checkpoint)
+    # Created before the fork so every process reports into it
+    args.metrics = Metrics('parallel-rsync', count_pending(args.transfer_info_f, checkpoint), args.metrics_file, args.metrics_format, args.metrics_interval)
+    procs = start_processes(transfer_queue, do_processing, args.num_procs, args, journal)
+    args.metrics.start()
+
+    # Seek past whatever a previous run already finished
+    logger.info(f'Skipping {checkpoint.line_count} lines and {len(checkpoint.completed)} more items already completed...')
+
+    with open_input(args.transfer_info_f, args.mmap) as f:
+        for i, next_offset, transfer_item in pending_items(f, checkpoint, journal):
+            transfer_queue.put((i, next_offset, transfer_item))
             
     logger.info('All transfer items produced to consumer processes. Dispatching Sentinel.')
     end_processes(transfer_queue, procs)
+    args.metrics.stop()
+    logger.info(f'Host throughput: {args.host_pool.summary()}')
 
 if __name__ == "__main__":
     main()
@@ -1,6 +1,7 @@
 # tar Program
 # Given an input file consisting of file sizes, and paths to files (can be relative) 
 #      create a tar archive in the destination from every TARRBALL_SIZE_LIMIT files 
+#      (or, with --manifests, one archive per manifest planned by plan-tarballs.py)
 # Brandon White, 2022
 
 import argparse
@@ -12,11 +13,14 @@ import os
 import os.path
 import pathlib
 import shutil
-import subprocess
+import tarfile
 import tempfile
+import time
 from multiprocessing import Queue
 
-from util import Sentinel, start_processes, end_processes, get_start_offset, set_logger, at_offset, write_offset_file
+from metrics import Metrics, add_metrics_arguments
+from tarstream import write_archive, write_sidecar
+from util import Sentinel, start_processes, end_processes, set_logger, open_journal, open_input, pending_items, count_pending
 
 logging.basicConfig(format='%(asctime)-15s %(name)s %(levelname)s %(message)s', level=logging.INFO)
 logger = logging.getLogger()
@@ -31,36 +35,50 @@ def get_hash_digits(string_to_hash):
     return digits
 
 def execute_tar(pid, tarlist_tempfile_path, archive_dest_path, fail_logger):
-    logger.info(f'(pid:{pid}) Executing tar of files specified in {tarlist_tempfile_path} and compressing to archive {archive_dest_path}')
-    tar_process = subprocess.Popen([
-        #'sudo',
-        'tar',
-        '--create', # --preserve-permissions is implied by execution as a superuser
-        f'--file={archive_dest_path}',
-        f'--files-from={tarlist_tempfile_path}',
-        '--ignore-failed-read',
-        #'--atime-preserve', # preserve access times
-        #'--dereference', # Don't do this dumbass. Follow symlinks, and build their referents into the tarchive
-        #'--gzip', # PHENOMENAL COSMIC POWER! itty bitty living space
-        '--verbose' # let us know what's going on
-    ], stdout=subprocess.PIPE)
-    tar_stdout, tar_stderr = tar_process.communicate()
-    logger.info(f'(pid:{pid}): TAR OUTPUT: {tar_stdout.decode().strip()}')
-    if tar_process.returncode != 0:
-        logger.info(f'!!!  TAR FAILURE  !!!')
-        with open(tarlist_tempfile_path, 'r', encoding='utf-8', errors='ignore') as tarlist:
-            for missed_file in tarlist:
-                logger.error(f'Failed to include file {missed_file} in archive {archive_dest_path}')
-                fail_logger.error(missed_file.encode(encoding='UTF-8'))
-    else:
-        # Move file specfied by archive_dest_path to final destination
-        current_dir = os.path.dirname(archive_dest_path)
-        completed_subdir_digits = get_hash_digits(archive_dest_path)
-        completed_subdir = os.path.join(current_dir, 'completed', completed_subdir_digits)
-        pathlib.Path(completed_subdir).mkdir(parents=True, exist_ok=True)
-        shutil.move(archive_dest_path, completed_subdir)
-
-def do_processing(pid, tar_queue, args):
+    logger.info(f'(pid:{pid}) Writing archive {archive_dest_path} from files specified in {tarlist_tempfile_path}')
+    def log_missed_file(missed_file, error):
+        logger.error(f'Failed to include file {missed_file} in archive {archive_dest_path}: {error}')
+        fail_logger.error(missed_file.encode(encoding='UTF-8'))
+
+    with open(tarlist_tempfile_path, 'r', encoding='utf-8', errors='ignore') as tarlist:
+        file_paths = [line.rstrip('\n') for line in tarlist if line.strip()]
+    try:
+        manifest = write_archive(archive_dest_path, file_paths, on_missed=log_missed_file) # checksums the archive as it goes
+    except (OSError, tarfile.TarError) as error:
+        logger.info(f'!!!  TAR FAILURE  !!! {error}')
+        for missed_file in file_paths:
+            log_missed_file(missed_file, error)
+        return False
+    logger.info(f'(pid:{pid}): TAR OUTPUT: {len(manifest["members"])} members, {manifest["bytes"]} bytes, '
+            f'adler32 {manifest["adler32"]}, md5 {manifest["md5"]}')
+
+    # Move file specfied by archive_dest_path to final destination, with its checksum manifest alongside
+    current_dir = os.path.dirname(archive_dest_path)
+    completed_subdir_digits = get_hash_digits(archive_dest_path)
+    completed_subdir = os.path.join(current_dir, 'completed', completed_subdir_digits)
+    pathlib.Path(completed_subdir).mkdir(parents=True, exist_ok=True)
+    shutil.move(archive_dest_path, completed_subdir)
+    write_sidecar(os.path.join(completed_subdir, os.path.basename(archive_dest_path)), manifest)
+    return True
+
+def record_archived(journal, tar_lines):
+    # Only once the archive is complete are its input lines done
+    for line_no, next_offset in tar_lines:
+        journal.record(line_no, next_offset)
+    journal.sync()
+
+def timed_tar(pid, tarlist_tempfile_path, archive_dest_path, fail_logger, metrics, num_items, num_bytes):
+    # execute_tar, reporting the archive's files to the parent's metrics
+    start = time.monotonic()
+    try:
+        tar_ok = execute_tar(pid, tarlist_tempfile_path, archive_dest_path, fail_logger)
+    except Exception:
+        metrics.report(num_items, 0, time.monotonic() - start, False)
+        raise
+    metrics.report(num_items, num_bytes if tar_ok else 0, time.monotonic() - start, tar_ok)
+    return tar_ok
+
+def do_processing(pid, tar_queue, args, journal):
     # Create a tempfile for storing the accumulating list of files to be tarred
     tarlist_tempfile = tempfile.NamedTemporaryFile(prefix=args.tar_prefix, dir=args.tar_dest_dir) 
     tarlist_tempfile_path = tarlist_tempfile.name # absolute path to NamedTemporaryFile
@@ -76,15 +94,20 @@ def do_processing(pid, tar_queue, args):
     fail_logger.addHandler(fh)
 
     tar_rolling_size = 0 # Hold the accumulation of the list of files to be tarred in this batch
+    tar_lines = [] # Input lines of the files in this batch, journaled once the archive is written
     while True:
-        tar_info = tar_queue.get()
-        if isinstance(tar_info, Sentinel):
+        tar_item = tar_queue.get()
+        if isinstance(tar_item, Sentinel):
             tarlist_tempfile.flush()
             os.fsync(tarlist_tempfile.fileno())
-            execute_tar(pid, tarlist_tempfile_path, archive_dest_path, fail_logger) # DO THE TAR
+            if tar_lines and timed_tar(pid, tarlist_tempfile_path, archive_dest_path, fail_logger,
+                                       args.metrics, len(tar_lines), tar_rolling_size): # DO THE TAR
+                record_archived(journal, tar_lines)
             tarlist_tempfile.close()
+            journal.close()
             logger.info(f'PID: {pid} complete. Waiting to join.')
             return
+        line_no, next_offset, tar_info = tar_item
 
         tar_info_split = tar_info.split()
         file_size = int(tar_info_split[0])
@@ -95,16 +118,21 @@ def do_processing(pid, tar_queue, args):
             tar_rolling_size += file_size
             b_file_path = file_path.encode(encoding='UTF-8')
             tarlist_tempfile.write(b_file_path)
+            tar_lines.append((line_no, next_offset))
 
         elif tar_rolling_size >= TARBALL_SIZE_LIMIT:
             # Flush I/O buffer to file
             tarlist_tempfile.flush()
             os.fsync(tarlist_tempfile.fileno())
             try:
-                execute_tar(pid, tarlist_tempfile_path, archive_dest_path, fail_logger) # DO THE TAR
+                tar_ok = timed_tar(pid, tarlist_tempfile_path, archive_dest_path, fail_logger,
+                                   args.metrics, len(tar_lines), tar_rolling_size) # DO THE TAR
             except Exception:
-                execute_tar(pid, tarlist_tempfile_path, archive_dest_path, fail_logger) # DO THE TAR
+                tar_ok = timed_tar(pid, tarlist_tempfile_path, archive_dest_path, fail_logger,
+                                   args.metrics, len(tar_lines), tar_rolling_size) # DO THE TAR
                 tarlist_tempfile.close() # Clean up if we die
+            if tar_ok:
+                record_archived(journal, tar_lines)
             tarlist_tempfile.close() # Close and delete tarlist upon successfull tar
             tarlist_tempfile = tempfile.NamedTemporaryFile(prefix=args.tar_prefix, dir=args.tar_dest_dir) # Open up the next tempfile
             tarlist_tempfile_path = tarlist_tempfile.name
@@ -112,44 +140,82 @@ def do_processing(pid, tar_queue, args):
             logger.info(f'Opened new tarlist at: {tarlist_tempfile_path}')
             b_file_path = file_path.encode(encoding='UTF-8')
             tarlist_tempfile.write(b_file_path)
+            tar_lines = [(line_no, next_offset)]
             tar_rolling_size = file_size # Reset the rolling sum, add the file that can't fit to the new list
         else:
             logger.error('Uh, this should not happen.')
 
+def do_manifest_processing(pid, manifest_queue, args, journal):
+    # Each item is a manifest from plan-tarballs.py: tar exactly its files into one archive
+    fail_logger = logging.getLogger('fail_log')
+    while True:
+        manifest_item = manifest_queue.get()
+        if isinstance(manifest_item, Sentinel):
+            journal.close()
+            logger.info(f'PID: {pid} complete. Waiting to join.')
+            return
+        line_no, next_offset, manifest_path = manifest_item
+
+        archive_name = os.path.splitext(os.path.basename(manifest_path))[0]
+        archive_dest_path = os.path.join(args.tar_dest_dir, archive_name + '.tar')
+        fh = logging.FileHandler(archive_dest_path + '.error') # Name of per-archive failure logs
+        fail_logger.addHandler(fh)
+        manifest_size = 0
+        with tempfile.NamedTemporaryFile(prefix=archive_name, dir=args.tar_dest_dir) as tarlist_tempfile:
+            with open(manifest_path, encoding='utf-8', errors='ignore') as manifest:
+                for tar_info in manifest:
+                    file_size, file_path = tar_info.replace('\t', ' ').split(' ', 1)
+                    manifest_size += int(file_size)
+                    tarlist_tempfile.write(file_path.lstrip(' ').encode(encoding='UTF-8'))
+            tarlist_tempfile.flush()
+            os.fsync(tarlist_tempfile.fileno())
+            if timed_tar(pid, tarlist_tempfile.name, archive_dest_path, fail_logger, args.metrics, 1, manifest_size): # DO THE TAR
+                journal.record(line_no, next_offset)
+        fail_logger.removeHandler(fh)
+        fh.close()
+
 def get_program_arguments():
     parser = argparse.ArgumentParser(description='Transfers a directory from a remote host(s) in parallel to a given local filesystem using rsync')
     parser.add_argument('file_info_f', type=str, help='File containing one file path on the remote host per line')
+    parser.add_argument('--manifests', default=False, action='store_true', help='file_info_f is a manifests.list written by plan-tarballs.py; tar one archive per manifest.')
     parser.add_argument('--num-procs', type=int, default=1, help='Number of procs to divy up lines .')
     parser.add_argument('--tar-prefix', type=str, default='tar_', help='Name to append to tempfiles used to track files to be tarred in a batch.')
     parser.add_argument('--tar-dest-dir', type=str, default='/tmp', help='Number of procs to divy up lines.')
     parser.add_argument('--ignore-checkpoint', default=False, action='store_true')
+    parser.add_argument('--mmap', default=False, action='store_true', help='Read the input file through mmap.')
+    add_metrics_arguments(parser)
     args = parser.parse_args()
     return args
 
 def main():
     set_logger(logger)
     args = get_program_arguments()
-    logstr = f'Executing tar operation with tarball size limit: {TARBALL_SIZE_LIMIT}'
+    if args.manifests:
+        logstr = f'Executing tar operation for the archive manifests listed in {args.file_info_f}'
+        processing = do_manifest_processing
+    else:
+        logstr = f'Executing tar operation with tarball size limit: {TARBALL_SIZE_LIMIT}'
+        processing = do_processing
     logger.info(logstr)
 
     tar_queue = Queue(args.num_procs)
     logger.info(f'Starting {args.num_procs} procs')
-    procs = start_processes(tar_queue, do_processing, args.num_procs, args)
-
-    # See if there is a point in the input file we should resume at
-    start_from, offset_file_path = get_start_offset(args.file_info_f, args.ignore_checkpoint)
-    logger.info(f'Starting processing from {start_from} lines into the input file...')
-
-    with open(args.file_info_f, encoding='utf-8', errors='ignore') as f:
-        for i, item in enumerate(f):
-            if not at_offset(i, start_from):
-                continue
-            tar_item = item.strip()
-            tar_queue.put(tar_item)
-            write_offset_file(i, offset_file_path) # TODO: should probably do after the tar completes instead
+    journal, checkpoint = open_journal(args.file_info_f, args.ignore_checkpoint)
+    # Created before the fork so every process reports into it
+    args.metrics = Metrics('parallel-tar', count_pending(args.file_info_f, checkpoint), args.metrics_file, args.metrics_format, args.metrics_interval)
+    procs = start_processes(tar_queue, processing, args.num_procs, args, journal)
+    args.metrics.start()
+
+    # Seek past whatever a previous run already archived
+    logger.info(f'Skipping {checkpoint.line_count} lines and {len(checkpoint.completed)} more items already completed...')
+
+    with open_input(args.file_info_f, args.mmap) as f:
+        for i, next_offset, tar_item in pending_items(f, checkpoint, journal, errors='ignore'):
+            tar_queue.put((i, next_offset, tar_item))
             
     logger.info('All transfer items produced to consumer processes. Dispatching Sentinel.')
     end_processes(tar_queue, procs)
+    args.metrics.stop()
 
 if __name__ == "__main__":
     main()
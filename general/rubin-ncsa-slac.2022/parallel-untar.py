@@ -1,44 +1,55 @@
 # tar tvf Program
 # Given an input file consisting of paths to tar archives, untar them into a given directory
 # They will assume a relative path below this directory, replicating the layout at the destination
+# Archives are read sequentially in-process while a pool of writer threads per process lays the
+#     member data down, keeping tar's --keep-newer-files and --keep-directory-symlink behaviour
 # Brandon White, 2022
 
 import argparse
 import logging
 import os.path
-import subprocess
+import tarfile
+import time
 from multiprocessing import Queue
 
-from util import Sentinel, start_processes, end_processes, get_start_offset,\
-        set_logger, at_offset, write_offset_file
+from util import Sentinel, start_processes, end_processes, set_logger,\
+        open_journal, open_input, pending_items, count_pending
+from metrics import Metrics, add_metrics_arguments
+from tarstream import extract_archive
 
 logging.basicConfig(format='%(asctime)-15s %(name)s %(levelname)s %(message)s', level=logging.INFO)
 logger = logging.getLogger()
 
-def execute_untar(pid, archive_path, untar_dest_path, fail_logger):
-    logger.info(f'(pid:{pid}) Executing extraction of files specified in {archive_path} and sending to file {untar_dest_path}')
-    logger.info(f'tar --extract --verbose --file={archive_path} --directory={untar_dest_path}')
-    tar_process = subprocess.Popen([
-        'tar',
-        '--extract',
-        '--verbose',
-        '--keep-directory-symlink',
-        '--keep-newer-files',
-        f'--file={archive_path}',
-        f'--directory={untar_dest_path}',
-    ], stdout=subprocess.PIPE)
-    tar_stdout, tar_stderr = tar_process.communicate()
-    if tar_process.returncode != 0:
-        logger.info(f'!!! TAR FAILURE: Failed to include file {archive_path} in archive {untar_dest_path} !!!')
+def execute_untar(pid, archive_path, untar_dest_path, num_writers, fail_logger):
+    logger.info(f'(pid:{pid}) Extracting {archive_path} into {untar_dest_path} with {num_writers} writers')
+    def on_skipped(name, reason):
+        logger.info(f'(pid:{pid}) Skipped {name} from {archive_path}: {reason}')
+    def on_failed(name, error):
+        logger.error(f'(pid:{pid}) Failed to extract {name} from {archive_path}: {error}')
+    start = time.monotonic()
+    try:
+        stats = extract_archive(archive_path, untar_dest_path, num_writers, on_skipped=on_skipped, on_failed=on_failed)
+    except (OSError, tarfile.TarError) as error:
+        logger.info(f'!!! TAR FAILURE: Failed to extract archive {archive_path} into {untar_dest_path}: {error} !!!')
         fail_logger.error(archive_path.encode(encoding='UTF-8'))
-    logger.info(f'(pid:{pid}): TAR EXTRACTION COMPLETE: {archive_path}')
+        return False
+    elapsed = max(time.monotonic() - start, 1e-6)
+    logger.info(f'(pid:{pid}): TAR EXTRACTION COMPLETE: {archive_path}: {stats["files"]} files, {stats["bytes"]} bytes, '
+                f'{stats["skipped"]} skipped, {stats["failed"]} failed in {elapsed:.1f}s ({stats["bytes"] / elapsed / 1e6:.1f} MB/s)')
+    if stats['failed']:
+        # Not journaled, so a rerun extracts the archive again
+        fail_logger.error(archive_path.encode(encoding='UTF-8'))
+        return False
+    return True
 
-def do_processing(pid, archive_queue, args):
+def do_processing(pid, archive_queue, args, journal):
     while True:
-        archive_path = archive_queue.get()
-        if isinstance(archive_path, Sentinel):
+        archive_item = archive_queue.get()
+        if isinstance(archive_item, Sentinel):
+            journal.close()
             logger.info(f'PID: {pid} complete. Waiting to join.')
             return
+        line_no, next_offset, archive_path = archive_item
 
         untar_dest_path = args.dest_dir
         # Setup error logging
@@ -47,14 +58,21 @@ def do_processing(pid, archive_queue, args):
         fh = logging.FileHandler(fail_log_path)
         fail_logger.addHandler(fh)
         # Do the thing
-        execute_untar(pid, archive_path, untar_dest_path, fail_logger) # DO THE TAR
+        start = time.monotonic()
+        untar_ok = execute_untar(pid, archive_path, untar_dest_path, args.num_writers, fail_logger) # DO THE TAR
+        if untar_ok:
+            journal.record(line_no, next_offset)
+        args.metrics.report(1, os.path.getsize(archive_path) if untar_ok else 0, time.monotonic() - start, untar_ok)
 
 def get_program_arguments():
     parser = argparse.ArgumentParser(description='Transfers a directory from a remote host(s) in parallel to a given local filesystem using rsync')
     parser.add_argument('tarlist_info_f', type=str, help='File containing one file path on the local host per line')
     parser.add_argument('--num-procs', type=int, default=1, help='Number of procs to divy up lines .')
     parser.add_argument('--dest-dir', type=str, default='/tmp', help='Destination within which the untarred archives will be placed.')
+    parser.add_argument('--num-writers', type=int, default=4, help='Writer threads per process extracting member data. Default: 4')
     parser.add_argument('--ignore-checkpoint', default=False, action='store_true')
+    parser.add_argument('--mmap', default=False, action='store_true', help='Read the input file through mmap.')
+    add_metrics_arguments(parser)
     args = parser.parse_args()
     return args
 
@@ -65,26 +83,31 @@ def main():
     logger.info(logstr)
 
     archive_queue = Queue(args.num_procs)
-    #completed_queue = Queue() # TODO
-    #failed_queue = Queue() # TODO
     logger.info(f'Starting {args.num_procs} procs')
-    procs = start_processes(archive_queue, do_processing, args.num_procs, args) # TODO: Start with the completed/failed queues
+    journal, checkpoint = open_journal(args.tarlist_info_f, args.ignore_checkpoint)
+    # Created before the fork so every process reports into it
+    args.metrics = Metrics('parallel-untar', count_pending(args.tarlist_info_f, checkpoint), args.metrics_file, args.metrics_format, args.metrics_interval)
+    procs = start_processes(archive_queue, do_processing, args.num_procs, args, journal)
+    args.metrics.start()
+
+    # Seek past whatever a previous run already finished
+    logger.info(f'Skipping {checkpoint.line_count} lines and {len(checkpoint.completed)} more items already completed...')
 
-    # See if there is a point in the input file we should resume at
-    start_from, offset_file_path = get_start_offset(args.tarlist_info_f, args.ignore_checkpoint)
-    logger.info(f'Starting processing from {start_from} lines into the input file...')
+    start = time.monotonic()
+    archive_bytes = 0
+    with open_input(args.tarlist_info_f, args.mmap) as f:
+        for i, next_offset, archive_item in pending_items(f, checkpoint, journal):
+            archive_queue.put((i, next_offset, archive_item))
+            try:
+                archive_bytes += os.path.getsize(archive_item)
+            except OSError:
+                pass # The worker will log it as a failure
 
-    with open(args.tarlist_info_f) as f:
-        for i, item in enumerate(f):
-            while not at_offset(i, start_from, f):
-                continue
-            archive_item = item.strip()
-            archive_queue.put(archive_item)
-            # TODO: Check the operation result queue to see if any files were completed, if so, then run_write_offset_file
-            write_offset_file(i, offset_file_path) # TODO: should probably do after the tar completes instead
-            
     logger.info('All items produced to consumer processes. Dispatching Sentinel.')
     end_processes(archive_queue, procs)
+    args.metrics.stop()
+    elapsed = max(time.monotonic() - start, 1e-6)
+    logger.info(f'Read {archive_bytes} archive bytes in {elapsed:.1f}s ({archive_bytes / elapsed / 1e6:.1f} MB/s overall)')
 
 if __name__ == "__main__":
     main()
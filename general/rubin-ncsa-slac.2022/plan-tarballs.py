@@ -0,0 +1,142 @@
+# Tarball Planner
+# Given an input file consisting of file sizes and paths to files (the parallel-tar.py input format),
+#      split it into balanced archive manifests of roughly --target-size bytes each,
+#      so every archive lands near a tape-friendly size and there are no tiny leftovers.
+# The manifests are then run with: parallel-tar.py --manifests <manifest-dir>/manifests.list
+
+import argparse
+import heapq
+import logging
+import math
+import os
+import os.path
+from collections import defaultdict
+
+logging.basicConfig(format='%(asctime)-15s %(name)s %(levelname)s %(message)s', level=logging.INFO)
+logger = logging.getLogger()
+
+ONE_TERABYTE = int(math.pow(1024, 4))
+SIZE_SUFFIXES = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4, 'P': 1024 ** 5}
+
+def parse_size(size):
+    # Bytes, optionally with a binary K/M/G/T/P suffix (e.g. 512G)
+    suffix = size[-1:].upper()
+    if suffix in SIZE_SUFFIXES:
+        return int(float(size[:-1]) * SIZE_SUFFIXES[suffix])
+    return int(size)
+
+def read_file_info(file_info_path):
+    # Yields (size, path) for each "<size> <path>" line; paths may contain spaces
+    with open(file_info_path, encoding='utf-8', errors='ignore') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            size, path = line.replace('\t', ' ').split(' ', 1)
+            yield int(size), path.lstrip(' ')
+
+def group_units(files, by_directory, max_unit_size):
+    # A unit is a set of files that must land in the same archive: a single file,
+    #     or with by_directory every file in one directory (split if the directory alone is too big)
+    if not by_directory:
+        return [(size, [(size, path)]) for size, path in files]
+    directories = defaultdict(list)
+    for size, path in files:
+        directories[os.path.dirname(path)].append((size, path))
+    units = []
+    for directory in sorted(directories):
+        unit, unit_size = [], 0
+        for size, path in sorted(directories[directory], key=lambda f: f[1]):
+            if unit and unit_size + size > max_unit_size:
+                units.append((unit_size, unit))
+                unit, unit_size = [], 0
+            unit.append((size, path))
+            unit_size += size
+        units.append((unit_size, unit))
+    return units
+
+def pack(units, num_archives):
+    # LPT: units largest first onto the currently smallest of num_archives archives.
+    #     Returns (size, number of units, [(size, path), ...]) per archive.
+    heap = [(0, i) for i in range(num_archives)] # (current size, archive number)
+    contents = [[] for _ in range(num_archives)]
+    num_units = [0] * num_archives
+    for unit_size, unit_files in sorted(units, key=lambda unit: unit[0], reverse=True):
+        archive_size, i = heapq.heappop(heap)
+        contents[i].extend(unit_files)
+        num_units[i] += 1
+        heapq.heappush(heap, (archive_size + unit_size, i))
+    sizes = dict((i, size) for size, i in heap)
+    return [(sizes[i], num_units[i], contents[i]) for i in range(num_archives) if contents[i]]
+
+def plan_archives(units, target_size, tolerance):
+    """
+    Packs units into archives whose sizes are as equal as possible and within the tolerance of target_size.
+
+    The number of archives starts at the fewest that could hold the total under the upper
+    tolerance bound; units are then placed largest first onto the currently smallest archive (LPT),
+    adding archives while any archive of more than one unit is still over the bound. Units larger
+    than the upper bound get an archive of their own.
+
+    :returns: list of archives, each a (size, [(size, path), ...]) tuple
+    """
+    upper = target_size * (1 + tolerance)
+    oversized = [unit for unit in units if unit[0] > upper]
+    packable = [unit for unit in units if unit[0] <= upper]
+    total = sum(unit[0] for unit in packable)
+    num_archives = max(1, math.ceil(total / upper)) if packable else 0
+
+    packed = pack(packable, num_archives)
+    while num_archives < len(packable) and any(size > upper and num_units > 1 for size, num_units, _ in packed):
+        num_archives += 1
+        packed = pack(packable, num_archives)
+
+    archives = [(size, files) for size, _, files in packed]
+    archives.extend(oversized)
+    return archives
+
+def write_manifests(archives, manifest_dir, prefix):
+    # One manifest per archive, in the same "<size> <path>" format as the input, plus a list of the manifests
+    os.makedirs(manifest_dir, exist_ok=True)
+    manifest_list_path = os.path.join(manifest_dir, 'manifests.list')
+    with open(manifest_list_path, 'w') as manifest_list:
+        for n, (archive_size, archive_files) in enumerate(archives):
+            manifest_path = os.path.join(manifest_dir, f'{prefix}{n:06d}.manifest')
+            with open(manifest_path, 'w') as manifest:
+                for size, path in sorted(archive_files, key=lambda f: f[1]):
+                    manifest.write(f'{size} {path}\n')
+            manifest_list.write(f'{os.path.abspath(manifest_path)}\n')
+    return manifest_list_path
+
+def get_program_arguments():
+    parser = argparse.ArgumentParser(description='Plans balanced tar archives from a list of file sizes and paths')
+    parser.add_argument('file_info_f', type=str, help='File containing one "<size in bytes> <path>" per line')
+    parser.add_argument('--manifest-dir', type=str, required=True, help='Directory the archive manifests are written to.')
+    parser.add_argument('--manifest-prefix', type=str, default='tar_', help='Name to prepend to each manifest (and so each archive).')
+    parser.add_argument('--target-size', type=parse_size, default=ONE_TERABYTE, help='Target archive size in bytes, K/M/G/T suffixes allowed. Default: 1T')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Allowed relative deviation from the target size. Default: 0.1')
+    parser.add_argument('--group-by-directory', default=False, action='store_true', help='Keep files from the same directory in the same archive where possible.')
+    args = parser.parse_args()
+    return args
+
+def main():
+    args = get_program_arguments()
+    logger.info(f'Planning archives of {args.target_size} bytes (+/- {args.tolerance:.0%}) from {args.file_info_f}')
+
+    files = list(read_file_info(args.file_info_f))
+    units = group_units(files, args.group_by_directory, args.target_size)
+    archives = plan_archives(units, args.target_size, args.tolerance)
+    manifest_list_path = write_manifests(archives, args.manifest_dir, args.manifest_prefix)
+
+    sizes = [size for size, _ in archives]
+    lower, upper = args.target_size * (1 - args.tolerance), args.target_size * (1 + args.tolerance)
+    outside = sum(1 for size in sizes if not lower <= size <= upper)
+    logger.info(f'Planned {len(archives)} archives for {len(files)} files ({sum(sizes)} bytes)')
+    if sizes:
+        logger.info(f'Archive sizes: min {min(sizes)} / mean {sum(sizes) // len(sizes)} / max {max(sizes)} bytes')
+    if outside:
+        logger.warning(f'{outside} archives fall outside the tolerance (oversized files, or too little data for one full archive)')
+    logger.info(f'Manifest list written to {manifest_list_path}')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+# Tar member retrieval
+# Pulls individual members out of archives written by parallel-tar.py without scanning them:
+#      the member index in each archive's .json sidecar gives the header and data offsets,
+#      so a restore is a couple of pread calls instead of a pass over a 1 TB archive.
+# Batch mode extracts many members from many archives, each archive read in offset order.
+
+import argparse
+import io
+import logging
+import os
+import os.path
+import tarfile
+import time
+import zlib
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+from tarstream import load_index
+
+logging.basicConfig(format='%(asctime)-15s %(name)s %(levelname)s %(message)s', level=logging.INFO)
+logger = logging.getLogger()
+
+READ_CHUNK_SIZE = 16 * 1024 * 1024
+
+def dest_path_for(dest_dir, name):
+    # Refuse member names that would land outside the destination
+    if name.startswith('/') or '..' in name.split('/'):
+        raise ValueError(f'Refusing to extract {name} outside of {dest_dir}')
+    return os.path.join(dest_dir, name)
+
+def read_tarinfo(fd, member):
+    # Parse just the member's header block(s), which sit between its header and data offsets
+    header = os.pread(fd, member['data_offset'] - member['header_offset'], member['header_offset'])
+    with tarfile.open(fileobj=io.BytesIO(header), mode='r:') as tar:
+        return tar.next()
+
+def copy_data(fd, member, dest_path):
+    adler32 = 1
+    offset = member['data_offset']
+    remaining = member['size']
+    with open(dest_path, 'wb') as out:
+        while remaining:
+            chunk = os.pread(fd, min(READ_CHUNK_SIZE, remaining), offset)
+            if not chunk:
+                raise EOFError(f'Archive ends inside {member["name"]}')
+            out.write(chunk)
+            adler32 = zlib.adler32(chunk, adler32)
+            offset += len(chunk)
+            remaining -= len(chunk)
+    return f'{adler32:08x}'
+
+def extract_member(fd, member, dest_dir, verify=True):
+    # Returns the bytes written, or None if the member's type can't be retrieved
+    tarinfo = read_tarinfo(fd, member)
+    dest_path = dest_path_for(dest_dir, member['name'])
+    os.makedirs(os.path.dirname(dest_path) or '.', exist_ok=True)
+    if tarinfo.isdir():
+        os.makedirs(dest_path, exist_ok=True)
+    elif tarinfo.issym():
+        if os.path.lexists(dest_path):
+            os.remove(dest_path)
+        os.symlink(tarinfo.linkname, dest_path)
+        return 0
+    elif tarinfo.isreg():
+        adler32 = copy_data(fd, member, dest_path)
+        if verify and member.get('adler32') and adler32 != member['adler32']:
+            raise ValueError(f'{member["name"]}: adler32 {adler32} does not match the index ({member["adler32"]})')
+    else:
+        logger.warning(f'Skipping {member["name"]}: only files, directories and symlinks can be retrieved')
+        return None
+    os.chmod(dest_path, tarinfo.mode)
+    os.utime(dest_path, (tarinfo.mtime, tarinfo.mtime))
+    return member['size']
+
+def retrieve(archive_path, names, dest_dir, verify=True):
+    # Extracts the named members from one archive in data offset order; returns (retrieved, skipped, failed)
+    index = load_index(archive_path)
+    members = []
+    failed = 0
+    for name in names:
+        member = index.get(name.lstrip('/'))
+        if member is None:
+            logger.error(f'{name} is not in the index of {archive_path}')
+            failed += 1
+        else:
+            members.append(member)
+    members.sort(key=lambda member: member['data_offset'])
+
+    retrieved = skipped = 0
+    fd = os.open(archive_path, os.O_RDONLY)
+    try:
+        for member in members:
+            start = time.monotonic()
+            try:
+                nbytes = extract_member(fd, member, dest_dir, verify)
+            except (OSError, ValueError, tarfile.TarError) as error:
+                logger.error(f'Failed to retrieve {member["name"]} from {archive_path}: {error}')
+                failed += 1
+                continue
+            if nbytes is None:
+                skipped += 1
+                continue
+            retrieved += 1
+            logger.info(f'Retrieved {member["name"]} ({nbytes} bytes) from {archive_path} in {(time.monotonic() - start) * 1000:.1f}ms')
+    finally:
+        os.close(fd)
+    return retrieved, skipped, failed
+
+def read_batch(batch_path):
+    # "<archive path>\t<member name>" per line, grouped by archive
+    requests = defaultdict(list)
+    with open(batch_path, encoding='utf-8') as batch:
+        for line in batch:
+            line = line.rstrip('\n')
+            if line:
+                archive_path, name = line.split('\t', 1)
+                requests[archive_path].append(name)
+    return requests
+
+def get_program_arguments():
+    parser = argparse.ArgumentParser(description='Retrieves individual members from tar archives written by parallel-tar.py using their member index')
+    parser.add_argument('archive', type=str, nargs='?', help='Archive to retrieve from (its .json sidecar must sit next to it).')
+    parser.add_argument('members', type=str, nargs='*', help='Member names to retrieve.')
+    parser.add_argument('--batch', type=str, help='File with one "<archive path>\\t<member name>" per line, instead of archive and members.')
+    parser.add_argument('--dest-dir', type=str, default='.', help='Directory the members are extracted below.')
+    parser.add_argument('--num-procs', type=int, default=1, help='Number of archives read in parallel in --batch mode.')
+    parser.add_argument('--no-verify', default=False, action='store_true', help='Skip checking retrieved data against the indexed adler32.')
+    args = parser.parse_args()
+    if not args.batch and not (args.archive and args.members):
+        parser.error('give an archive and member names, or --batch')
+    return args
+
+def main():
+    args = get_program_arguments()
+    requests = read_batch(args.batch) if args.batch else {args.archive: args.members}
+    verify = not args.no_verify
+
+    retrieved = skipped = failed = 0
+    with ProcessPoolExecutor(max_workers=args.num_procs) as pool:
+        futures = [pool.submit(retrieve, archive_path, names, args.dest_dir, verify) for archive_path, names in requests.items()]
+        for future in futures:
+            archive_retrieved, archive_skipped, archive_failed = future.result()
+            retrieved += archive_retrieved
+            skipped += archive_skipped
+            failed += archive_failed
+    logger.info(f'Retrieved {retrieved} members from {len(requests)} archives, {skipped} skipped, {failed} failed')
+    if failed:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
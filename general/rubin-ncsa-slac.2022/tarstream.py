@@ -0,0 +1,347 @@
+# Streaming tar writer with inline checksums
+# Writes an archive in-process with tarfile, hashing every byte on its way out, so the archive's
+#     adler32/md5 (and each member's) are known the moment it is closed, without reading it back.
+# Also home to the header-only lister and the parallel extractor used by the other tar tools.
+
+import grp
+import hashlib
+import json
+import os
+import os.path
+import pwd
+import tarfile
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+WRITE_BUFFER_SIZE = 16 * 1024 * 1024 # A multiple of tarfile.RECORDSIZE, so writes stay record-aligned
+EXTRACT_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+class Checksums:
+    def __init__(self):
+        self.adler32 = 1
+        self.md5 = hashlib.md5()
+        self.size = 0
+
+    def update(self, data):
+        self.adler32 = zlib.adler32(data, self.adler32)
+        self.md5.update(data)
+        self.size += len(data)
+
+    def as_dict(self):
+        return {'bytes': self.size, 'adler32': f'{self.adler32:08x}', 'md5': self.md5.hexdigest()}
+
+
+class HashingWriter:
+    # Unbuffered file sink that checksums everything written; tarfile's stream does the buffering
+    def __init__(self, path):
+        self.f = open(path, 'wb', buffering=0)
+        self.checksums = Checksums()
+
+    def write(self, data):
+        self.checksums.update(data)
+        view = memoryview(data)
+        while view:
+            written = self.f.write(view)
+            view = view[written:]
+        return len(data)
+
+    def close(self):
+        os.fsync(self.f.fileno())
+        self.f.close()
+
+
+class HashingReader:
+    # Checksums a member's data as tarfile copies it into the archive
+    def __init__(self, f):
+        self.f = f
+        self.checksums = Checksums()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.checksums.update(data)
+        return data
+
+
+def padded_size(size):
+    blocks, remainder = divmod(size, tarfile.BLOCKSIZE)
+    return (blocks + (1 if remainder else 0)) * tarfile.BLOCKSIZE
+
+
+def iter_paths(path):
+    # Like tar --files-from: a directory brings in everything below it
+    yield path
+    if os.path.isdir(path) and not os.path.islink(path):
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for name in dirnames + sorted(filenames):
+                yield os.path.join(dirpath, name)
+
+
+def write_archive(archive_path, file_paths, on_missed=None, buffer_size=WRITE_BUFFER_SIZE):
+    """
+    Writes file_paths (and anything below directories among them) into a tar archive.
+
+    Files that cannot be read are skipped and passed to on_missed(path, error), like tar --ignore-failed-read.
+    The archive is written under a temporary name and only renamed to archive_path once complete, so a
+    failure (e.g. a file shrinking while it is read) never leaves a truncated archive behind.
+
+    :returns: a manifest dict with the archive's bytes/adler32/md5 and one entry per member
+    """
+    partial_path = archive_path + '.partial'
+    sink = HashingWriter(partial_path)
+    members = []
+    try:
+        with tarfile.open(fileobj=sink, mode='w|', format=tarfile.GNU_FORMAT, bufsize=buffer_size) as tar:
+            tar.copybufsize = buffer_size
+            for top_path in file_paths:
+                for path in iter_paths(top_path):
+                    try:
+                        tarinfo = tar.gettarinfo(path)
+                        # Hard links to a member already written are LNKTYPE with no data of their own;
+                        #     only real file data gets checksums in the index
+                        source = open(path, 'rb') if tarinfo is not None and tarinfo.isreg() else None
+                    except OSError as error:
+                        tarinfo, source = None, error
+                    if tarinfo is None: # Unreadable, or a type tar can't hold (e.g. a socket)
+                        if on_missed is not None:
+                            on_missed(path, source or 'unsupported file type')
+                        continue
+                    member = {'name': tarinfo.name, 'size': tarinfo.size, 'header_offset': tar.offset}
+                    if source is None:
+                        tar.addfile(tarinfo)
+                    else:
+                        with source:
+                            reader = HashingReader(source)
+                            tar.addfile(tarinfo, reader)
+                        checksums = reader.checksums.as_dict()
+                        member['adler32'] = checksums['adler32']
+                        member['md5'] = checksums['md5']
+                    # The data (padded to whole blocks) is the last thing written for the member
+                    member['data_offset'] = tar.offset - padded_size(tarinfo.size)
+                    members.append(member)
+        sink.close()
+    except BaseException:
+        sink.f.close()
+        os.unlink(partial_path)
+        raise
+    os.replace(partial_path, archive_path)
+    manifest = {'name': os.path.basename(archive_path)}
+    manifest.update(sink.checksums.as_dict())
+    manifest['members'] = members
+    return manifest
+
+
+def write_sidecar(archive_path, manifest):
+    # <archive>.json next to the archive, ready for ingest, doubling as the archive's member index
+    sidecar_path = archive_path + '.json'
+    with open(sidecar_path, 'w') as sidecar:
+        json.dump(manifest, sidecar, indent=1)
+        sidecar.write('\n')
+    return sidecar_path
+
+
+def load_index(archive_path):
+    # {member name: member entry} from the archive's sidecar
+    with open(archive_path + '.json') as sidecar:
+        manifest = json.load(sidecar)
+    return {member['name']: member for member in manifest['members']}
+
+
+def iter_members(archive_path):
+    # Yields a TarInfo per member reading only the headers: in an uncompressed archive tarfile
+    #     seeks over member data, so listing a 1 TB archive reads kilobytes per member, not the data
+    with tarfile.open(archive_path, mode='r:') as tar:
+        while True:
+            tarinfo = tar.next()
+            if tarinfo is None:
+                return
+            tar.members = [] # Don't hold millions of TarInfos just to list them
+            yield tarinfo
+
+
+class PwriteFile:
+    # Destination file filled by several writer threads at once with pwrite. The reader holds a
+    #     reference while it hands out chunks; metadata is applied once the last chunk has landed.
+    def __init__(self, path, tarinfo):
+        self.tarinfo = tarinfo
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        if tarinfo.size:
+            try:
+                os.posix_fallocate(self.fd, 0, tarinfo.size) # One contiguous allocation instead of growing chunk by chunk
+            except OSError:
+                pass # Not every filesystem supports it
+        self.pending = 1
+        self.lock = threading.Lock()
+
+    def add_chunk(self):
+        with self.lock:
+            self.pending += 1
+
+    def write(self, data, offset):
+        try:
+            view = memoryview(data)
+            while view:
+                written = os.pwrite(self.fd, view, offset)
+                view = view[written:]
+                offset += written
+        finally:
+            self.release()
+
+    def release(self):
+        with self.lock:
+            self.pending -= 1
+            if self.pending:
+                return
+        try:
+            os.fchmod(self.fd, self.tarinfo.mode)
+            if os.geteuid() == 0:
+                os.fchown(self.fd, *owner_ids(self.tarinfo))
+            os.utime(self.fd, (self.tarinfo.mtime, self.tarinfo.mtime))
+        finally:
+            os.close(self.fd)
+
+
+@lru_cache(maxsize=None)
+def _owner_ids(uname, gname, uid, gid):
+    # Names win over numeric ids when they exist here, as with tar
+    try:
+        uid = pwd.getpwnam(uname).pw_uid
+    except KeyError:
+        pass
+    try:
+        gid = grp.getgrnam(gname).gr_gid
+    except KeyError:
+        pass
+    return uid, gid
+
+
+def owner_ids(tarinfo):
+    return _owner_ids(tarinfo.uname, tarinfo.gname, tarinfo.uid, tarinfo.gid)
+
+
+def member_dest_path(dest_dir, name):
+    # Leading slashes are dropped and members reaching outside dest_dir are refused, as tar does
+    name = name.lstrip('/')
+    if not name or '..' in name.split('/'):
+        return None
+    return os.path.join(dest_dir, name)
+
+
+def is_newer(dest_path, mtime):
+    try:
+        return os.lstat(dest_path).st_mtime > mtime
+    except FileNotFoundError:
+        return False
+
+
+def remove_existing(dest_path):
+    # Replace files and links, including links to directories; real directories are kept
+    if os.path.islink(dest_path) or (os.path.lexists(dest_path) and not os.path.isdir(dest_path)):
+        os.unlink(dest_path)
+
+
+def extract_archive(archive_path, dest_dir, num_writers=4, keep_newer_files=True,
+                    chunk_size=EXTRACT_CHUNK_SIZE, on_skipped=None, on_failed=None):
+    """
+    Extracts an archive into dest_dir, reading it sequentially while a pool of writer
+    threads lays member data down with preallocated pwrites.
+
+    Like tar --keep-newer-files, existing files newer than their archive copy are left alone.
+    Like tar --keep-directory-symlink, a symlink standing where the archive has a directory is kept.
+    A member that cannot be created is passed to on_failed(name, error) and extraction carries on.
+
+    :returns: dict with the number of files and bytes written and members skipped and failed
+    """
+    stats = {'files': 0, 'bytes': 0, 'skipped': 0, 'failed': 0}
+    errors = []
+    directories = []
+    in_flight = threading.BoundedSemaphore(num_writers * 4) # Caps buffered chunk memory
+
+    def chunk_written(future):
+        in_flight.release()
+        if future.exception() is not None:
+            errors.append(future.exception())
+
+    def skip(tarinfo, reason):
+        stats['skipped'] += 1
+        if on_skipped is not None:
+            on_skipped(tarinfo.name, reason)
+
+    def fail(tarinfo, error):
+        stats['failed'] += 1
+        if on_failed is not None:
+            on_failed(tarinfo.name, error)
+
+    with open(archive_path, 'rb', buffering=chunk_size) as archive, \
+            tarfile.open(fileobj=archive, mode='r:') as tar, \
+            ThreadPoolExecutor(max_workers=num_writers) as writers:
+        while not errors:
+            tarinfo = tar.next()
+            if tarinfo is None:
+                break
+            tar.members = []
+            dest_path = member_dest_path(dest_dir, tarinfo.name)
+            if dest_path is None:
+                skip(tarinfo, 'member path leaves the destination')
+                continue
+            if tarinfo.isdir():
+                os.makedirs(dest_path, exist_ok=True)
+                directories.append((dest_path, tarinfo))
+                continue
+            if keep_newer_files and is_newer(dest_path, tarinfo.mtime):
+                skip(tarinfo, 'existing file is newer')
+                continue
+            try:
+                os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+                remove_existing(dest_path)
+                sink = PwriteFile(dest_path, tarinfo) if tarinfo.isreg() else None
+            except OSError as error: # E.g. a directory standing where the member goes
+                fail(tarinfo, error)
+                continue
+            if tarinfo.isreg():
+                source = tar.extractfile(tarinfo)
+                offset = 0
+                while True:
+                    chunk = source.read(chunk_size)
+                    if not chunk:
+                        break
+                    in_flight.acquire()
+                    sink.add_chunk()
+                    writers.submit(sink.write, chunk, offset).add_done_callback(chunk_written)
+                    offset += len(chunk)
+                sink.release()
+                stats['files'] += 1
+                stats['bytes'] += tarinfo.size
+            elif tarinfo.issym():
+                try:
+                    os.symlink(tarinfo.linkname, dest_path)
+                    if os.geteuid() == 0:
+                        os.lchown(dest_path, *owner_ids(tarinfo))
+                    # The link's own mtime, so --keep-newer-files doesn't take it for newer on the next run
+                    os.utime(dest_path, (tarinfo.mtime, tarinfo.mtime), follow_symlinks=False)
+                except OSError as error: # E.g. a directory kept where the archive has the symlink
+                    fail(tarinfo, error)
+            elif tarinfo.islnk():
+                link_target = member_dest_path(dest_dir, tarinfo.linkname)
+                if link_target is None:
+                    skip(tarinfo, 'hard link target leaves the destination')
+                    continue
+                try:
+                    os.link(link_target, dest_path)
+                except OSError as error:
+                    fail(tarinfo, error)
+            else:
+                skip(tarinfo, 'unsupported member type')
+    if errors:
+        raise errors[0]
+
+    # Directory metadata goes last, deepest first, so extracting their contents doesn't disturb it
+    for dest_path, tarinfo in reversed(directories):
+        if os.path.islink(dest_path):
+            continue # --keep-directory-symlink: leave the symlink and its target alone
+        os.chmod(dest_path, tarinfo.mode)
+        os.utime(dest_path, (tarinfo.mtime, tarinfo.mtime))
+    return stats
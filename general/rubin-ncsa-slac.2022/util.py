@@ -1,11 +1,13 @@
 import hashlib
+import mmap
 import os
-import shutil
-import tempfile
+import time
+from contextlib import contextmanager
 from multiprocessing import Process
 
 logger = None
-OFFSET_MODULO=500
+JOURNAL_SYNC_EVERY = 64
+JOURNAL_SYNC_SECONDS = 5
 
 class Sentinel:
     pass
@@ -16,42 +18,170 @@ def get_hash_digits(string_to_hash):
     digits = md5.hexdigest()[:2]
     return digits
 
-def write_offset_file(i, offset_file_path, modulo=OFFSET_MODULO):
-    if i % modulo == 0: # Only do this every so often
-        temp_f = tempfile.NamedTemporaryFile(mode='wt', delete=False)
-        temp_f.write(str(i))
-        temp_fname = temp_f.name
-        temp_f.close()
-        shutil.copy(temp_fname, offset_file_path)
-        os.remove(temp_fname)
-
-def at_offset(i, start_from, frequency=100000):
-    if i < start_from:
-        if i < 3 or i % frequency == 0:
-            logger.info(f'Seeking to offset {i} / {start_from}...')
-            return False
-    return True
-
 def set_logger(main_logger):
     global logger
     logger = main_logger
 
-def get_start_offset(operation_list_path, ignore_checkpoint):
-    start_from = 0
-    offset_file_path = f'{operation_list_path}.resume'
-    if not ignore_checkpoint:
+class Checkpoint:
+    # Where to resume in the input: the byte offset and line number just past the longest
+    #     fully-completed prefix, plus the line numbers completed beyond it
+    def __init__(self, offset=0, line_count=0, completed=None):
+        self.offset = offset
+        self.line_count = line_count
+        self.completed = completed if completed is not None else set()
+
+class CompletionJournal:
+    # Append-only log of the input lines whose work has finished, as "<line number> <offset of the next line>".
+    # Each process appends through its own O_APPEND descriptor, one small write per record,
+    #     and fsyncs every JOURNAL_SYNC_EVERY records or JOURNAL_SYNC_SECONDS, whichever comes first.
+    # A crash can only lose the unsynced tail, so those items get redone rather than skipped.
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.pid = None
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def _open(self):
+        # Opened lazily so every forked worker gets its own descriptor
+        if self.pid != os.getpid():
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            self.pid = os.getpid()
+            self.unsynced = 0
+        return self.fd
+
+    def record(self, line_no, next_offset):
+        os.write(self._open(), f'{line_no} {next_offset}\n'.encode())
+        self.unsynced += 1
+        if self.unsynced >= JOURNAL_SYNC_EVERY or time.monotonic() - self.last_sync >= JOURNAL_SYNC_SECONDS:
+            self.sync()
+
+    def sync(self):
+        if self.pid == os.getpid() and self.unsynced:
+            os.fsync(self.fd)
+            self.unsynced = 0
+            self.last_sync = time.monotonic()
+
+    def close(self):
+        if self.pid == os.getpid():
+            self.sync()
+            os.close(self.fd)
+            self.fd = None
+            self.pid = None
+
+    def reset(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def completed(self):
+        # {line number: offset of the next line} recorded so far. A torn final record (no newline) is ignored.
+        done = {}
         try:
-            logger.info(f'Checking {offset_file_path} for a line offset...')
-            with open(offset_file_path, 'r') as offset_file:
-                start_from = int(offset_file.read())
-        except OSError:
+            with open(self.path, 'r') as journal_file:
+                for record in journal_file:
+                    if record.endswith('\n'):
+                        line_no, next_offset = record.split()
+                        done[int(line_no)] = int(next_offset)
+        except FileNotFoundError:
             pass
-    return start_from, offset_file_path
+        return done
+
+    def rewrite(self, done):
+        # Replace the journal with just the given records (used to compact it on startup)
+        write_atomically(self.path, ''.join(f'{line_no} {next_offset}\n' for line_no, next_offset in sorted(done.items())))
+
+def write_atomically(path, data):
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'w') as temp_f:
+        temp_f.write(data)
+        temp_f.flush()
+        os.fsync(temp_f.fileno())
+    os.replace(temp_path, path)
+
+def checkpoint_is_sane(operation_list_path, offset, line_count):
+    # The offset must land just after a newline within the file, and every line takes at least a byte
+    if offset == 0:
+        return line_count == 0
+    if line_count > offset or offset > os.path.getsize(operation_list_path):
+        return False
+    with open(operation_list_path, 'rb') as f:
+        f.seek(offset - 1)
+        return f.read(1) == b'\n'
+
+def read_checkpoint(operation_list_path, checkpoint_path):
+    try:
+        logger.info(f'Checking {checkpoint_path} for a byte offset...')
+        with open(checkpoint_path, 'r') as checkpoint_file:
+            offset, line_count = (int(field) for field in checkpoint_file.read().split())
+    except OSError:
+        return 0, 0
+    except ValueError:
+        logger.warning(f'{checkpoint_path} is not a byte offset checkpoint, ignoring it')
+        return 0, 0
+    if not checkpoint_is_sane(operation_list_path, offset, line_count):
+        logger.warning(f'{checkpoint_path} does not match {operation_list_path}, ignoring it')
+        return 0, 0
+    return offset, line_count
+
+def open_journal(operation_list_path, ignore_checkpoint):
+    # Folds the journal into the checkpoint: the contiguous completed prefix becomes a byte offset to seek to,
+    #     and only completions past it stay in the journal
+    journal = CompletionJournal(f'{operation_list_path}.journal')
+    checkpoint_path = f'{operation_list_path}.resume'
+    if ignore_checkpoint:
+        journal.reset()
+        write_atomically(checkpoint_path, '0 0\n')
+    offset, line_count = read_checkpoint(operation_list_path, checkpoint_path)
+    logger.info(f'Checking {journal.path} for completed items...')
+    done = journal.completed()
+    while line_count in done:
+        offset = done.pop(line_count)
+        line_count += 1
+    done = {line_no: next_offset for line_no, next_offset in done.items() if line_no > line_count}
+    write_atomically(checkpoint_path, f'{offset} {line_count}\n')
+    journal.rewrite(done)
+    return journal, Checkpoint(offset, line_count, set(done))
+
+@contextmanager
+def open_input(operation_list_path, use_mmap=False):
+    # Binary reader over the input, through mmap if asked (and the file isn't empty)
+    with open(operation_list_path, 'rb') as f:
+        if use_mmap and os.path.getsize(operation_list_path) > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                yield mm
+        else:
+            yield f
+
+def pending_items(f, checkpoint, journal, errors='strict'):
+    # Seeks straight to the checkpoint, then yields (line number, offset of the next line, item)
+    #     for every input line not already completed. Blank lines are journaled as done right away.
+    f.seek(checkpoint.offset)
+    logger.info(f'Resuming at byte {checkpoint.offset} (line {checkpoint.line_count}) of the input...')
+    i = checkpoint.line_count
+    offset = checkpoint.offset
+    for line in iter(f.readline, b''):
+        offset += len(line)
+        item = line.decode('utf-8', errors=errors).strip()
+        if not item:
+            journal.record(i, offset)
+        elif i not in checkpoint.completed:
+            yield i, offset, item
+        i += 1
+    journal.close()
+
+def count_pending(operation_list_path, checkpoint):
+    # Lines still to do past the checkpoint, for progress and ETA; one buffered pass counting newlines
+    with open(operation_list_path, 'rb') as f:
+        f.seek(checkpoint.offset)
+        lines = sum(chunk.count(b'\n') for chunk in iter(lambda: f.read(1024 * 1024), b''))
+    return max(lines - len(checkpoint.completed), 0)
 
-def start_processes(queue, do_processing, num_procs, args):
+def start_processes(queue, do_processing, num_procs, args, journal):
     procs = []
     for i in range(num_procs):
-        p = Process(target=do_processing, args=(i, queue, args))
+        p = Process(target=do_processing, args=(i, queue, args, journal))
         p.start()
         procs.append(p)
     return procs
@@ -0,0 +1,143 @@
+# Dynamic work scheduler
+# Streams items from an input to n worker threads or processes through a bounded queue.
+#     Idle workers pull the next item as soon as they finish, so a few slow items
+#     only hold up the worker that drew them instead of the whole run.
+#
+# Used by the tools in rucio/, sam/ and general/. Scripts outside this directory
+# put it on their path with:
+#     sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), <relative path to general/>))
+
+import heapq
+import logging
+import multiprocessing
+import queue
+import threading
+from itertools import islice
+
+logger = logging.getLogger('scheduler')
+
+PUT_TIMEOUT = 1.0 # Seconds between liveness checks while the queue is full
+
+
+class Sentinel:
+    pass
+
+
+def read_items(f):
+    # Stream stripped, non-empty lines from an open file without reading it all in
+    for line in f:
+        item = line.strip()
+        if item:
+            yield item
+
+
+def chunked(iterable, size):
+    # Lists of up to size items from a stream, for work handed out in batches
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def largest_first(items, weight, window):
+    # Reorder a stream so the heaviest of the next `window` items is handed out first.
+    # Only `window` items are ever held in memory.
+    heap = []
+    for seq, item in enumerate(items):
+        heapq.heappush(heap, (-weight(item), seq, item))
+        if len(heap) >= window:
+            yield heapq.heappop(heap)[2]
+    while heap:
+        yield heapq.heappop(heap)[2]
+
+
+def consume(work_queue):
+    # Yields items from the queue until the scheduler signals the end of the input
+    while True:
+        item = work_queue.get()
+        if isinstance(item, Sentinel):
+            return
+        yield item
+
+
+def _run_worker(target, tid, work_queue, args):
+    target(tid, consume(work_queue), *args)
+
+
+class WorkScheduler:
+    """
+    Runs target(tid, items, *args) in num_workers threads (or processes), where
+    items is an iterator over the work handed to that worker.
+
+    with WorkScheduler(do_processing, 8, args=(args,)) as scheduler:
+        scheduler.feed(read_items(f))
+    """
+    def __init__(self, target, num_workers, args=(), processes=False, queue_depth=None):
+        self.num_workers = num_workers
+        depth = queue_depth if queue_depth is not None else 2 * num_workers
+        if processes:
+            # Always fork: workers inherit target and args as they are (locks, thread-locals, open clients)
+            #     instead of getting pickled copies, which spawn and forkserver would need
+            context = multiprocessing.get_context('fork')
+            self.queue = context.Queue(depth)
+            worker_type = context.Process
+        else:
+            self.queue = queue.Queue(depth)
+            worker_type = threading.Thread
+        self.workers = [
+            worker_type(target=_run_worker, args=(target, tid, self.queue, args))
+            for tid in range(num_workers)
+        ]
+        self.num_items = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.finish()
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def put(self, item):
+        # Blocks while the queue is full, but gives up if every worker has died
+        while True:
+            try:
+                self.queue.put(item, timeout=PUT_TIMEOUT)
+                return
+            except queue.Full:
+                if not any(worker.is_alive() for worker in self.workers):
+                    raise RuntimeError('All workers exited before the input was fully consumed')
+
+    def feed(self, items, weight=None, window=1):
+        """
+        Hands every item to the workers as they become free.
+
+        :param items: iterable of work items, consumed lazily
+        :param weight: optional function giving an item's cost (e.g. its size in bytes)
+        :param window: with weight, reorder this many upcoming items heaviest first
+        :returns: the number of items fed
+        """
+        if weight is not None and window > 1:
+            items = largest_first(items, weight, window)
+        num_items = 0
+        for item in items:
+            self.put(item)
+            num_items += 1
+        self.num_items += num_items
+        return num_items
+
+    def finish(self):
+        # One Sentinel per worker, whether or not it is still alive: any worker may take any Sentinel,
+        #     so skipping the ones that already exited leaves others waiting forever
+        for worker in self.workers:
+            try:
+                self.put(Sentinel())
+            except RuntimeError:
+                break # Every worker has exited; nobody is left to stop
+        for worker in self.workers:
+            worker.join()
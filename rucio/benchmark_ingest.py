@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+
+# Counts catalog and storage calls per file made by InPlaceIngestClient.ingest
+# The Rucio client and the storage protocol are mocks, so this runs anywhere the
+#     rucio client and gfal2 packages import, without a server or storage behind them.
+
+
+import argparse
+import logging
+import time
+from collections import Counter
+from unittest import mock
+
+import ndrseipi
+
+logging.basicConfig(format='%(asctime)-15s %(name)s %(levelname)s %(message)s', level=logging.WARNING)
+logger = logging.getLogger('benchmark_ingest')
+
+RSE = 'MOCK_NONDET_RSE'
+
+
+def make_items(num_files, dataset=None, prefix='root://mock.example.org:1094//data/bench'):
+    # Items as get_files yields them: size and checksums already known
+    items = [{
+        'name': f'file{i:07d}',
+        'path': f'{prefix}/file{i:07d}',
+        'pfn': f'{prefix}/file{i:07d}',
+        'rse': RSE,
+        'register_after_upload': True,
+        'bytes': 1024,
+        'adler32': '0badcafe',
+        'md5': 'd41d8cd98f00b204e9800998ecf8427e',
+    } for i in range(num_files)]
+    if dataset:
+        for item in items:
+            item['dataset_scope'], item['dataset_name'] = dataset.split(':', 1)
+    return items
+
+
+def make_client():
+    client = mock.MagicMock(name='Client')
+    client.vo = 'def'
+    client.account = 'bench'
+    client.list_rses.return_value = [{'rse': RSE}]
+    client.list_rse_attributes.return_value = {'site': 'MOCK'}
+    client.get_did.side_effect = ndrseipi.DataIdentifierNotFound()
+    client.get_metadata_bulk.return_value = []
+    return client
+
+
+def make_rsemgr(exists_latency):
+    rsemgr = mock.MagicMock(name='rsemgr')
+    rsemgr.get_rse_info.return_value = {
+        'rse': RSE, 'availability_write': 1, 'deterministic': False, 'domain': ['wan'], 'protocols': [],
+    }
+    protocol = rsemgr.create_protocol.return_value
+
+    # In-place files are already at their PFN, so every check finds them
+    def exists(pfn):
+        if pfn is not None:
+            time.sleep(exists_latency)
+        return True
+    protocol.exists.side_effect = exists
+    return rsemgr
+
+
+def count_calls(mock_object):
+    # Top-level method name -> number of calls (calls on returned objects are counted with those objects)
+    return Counter(name.split('.')[0] for name, _, _ in mock_object.mock_calls if name and '()' not in name)
+
+
+def run(num_files, exists_latency, exists_concurrency, dataset=None):
+    client = make_client()
+    rsemgr = make_rsemgr(exists_latency)
+    with mock.patch.object(ndrseipi, 'rsemgr', rsemgr):
+        ingest_client = ndrseipi.InPlaceIngestClient(client, logger=lambda level, msg: None, tracing=False,
+                                                     exists_concurrency=exists_concurrency)
+        client.reset_mock()
+        start = time.time()
+        ingest_client.ingest(make_items(num_files, dataset))
+        elapsed = time.time() - start
+
+    protocol = rsemgr.create_protocol.return_value
+    print(f'{num_files} files in {elapsed:.2f}s ({num_files / elapsed:.0f} files/s), '
+          f'exists latency {exists_latency * 1000:.0f}ms, {exists_concurrency} concurrent checks')
+    print('Catalog calls per file:')
+    for name, n in sorted(count_calls(client).items()):
+        print(f'    {name:<30} {n / num_files:8.3f}')
+    print('Storage calls per file:')
+    for name, n in sorted(count_calls(rsemgr).items()):
+        print(f'    rsemgr.{name:<23} {n / num_files:8.3f}')
+    for name, n in sorted(count_calls(protocol).items()):
+        print(f'    protocol.{name:<21} {n / num_files:8.3f}')
+
+
+def get_program_arguments():
+    parser = argparse.ArgumentParser(description='Count the calls InPlaceIngestClient makes per file against a mocked Rucio and storage')
+    parser.add_argument('--num-files', type=int, default=1000, help='Files to ingest. Default: 1000')
+    parser.add_argument('--exists-latency-ms', type=float, default=5, help='Simulated storage round trip per existence check. Default: 5')
+    parser.add_argument('--dataset', type=str, default=None, help='scope:name of a dataset to attach the files to. Default: none')
+    parser.add_argument('--exists-concurrency', type=int, default=8, help='Concurrent existence checks. Default: 8')
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = get_program_arguments()
+    run(args.num_files, args.exists_latency_ms / 1000, args.exists_concurrency, args.dataset)
+
+
+if __name__ == '__main__':
+    main()
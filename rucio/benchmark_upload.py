@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+# Measures RucioUploader throughput against a fake RSE
+# The RSE is a local directory the upload client copies into, and the catalog is a mock that
+#     sleeps for a simulated round trip per call, so this runs without a server or storage behind it.
+
+
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter
+from unittest import mock
+
+import rbu
+from checksums import checksum_file
+
+logging.getLogger().setLevel(logging.WARNING)
+logger = logging.getLogger('benchmark_upload')
+
+
+class FakeCatalog:
+    # Stands in for the Rucio client: every call costs one simulated round trip and is counted
+    def __init__(self, latency):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.contents = set()
+
+    def call(self, name):
+        time.sleep(self.latency)
+        with self.lock:
+            self.calls[name] += 1
+
+    def add_dataset(self, scope, name, rse=None):
+        self.call('add_dataset')
+
+    def add_replicas(self, rse, files):
+        self.call('add_replicas')
+
+    def add_replication_rule(self, dids, copies, rse_expression):
+        self.call('add_replication_rule')
+
+    def add_files_to_datasets(self, attachments, ignore_duplicate=False):
+        self.call('add_files_to_datasets')
+        with self.lock:
+            for attachment in attachments:
+                self.contents.update((did['scope'], did['name']) for did in attachment['dids'])
+
+
+class FakeUploadClient:
+    # Copies each file into the RSE directory, paying the catalog round trips of a real upload
+    #     (existence check, replica registration unless no_register); fails at fail_rate to exercise the retries.
+    #     Like UploadClient, it checksums every file and can write them to a summary file.
+    def __init__(self, catalog, rse_dir, fail_rate):
+        self.catalog = catalog
+        self.rse_dir = rse_dir
+        self.fail_rate = fail_rate
+
+    def upload(self, items, summary_file_path=None, traces_copy_out=None):
+        summary = {}
+        for item in items:
+            info = checksum_file(item['path'])
+            if not item.get('no_register'):
+                self.catalog.call('get_did')
+            if random.random() < self.fail_rate:
+                raise RuntimeError(f'simulated failure uploading {item["path"]}')
+            shutil.copyfile(item['path'], os.path.join(self.rse_dir, item['did_name']))
+            if not item.get('no_register'):
+                self.catalog.call('add_replicas')
+            summary[f'{item["did_scope"]}:{item["did_name"]}'] = dict(info, scope=item['did_scope'], name=item['did_name'])
+        if summary_file_path:
+            with open(summary_file_path, 'w') as f:
+                json.dump(summary, f)
+        return 0
+
+
+def make_files(directory, num_files, file_size):
+    data = os.urandom(file_size)
+    paths = []
+    for i in range(num_files):
+        path = os.path.join(directory, f'file{i:07d}')
+        with open(path, 'wb') as f:
+            f.write(data)
+        paths.append(path)
+    return paths
+
+
+def run(num_files, file_size, num_threads, attach_batch_size, catalog_latency, fail_rate, manifest=None, source_dir=None):
+    catalog = FakeCatalog(catalog_latency)
+    args = argparse.Namespace(just_say=False, rucio_account='bench', scope='user.bench', dataset_name='bench',
+                              rse='FAKE_RSE', register_after_upload=True, attach_batch_size=attach_batch_size,
+                              max_retries=5, retry_backoff=0.01, manifest=manifest)
+    with tempfile.TemporaryDirectory() as temp_dir, tempfile.TemporaryDirectory() as rse_dir:
+        # With a manifest, keep the source files in source_dir so a second run can resume over the same paths
+        source_dir = source_dir or temp_dir
+        os.makedirs(source_dir, exist_ok=True)
+        paths = [os.path.join(source_dir, name) for name in sorted(os.listdir(source_dir))] or \
+                make_files(source_dir, num_files, file_size)
+        num_files = len(paths)
+        total = sum(os.path.getsize(path) for path in paths)
+        with mock.patch.object(rbu, 'RucioClient', lambda account=None: catalog), \
+                mock.patch.object(rbu, 'RucioUploadClient', lambda _client=None, logger=None: FakeUploadClient(catalog, rse_dir, fail_rate)):
+            uploader = rbu.RucioUploader(args)
+            start = time.time()
+            uploader.upload(iter(paths), num_threads)
+            elapsed = time.time() - start
+        stored = len(os.listdir(rse_dir))
+
+    print(f'{num_files} files, {total / 1e6:.1f} MB in {elapsed:.2f}s: {total / elapsed / 1e6:.1f} MB/s, '
+          f'{num_files / elapsed:.0f} files/s, {num_threads} threads, catalog latency {catalog_latency * 1000:.0f}ms')
+    print(f'Stored {stored}, attached {len(catalog.contents)}, uploads failed {uploader.stats.files[False]}, '
+          f'attachments failed {len(uploader.attacher.failed)}')
+    print('Catalog calls per file:')
+    for name, n in sorted(catalog.calls.items()):
+        print(f'    {name:<30} {n / num_files:8.3f}')
+    if uploader.manifest is not None:
+        print('Manifest:', uploader.manifest.summary())
+        uploader.manifest.close()
+
+
+def get_program_arguments():
+    parser = argparse.ArgumentParser(description='Measure RucioUploader throughput against a local-directory RSE and a mocked catalog')
+    parser.add_argument('--num-files', type=int, default=500, help='Files to upload. Default: 500')
+    parser.add_argument('--file-size', type=int, default=1024 * 1024, help='Size of each file in bytes. Default: 1048576')
+    parser.add_argument('--num-threads', type=int, default=8, help='Upload threads. Default: 8')
+    parser.add_argument('--attach-batch-size', type=int, default=500, help='Files attached to the dataset per call. Default: 500')
+    parser.add_argument('--catalog-latency-ms', type=float, default=10, help='Simulated round trip per catalog call. Default: 10')
+    parser.add_argument('--manifest', type=str, default=None, help='Upload manifest to record to and resume from. Default: none')
+    parser.add_argument('--source-dir', type=str, default=None, help='Directory of files to upload, created on the first run. Default: a temporary directory')
+    parser.add_argument('--fail-rate', type=float, default=0.0, help='Fraction of upload attempts that fail and are retried. Default: 0')
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = get_program_arguments()
+    run(args.num_files, args.file_size, args.num_threads, args.attach_batch_size, args.catalog_latency_ms / 1000, args.fail_rate,
+        args.manifest, args.source_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+# Per-process, per-thread Rucio clients for tools with many workers
+# A Rucio client holds a requests session whose keep-alive connections must not be used from two
+#     processes (after a fork) or two threads at once, so every worker thread builds its own clients.
+# The auth token is shared instead: prime() authenticates once in the parent, which writes the token to
+#     the Rucio client's token cache, and workers pick it up from there when they build their clients.
+#     Client construction is serialized across processes with a file lock, so a missing or expired token
+#     is fetched by the first worker only and the rest read it from the cache, instead of every worker
+#     asking the auth server at once.
+# The factory reaches worker processes by being inherited through fork (it holds a threading.local, which
+#     cannot be pickled), so WorkScheduler(processes=True) always uses the fork start method.
+
+import fcntl
+import logging
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from rucio.client import Client as RucioClient
+
+logger = logging.getLogger('clientfactory')
+
+
+class ClientFactory:
+    """
+    Hands out Rucio clients owned by the calling process and thread.
+
+    factory = ClientFactory()
+    factory.prime()                       # In the parent, before the workers start
+    R = factory.get(ReplicaClient)        # In a worker, after the fork
+    """
+    def __init__(self, lock_path=None, **client_args):
+        self.client_args = client_args
+        self.lock_path = lock_path or os.path.join(tempfile.gettempdir(), f'rucio_client_{os.getuid()}.lock')
+        self.local = threading.local()
+
+    @contextmanager
+    def locked(self):
+        with open(self.lock_path, 'a') as lock_f:
+            fcntl.flock(lock_f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_f, fcntl.LOCK_UN)
+
+    def prime(self):
+        # Authenticate once so the token is in the cache before any worker needs it
+        with self.locked():
+            RucioClient(**self.client_args)
+
+    def get(self, client_type=RucioClient):
+        # Clients inherited through a fork belong to the parent and are never reused
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.pid = os.getpid()
+            self.local.clients = {}
+        client = self.local.clients.get(client_type)
+        if client is None:
+            with self.locked():
+                client = client_type(**self.client_args)
+            self.local.clients[client_type] = client
+            logger.debug(f'(pid:{os.getpid()}) Created {client_type.__name__} for {threading.current_thread().name}')
+        return client
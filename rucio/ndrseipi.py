@@ -5,26 +5,52 @@
 
 import argparse
 import copy
+import errno
+import fnmatch
 import json
 import logging
+import os
+import queue
+import stat
+import sys
+import threading
 import time
 import random
+from collections import defaultdict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 import gfal2
 from rucio.client import Client as RucioClient
 from rucio.client.uploadclient import UploadClient
-from rucio.common.exception import (DataIdentifierNotFound, RSEWriteBlocked, InputValidationError, NoFilesUploaded)
+from rucio.common.exception import (DataIdentifierAlreadyExists, DataIdentifierNotFound, RSEWriteBlocked, InputValidationError, NoFilesUploaded)
 from rucio.rse import rsemanager as rsemgr
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'general'))
+from scheduler import chunked
+
 logging.basicConfig(format='%(asctime)-15s %(name)s %(levelname)s %(message)s', level=logging.INFO)
 logger = logging.getLogger('ndrseipi')
 
+CHECKSUM_TYPES = ('adler32', 'md5')
+REGISTER_CHUNK_SIZE = 1000
+ATTACH_CHUNK_SIZE = 1000
+TRACE_CONCURRENCY = 8
+PREFETCH_BATCHES = 4 # Scanned batches waiting for registration; bounds memory on huge trees
+
+RSEContext = namedtuple('RSEContext', ['settings', 'attributes', 'domain'])
+
 
 class InPlaceIngestClient(UploadClient):
-    def __init__(self, _client=None, logger=None, tracing=True, ctxt=None, target_dir=None):
+    def __init__(self, _client=None, logger=None, tracing=True, ctxt=None, target_dir=None, exists_concurrency=8):
         super().__init__(_client, logger, tracing)
         self.ctxt = ctxt
         self.target_dir = target_dir
+        self.exists_concurrency = exists_concurrency
+        self.rse_contexts = {}
+        self.local = threading.local()
+        self.open_protocols = []
+        self.protocols_lock = threading.Lock()
 
 
     def _upload_item(self, rse_settings, rse_attributes, lfn,
@@ -35,6 +61,208 @@ class InPlaceIngestClient(UploadClient):
         pfn = force_pfn
         return pfn
 
+    def _rse_context(self, rse, ignore_availability=False):
+        """
+        Settings, attributes and upload domain of an RSE, looked up once per client
+        rather than once per file
+        """
+        context = self.rse_contexts.get(rse)
+        if context is not None:
+            return context
+        logger = self.logger
+        if not self.rses.get(rse):
+            self.rses[rse] = rsemgr.get_rse_info(rse, vo=self.client.vo)
+        rse_settings = self.rses[rse]
+        if not ignore_availability and rse_settings['availability_write'] != 1:
+            raise RSEWriteBlocked('%s is not available for writing. No actions have been taken' % rse)
+
+        # resolving local area networks
+        domain = 'wan'
+        rse_attributes = {}
+        try:
+            rse_attributes = self.client.list_rse_attributes(rse)
+        except:
+            logger(logging.WARNING, 'Attributes of the RSE: %s not available.' % rse)
+        if (self.client_location and 'lan' in rse_settings['domain'] and 'site' in rse_attributes):
+            if self.client_location['site'] == rse_attributes['site']:
+                domain = 'lan'
+        logger(logging.DEBUG, '{} domain is used for the upload'.format(domain))
+
+        context = RSEContext(rse_settings, rse_attributes, domain)
+        self.rse_contexts[rse] = context
+        return context
+
+    def _protocol(self, rse, scheme, impl):
+        """
+        A connected protocol for existence checks, one per RSE/scheme/impl and thread,
+        kept open for the whole ingest instead of being set up and torn down per file
+        """
+        protocols = getattr(self.local, 'protocols', None)
+        if protocols is None:
+            protocols = self.local.protocols = {}
+        key = (rse, scheme, impl)
+        protocol = protocols.get(key)
+        if protocol is None:
+            context = self.rse_contexts[rse]
+            # Same choice as rsemgr.exists: read protocol, or write if it can't check existence
+            protocol = rsemgr.create_protocol(context.settings, 'read', scheme=scheme, impl=impl, domain=context.domain,
+                                              auth_token=self.auth_token, logger=self.logger)
+            protocol.connect()
+            try:
+                protocol.exists(None)
+            except NotImplementedError:
+                protocol = rsemgr.create_protocol(context.settings, 'write', scheme=scheme, impl=impl, domain=context.domain,
+                                                  auth_token=self.auth_token, logger=self.logger)
+                protocol.connect()
+            except:
+                pass
+            protocols[key] = protocol
+            with self.protocols_lock:
+                self.open_protocols.append(protocol)
+        return protocol
+
+    def _exists(self, file, target):
+        # target is the file's PFN or its DID
+        protocol = self._protocol(file['rse'], file.get('force_scheme'), file.get('impl'))
+        if isinstance(target, str):
+            return protocol.exists(target)
+        pfn = list(protocol.lfns2pfns(target).values())[0]
+        if isinstance(pfn, Exception):
+            raise pfn
+        return protocol.exists(pfn)
+
+    def _check_existence(self, file, no_register, register_after_upload):
+        """
+        Existence checks for one file, the same ones (and in the same order) as the ingest loop used to make inline
+
+        :returns: (exists at the PFN or DID checked first, exists under its DID) with None for checks not needed
+        """
+        pfn = file.get('pfn')
+        file_did = {'scope': file['did_scope'], 'name': file['did_name']}
+        is_deterministic = self.rses[file['rse']].get('deterministic', True)
+        if not register_after_upload and not is_deterministic and not no_register:
+            if self._exists(file, pfn):
+                return True, None
+            return False, self._exists(file, file_did)
+        return self._exists(file, pfn if pfn else file_did), None
+
+    def _registered_dids(self, files):
+        # {(scope, name)} of the files whose DID exists, REGISTER_CHUNK_SIZE DIDs per metadata lookup
+        registered = set()
+        for chunk in chunked(files, REGISTER_CHUNK_SIZE):
+            dids = [{'scope': file['did_scope'], 'name': file['did_name']} for file in chunk]
+            try:
+                registered.update((meta['scope'], meta['name']) for meta in self.client.get_metadata_bulk(dids))
+            except DataIdentifierNotFound:
+                pass # None of the chunk is registered
+        return registered
+
+    def _close_protocols(self):
+        with self.protocols_lock:
+            for protocol in self.open_protocols:
+                try:
+                    protocol.close()
+                except Exception:
+                    pass
+            self.open_protocols = []
+        self.local = threading.local()
+
+    def _register_datasets(self, files, registered_dataset_dids):
+        # What _register_file does for a file's dataset, once per dataset
+        logger = self.logger
+        for file in files:
+            dataset_did_str = file.get('dataset_did_str')
+            if not file.get('dataset_scope') or dataset_did_str in registered_dataset_dids:
+                continue
+            registered_dataset_dids.add(dataset_did_str)
+            try:
+                self.client.add_dataset(scope=file['dataset_scope'], name=file['dataset_name'], meta=file.get('dataset_meta'),
+                                        rules=[{'account': self.client.account, 'copies': 1, 'rse_expression': file['rse'],
+                                                'grouping': 'DATASET', 'lifetime': file.get('lifetime')}])
+                logger(logging.INFO, 'Successfully created dataset %s' % dataset_did_str)
+            except DataIdentifierAlreadyExists:
+                logger(logging.INFO, 'Dataset %s already exists - no rule will be created' % dataset_did_str)
+
+    def _register_chunk(self, rse, chunk, ignore_availability=False, activity=None):
+        """
+        Registers files on one RSE with a handful of calls: one metadata lookup, one add_replicas,
+        and one replication rule call per lifetime for new files that have no dataset.
+        Raises on any problem, leaving the caller to retry the files one by one.
+        """
+        dids = [{'scope': file['did_scope'], 'name': file['did_name']} for file in chunk]
+        existing = {(meta['scope'], meta['name']): meta for meta in self.client.get_metadata_bulk(dids)}
+        for file in chunk:
+            meta = existing.get((file['did_scope'], file['did_name']))
+            if meta is not None and (meta['adler32'] != file['adler32'] or meta['bytes'] != file['bytes']):
+                raise DataIdentifierAlreadyExists('%s:%s already exists with different metadata' % (file['did_scope'], file['did_name']))
+        self.client.add_replicas(rse=rse, files=[self._convert_file_for_api(file) for file in chunk])
+
+        # Like _register_file: only new files without a dataset get a rule of their own
+        rules = defaultdict(list)
+        for file, did in zip(chunk, dids):
+            if (did['scope'], did['name']) not in existing and not file.get('dataset_did_str'):
+                rules[file.get('lifetime')].append(did)
+        for lifetime, rule_dids in rules.items():
+            self.client.add_replication_rule(rule_dids, copies=1, rse_expression=rse, lifetime=lifetime,
+                                             ignore_availability=ignore_availability, activity=activity)
+
+    def _register_files_bulk(self, files, registered_dataset_dids, ignore_availability=False, activity=None):
+        """
+        Registers files in chunks of REGISTER_CHUNK_SIZE, falling back to _register_file
+        for each file of a chunk that fails
+
+        :returns: the files that were registered
+        """
+        logger = self.logger
+        self._register_datasets(files, registered_dataset_dids)
+        by_rse = defaultdict(list)
+        for file in files:
+            by_rse[file['rse']].append(file)
+        registered = []
+        for rse, rse_files in by_rse.items():
+            for chunk in chunked(rse_files, REGISTER_CHUNK_SIZE):
+                try:
+                    self._register_chunk(rse, chunk, ignore_availability=ignore_availability, activity=activity)
+                    registered.extend(chunk)
+                    continue
+                except Exception as error:
+                    logger(logging.WARNING, f'Bulk registration of {len(chunk)} files on {rse} failed, registering them one by one: {error}')
+                for file in chunk:
+                    try:
+                        self._register_file(file, registered_dataset_dids, ignore_availability=ignore_availability, activity=activity)
+                        registered.append(file)
+                    except Exception as error:
+                        logger(logging.ERROR, f'Failed to register {file["did_scope"]}:{file["did_name"]}: {error}')
+        return registered
+
+    def _attach_files_bulk(self, files):
+        # Attaches files to their datasets ATTACH_CHUNK_SIZE at a time, one by one only for chunks that fail
+        logger = self.logger
+        by_dataset = defaultdict(list)
+        for file in files:
+            by_dataset[(file['dataset_scope'], file['dataset_name'])].append({'scope': file['did_scope'], 'name': file['did_name']})
+        for (dataset_scope, dataset_name), dids in by_dataset.items():
+            for chunk in chunked(dids, ATTACH_CHUNK_SIZE):
+                try:
+                    self.client.attach_dids_to_dids([{'scope': dataset_scope, 'name': dataset_name, 'dids': chunk}], ignore_duplicate=True)
+                    continue
+                except Exception as error:
+                    logger(logging.WARNING, f'Bulk attachment of {len(chunk)} files to {dataset_scope}:{dataset_name} failed, attaching them one by one')
+                    logger(logging.DEBUG, 'Attaching to dataset {}'.format(str(error)))
+                for file_did in chunk:
+                    try:
+                        self.client.attach_dids(dataset_scope, dataset_name, [file_did])
+                    except Exception as error:
+                        logger(logging.WARNING, 'Failed to attach file to the dataset')
+                        logger(logging.DEBUG, 'Attaching to dataset {}'.format(str(error)))
+
+    def _send_traces(self, traces):
+        # The trace endpoint takes one trace per request; send a batch of them side by side
+        if not traces:
+            return
+        with ThreadPoolExecutor(max_workers=TRACE_CONCURRENCY) as executor:
+            list(executor.map(self._send_trace, traces))
+
     def ingest(self, items, summary_file_path=None, traces_copy_out=None, ignore_availability=False, activity=None):
 
         def _pick_random_rse(rse_expression):
@@ -45,19 +273,17 @@ class InPlaceIngestClient(UploadClient):
         logger = self.logger
         files = self._collect_and_validate_file_info(items)
         # self._register_file()
-        print(files)
+        logger(logging.DEBUG, f'Ingesting {len(files)} files')
 
         registered_dataset_dids = set()
         registered_file_dids = set()
         rse_expression = None
         for file in files:
             rse_expression = file['rse']
-            rse = self.rse_expressions.setdefault(rse_expression, _pick_random_rse(rse_expression))
-
-            if not self.rses.get(rse):
-                rse_settings = self.rses.setdefault(rse, rsemgr.get_rse_info(rse, vo=self.client.vo))
-                if not ignore_availability and rse_settings['availability_write'] != 1:
-                    raise RSEWriteBlocked('%s is not available for writing. No actions have been taken' % rse)
+            if rse_expression not in self.rse_expressions:
+                self.rse_expressions[rse_expression] = _pick_random_rse(rse_expression)
+            rse = self.rse_expressions[rse_expression]
+            self._rse_context(rse, ignore_availability)
 
             dataset_scope = file.get('dataset_scope')
             dataset_name = file.get('dataset_name')
@@ -73,22 +299,40 @@ class InPlaceIngestClient(UploadClient):
             raise InputValidationError('DIDs used to address both files and datasets: %s' % str(wrong_dids))
         logger(logging.DEBUG, 'Input validation done.')
 
+        # Check which files already exist on storage, several at a time, before walking through them
+        to_check = {}
+        for i, file in enumerate(files):
+            is_deterministic = self.rses[file['rse']].get('deterministic', True)
+            if not is_deterministic and not file.get('pfn'):
+                continue # Rejected in the loop below
+            register_after_upload = file.get('register_after_upload') and not file.get('no_register')
+            no_register = file.get('no_register') or (file.get('pfn') and is_deterministic)
+            to_check[i] = (file, no_register, register_after_upload)
+        try:
+            with ThreadPoolExecutor(max_workers=self.exists_concurrency) as executor:
+                existence = dict(zip(to_check, executor.map(lambda args: self._check_existence(*args), to_check.values())))
+        finally:
+            self._close_protocols()
+        # Files to be registered after upload that are already on storage need their DID looked up;
+        #     in place they all are, so look them up in bulk rather than with a get_did each
+        registered_after_upload = self._registered_dids([file for i, (file, _, register_after_upload) in to_check.items()
+                                                         if register_after_upload and existence[i][0]])
+
         registered_dataset_dids = set()
         num_succeeded = 0
         num_already_exists = 0
         summary = []
-        for file in files:
+        to_register = [] # (file, trace) for every file to register once the loop is done
+        for i, file in enumerate(files):
             basename = file['basename']
             logger(logging.INFO, 'Preparing ingest for file %s' % basename)
 
             no_register = file.get('no_register')
             register_after_upload = file.get('register_after_upload') and not no_register
             pfn = file.get('pfn')
-            force_scheme = file.get('force_scheme')
-            impl = file.get('impl')
             delete_existing = False
 
-            trace = copy.deepcopy(self.trace)
+            trace = dict(self.trace) # The trace template is flat; a shallow copy is enough
             # appending trace to list reference, if the reference exists
             if traces_copy_out is not None:
                 traces_copy_out.append(trace)
@@ -100,9 +344,9 @@ class InPlaceIngestClient(UploadClient):
             trace['remoteSite'] = rse
             trace['filesize'] = file['bytes']
 
-            file_did = {'scope': file['did_scope'], 'name': file['did_name']}
             dataset_did_str = file.get('dataset_did_str')
-            rse_settings = self.rses[rse]
+            rse_context = self.rse_contexts[rse]
+            rse_settings = rse_context.settings
             rse_sign_service = rse_settings.get('sign_url', None)
             is_deterministic = rse_settings.get('deterministic', True)
 
@@ -114,46 +358,33 @@ class InPlaceIngestClient(UploadClient):
                 logger(logging.WARNING, 'Upload with given pfn implies that no_register is True, except non-deterministic RSEs')
                 no_register = True
 
-            # resolving local area networks
-            domain = 'wan'
-            rse_attributes = {}
-            try:
-                rse_attributes = self.client.list_rse_attributes(rse)
-            except:
-                logger(logging.WARNING, 'Attributes of the RSE: %s not available.' % rse)
-            if (self.client_location and 'lan' in rse_settings['domain'] and 'site' in rse_attributes):
-                if self.client_location['site'] == rse_attributes['site']:
-                    domain = 'lan'
-            logger(logging.DEBUG, '{} domain is used for the upload'.format(domain))
-
             if not no_register and not register_after_upload:
                 self._register_file(file, registered_dataset_dids, ignore_availability=ignore_availability, activity=activity)
 
             # if register_after_upload, file should be overwritten if it is not registered
             # otherwise if file already exists on RSE we're done
+            exists, exists_by_did = existence[i]
             if register_after_upload:
-                if rsemgr.exists(rse_settings, pfn if pfn else file_did, domain=domain, scheme=force_scheme, impl=impl, auth_token=self.auth_token, vo=self.client.vo, logger=logger):
-                    try:
-                        self.client.get_did(file['did_scope'], file['did_name'])
+                if exists:
+                    if (file['did_scope'], file['did_name']) in registered_after_upload:
                         logger(logging.INFO, 'File already registered. Skipping upload.')
                         trace['stateReason'] = 'File already exists'
                         continue
-                    except DataIdentifierNotFound:
-                        logger(logging.INFO, 'File already exists on RSE. Previous left overs will be overwritten.')
-                        delete_existing = True
+                    logger(logging.INFO, 'File already exists on RSE. Previous left overs will be overwritten.')
+                    delete_existing = True
             elif not is_deterministic and not no_register:
-                if rsemgr.exists(rse_settings, pfn, domain=domain, scheme=force_scheme, impl=impl, auth_token=self.auth_token, vo=self.client.vo, logger=logger):
+                if exists:
                     logger(logging.INFO, 'File already exists on RSE with given pfn. Skipping upload. Existing replica has to be removed first.')
                     trace['stateReason'] = 'File already exists'
                     num_already_exists += 1
                     continue
-                elif rsemgr.exists(rse_settings, file_did, domain=domain, scheme=force_scheme, impl=impl, auth_token=self.auth_token, vo=self.client.vo, logger=logger):
+                elif exists_by_did:
                     logger(logging.INFO, 'File already exists on RSE with different pfn. Skipping upload.')
                     trace['stateReason'] = 'File already exists'
                     num_already_exists += 1
                     continue
             else:
-                if rsemgr.exists(rse_settings, pfn if pfn else file_did, domain=domain, scheme=force_scheme, impl=impl, auth_token=self.auth_token, vo=self.client.vo, logger=logger):
+                if exists:
                     logger(logging.INFO, 'File already exists on RSE. Skipping upload')
                     trace['stateReason'] = 'File already exists'
                     num_already_exists += 1
@@ -164,15 +395,14 @@ class InPlaceIngestClient(UploadClient):
             trace['clientState'] = 'DONE'
             file['state'] = 'A'
             logger(logging.INFO, 'Successfully ingested file %s' % basename)
-            self._send_trace(trace)
-
-            self._register_file(file, registered_dataset_dids, ignore_availability=ignore_availability, activity=activity)
-            if dataset_did_str:
-                try:
-                    self.client.attach_dids(file['dataset_scope'], file['dataset_name'], [file_did])
-                except Exception as error:
-                    logger(logging.WARNING, 'Failed to attach file to the dataset')
-                    logger(logging.DEBUG, 'Attaching to dataset {}'.format(str(error)))
+            to_register.append((file, trace))
+
+        # Register, attach and trace everything that made it through, in bulk
+        registered = self._register_files_bulk([file for file, _ in to_register], registered_dataset_dids,
+                                               ignore_availability=ignore_availability, activity=activity)
+        self._attach_files_bulk([file for file in registered if file.get('dataset_did_str')])
+        registered_ids = set(id(file) for file in registered)
+        self._send_traces([trace for file, trace in to_register if id(file) in registered_ids])
         
         if num_succeeded == 0:
             if num_already_exists > 0:
@@ -197,24 +427,26 @@ class InPlaceIngestClient(UploadClient):
         new_item['dirname'] = filepath
         new_item['basename'] = filepath.split('/')[-1]
 
-        file_stats = self.ctxt.lstat(filepath)
-
-        new_item['bytes'] = file_stats.st_size
+        # Items from MetadataScanner already carry size and checksums; only go back to the storage for the rest
+        if 'bytes' not in item:
+            file_stats = self.ctxt.lstat(filepath)
+            new_item['bytes'] = file_stats.st_size
 
-        try:
-            adler32 = self.ctxt.checksum(filepath, 'adler32')
-            new_item['adler32'] = adler32
-        except Exception as e:
-            logger.error(f'cannot get adler32 checksum for {filepath}')
-            raise
-
-        try:
-            md5 = self.ctxt.checksum(filepath, 'md5')
-        except Exception as e:
-            logger.error(f'could not get md5 checksum for {filepath}')
-            raise
+        if 'adler32' not in item:
+            try:
+                adler32 = self.ctxt.checksum(filepath, 'adler32')
+                new_item['adler32'] = adler32
+            except Exception as e:
+                logger.error(f'cannot get adler32 checksum for {filepath}')
+                raise
 
-        new_item['md5'] = md5
+        if 'md5' not in item:
+            try:
+                md5 = self.ctxt.checksum(filepath, 'md5')
+            except Exception as e:
+                logger.error(f'could not get md5 checksum for {filepath}')
+                raise
+            new_item['md5'] = md5
         new_item['meta'] = {'guid': self._get_file_guid(new_item)}
         new_item['state'] = 'C'
         if not new_item.get('did_scope'):
@@ -263,63 +495,226 @@ class InPlaceIngestClient(UploadClient):
         return files
 
 
-def get_files(ctxt, directory: str, rse: str) -> list:
-    files = ctxt.listdir(directory)
+class MetadataScanner:
+    """
+    Stats and checksums files on the storage several at a time, over a pool of gfal2 contexts.
+
+    Every file is lstat'ed once and each checksum is computed once; the storage does the
+    checksumming, so the threads mostly wait on round trips (gfal2 releases the GIL meanwhile).
+    """
+    def __init__(self, concurrency=16, checksum_types=CHECKSUM_TYPES, context_factory=None):
+        self.concurrency = concurrency
+        self.checksum_types = checksum_types
+        self.context_factory = context_factory or gfal2.creat_context
+        self.contexts = queue.Queue()
+        for _ in range(concurrency):
+            self.contexts.put(self.context_factory())
+        self.failed = 0
+
+    @contextmanager
+    def context(self):
+        ctxt = self.contexts.get()
+        try:
+            yield ctxt
+        finally:
+            self.contexts.put(ctxt)
 
-    items = []
-    for f in files:
-        name = f
-        pfn = f'{directory}/{f}'
-        f_stat = ctxt.lstat(pfn)
-        size = f_stat.st_size
-        adler32 = ctxt.checksum(pfn, 'adler32')
+    def stat(self, pfn, f_stat=None):
+        """
+        :param f_stat: the file's stat if the listing already returned it, saving the lstat
 
+        :returns: {'bytes': ..., '<checksum type>': ...} for a regular file, None for anything else
+        """
+        with self.context() as ctxt:
+            if f_stat is None:
+                f_stat = ctxt.lstat(pfn)
+            if not stat.S_ISREG(f_stat.st_mode):
+                return None
+            info = {'bytes': f_stat.st_size}
+            for checksum_type in self.checksum_types:
+                info[checksum_type] = ctxt.checksum(pfn, checksum_type)
+        return info
+
+    def _stat_or_log(self, pfn, f_stat=None):
+        try:
+            return self.stat(pfn, f_stat)
+        except Exception as error:
+            logger.error(f'cannot stat or checksum {pfn}: {error}')
+            self.failed += 1
+            return None
+
+    def scan(self, pfns):
+        """
+        Yields (pfn, info) for each regular file among pfns, in input order.
+
+        At most a few times `concurrency` files are in flight, so pfns can be a long generator.
+        """
+        return self.scan_entries((pfn, None) for pfn in pfns)
+
+    def scan_entries(self, entries):
+        # Like scan, for (pfn, stat or None) pairs such as walk_files yields
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            in_flight = deque()
+            for pfn, f_stat in entries:
+                in_flight.append((pfn, executor.submit(self._stat_or_log, pfn, f_stat)))
+                if len(in_flight) >= self.concurrency * 4:
+                    pfn, future = in_flight.popleft()
+                    info = future.result()
+                    if info is not None:
+                        yield pfn, info
+            while in_flight:
+                pfn, future = in_flight.popleft()
+                info = future.result()
+                if info is not None:
+                    yield pfn, info
+
+
+def matches(relative_path, patterns):
+    # Patterns with a slash match the path below the top directory, others just the name, as in rsync
+    name = relative_path.rsplit('/', 1)[-1]
+    return any(fnmatch.fnmatchcase(relative_path if '/' in pattern else name, pattern) for pattern in patterns)
+
+
+def list_entries(ctxt, directory):
+    # Yields (name, stat) for a directory, with the stats from the listing itself where the protocol
+    #     supports it (readpp), otherwise one lstat per entry
+    try:
+        handle = ctxt.opendir(directory)
+        dirent, f_stat = handle.readpp()
+    except gfal2.GError as error:
+        if error.code != errno.ENOTSUP:
+            raise
+        for name in ctxt.listdir(directory):
+            yield name, ctxt.lstat(f'{directory}/{name}')
+        return
+    while dirent is not None:
+        if dirent.d_name not in ('.', '..'):
+            yield dirent.d_name, f_stat
+        dirent, f_stat = handle.readpp()
+
+
+def walk_files(ctxt, top, recursive=True, include=(), exclude=(), on_error=None):
+    """
+    Yields (pfn, stat) for the files below top as they are listed, depth first.
+
+    Only pending directory names are kept in memory. Excluded directories are not descended into;
+    include patterns (if any) select which files are yielded. A directory that cannot be listed
+    is logged, passed to on_error(directory) and skipped; the walk carries on with the rest.
+    """
+    pending = ['']
+    while pending:
+        relative_dir = pending.pop()
+        directory = f'{top}/{relative_dir}' if relative_dir else top
+        subdirectories = []
+        try:
+            for name, f_stat in list_entries(ctxt, directory):
+                relative_path = f'{relative_dir}/{name}' if relative_dir else name
+                if exclude and matches(relative_path, exclude):
+                    continue
+                if stat.S_ISDIR(f_stat.st_mode):
+                    if recursive:
+                        subdirectories.append(relative_path)
+                elif stat.S_ISREG(f_stat.st_mode) and (not include or matches(relative_path, include)):
+                    yield f'{directory}/{name}', f_stat
+        except gfal2.GError as error:
+            logger.error(f'cannot list {directory}: {error}')
+            if on_error is not None:
+                on_error(directory)
+        pending.extend(reversed(subdirectories))
+
+
+def unique_names(entries, top, skipped):
+    # Passes on entries whose file name hasn't been seen yet in this walk; the rest go to skipped(pfn)
+    seen = set()
+    for pfn, f_stat in entries:
+        name = pfn.rsplit('/', 1)[-1]
+        if name in seen:
+            logger.error(f'{pfn[len(top) + 1:]}: another file named {name} was already found, not ingesting it')
+            skipped(pfn)
+            continue
+        seen.add(name)
+        yield pfn, f_stat
+
+
+def get_files(scanner, directory: str, rse: str, recursive=False, include=(), exclude=(), did_names='relative'):
+    """
+    Streams replica items: files are checksummed while the listing carries on.
+    The listing has a context of its own, so it never waits on the checksum pool.
+
+    :param did_names: 'relative' names each DID by its path below directory (so files with the same
+                      name in different subdirectories stay distinct), 'basename' by the file name alone,
+                      rejecting repeated names
+    """
+    def not_scanned(path):
+        scanner.failed += 1
+
+    entries = walk_files(scanner.context_factory(), directory, recursive, include, exclude, on_error=not_scanned)
+    if did_names == 'basename' and recursive:
+        entries = unique_names(entries, directory, not_scanned)
+    for pfn, info in scanner.scan_entries(entries):
+        name = pfn[len(directory) + 1:] if did_names == 'relative' else pfn.split('/')[-1]
         replica = {
             'name': name,
-            'bytes': size,
-            'adler32': adler32,
+            'did_name': name,
             'path': pfn,
             'pfn': pfn,
             'rse': rse,
             'register_after_upload': True
         }
-        items.append(replica)
+        replica.update(info)
+        yield replica
 
-    return items
 
+def prefetch(iterable, depth):
+    # Runs iterable in a background thread, at most depth items ahead of the consumer
+    items = queue.Queue(depth)
+    done = object()
 
-def discover_files(ctxt, rse: str, directory: str, scope: str) -> list:
+    def produce():
+        try:
+            for item in iterable:
+                items.put(item)
+        except BaseException as error:
+            items.put(error)
+        items.put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        item = items.get()
+        if item is done:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+
+def discover_files(scanner, rse: str, directory: str, scope: str) -> list:
     '''Discover files on the server to be ingested
     '''
     # get contents of a directory
-    files = ctxt.listdir(directory)
+    with scanner.context() as ctxt:
+        files = ctxt.listdir(directory)
 
     items = []
     # build pfns
-    for f in files:
-        name = f
-        pfn = f'{directory}/{f}'
-        f_stat = ctxt.lstat(pfn)
-        size = f_stat.st_size
-        adler32 = ctxt.checksum(pfn, 'adler32')
-
+    for pfn, info in scanner.scan(f'{directory}/{f}' for f in files):
         replica = {
-            'name': name,
+            'name': pfn.split('/')[-1],
             'scope': scope,
-            'bytes': size,
-            'adler32': adler32,
             'path': pfn,
             'pfn': pfn,
             'rse': rse,
             'register_after_upload': True
         }
+        replica.update(info)
         items.append(replica)
 
     return items
 
 
-def inplace_ingest(target_dir, rse):
+def inplace_ingest(target_dir, rse, concurrency=16):
     ctxt = gfal2.creat_context()
+    scanner = MetadataScanner(concurrency)
 
     rucio_client = RucioClient()
     inplace_ingest_client = InPlaceIngestClient(rucio_client, logger=logger, ctxt=ctxt)
@@ -331,13 +726,14 @@ def inplace_ingest(target_dir, rse):
     protocol = target_dir.split(":")[0]
     print([p['prefix'] for p in rse_info["protocols"] if p['scheme'] == protocol])
 
-    items = discover_files(ctxt, rse, target_dir, 'user.dylee')
+    items = discover_files(scanner, rse, target_dir, 'user.dylee')
 
     inplace_ingest_client.upload(items)
 
 
-def inplace_ingest2(target_dir, rse):
+def inplace_ingest2(target_dir, rse, concurrency=16, recursive=False, include=(), exclude=(), batch_size=100, did_names='relative'):
     ctxt = gfal2.creat_context()
+    scanner = MetadataScanner(concurrency)
 
     rucio_client = RucioClient()
     inplace_ingest_client = InPlaceIngestClient(rucio_client, logger=logger, ctxt=ctxt, target_dir=target_dir)
@@ -351,15 +747,27 @@ def inplace_ingest2(target_dir, rse):
 
     protocol = target_dir.split(":")[0]
 
-    items = get_files(ctxt, target_dir, rse)
-    inplace_ingest_client.ingest(items)
+    # Listing and checksumming run ahead in a background thread while batches are registered
+    start = time.time()
+    num_files = 0
+    items = get_files(scanner, target_dir, rse, recursive, include, exclude, did_names)
+    for batch in prefetch(chunked(items, batch_size), PREFETCH_BATCHES):
+        try:
+            inplace_ingest_client.ingest(batch)
+        except NoFilesUploaded:
+            logger.warning(f'None of the {len(batch)} files in this batch were ingested')
+        if not num_files:
+            logger.info(f'First batch registered after {time.time() - start:.1f}s')
+        num_files += len(batch)
+        logger.info(f'{num_files} files processed ({num_files / (time.time() - start):.1f} files/s)')
+    logger.info(f'Processed {num_files} files in {time.time() - start:.1f}s ({scanner.failed} files or directories could not be scanned)')
 
 
 def main():
     args = get_program_arguments()
     target_dir = args.file_directory
     rse = args.rse
-    inplace_ingest2(target_dir, rse)
+    inplace_ingest2(target_dir, rse, args.concurrency, args.recursive, args.include, args.exclude, args.batch_size, args.did_names)
 
 
 def get_program_arguments():
@@ -373,6 +781,24 @@ def get_program_arguments():
         'rse',
         help='Rucio Storage Element that the files will be ingested to.'
     )
+    parser.add_argument(
+        '--concurrency', type=int, default=16,
+        help='Files stat\'ed and checksummed at once, each over its own gfal2 context. Default: 16')
+    parser.add_argument(
+        '--recursive', action='store_true',
+        help='Descend into subdirectories of the target directory.')
+    parser.add_argument(
+        '--include', action='append', default=[],
+        help='Only ingest files matching this glob (repeatable). Globs with a / match the path below the target directory, others the file name.')
+    parser.add_argument(
+        '--exclude', action='append', default=[],
+        help='Skip files and directories matching this glob (repeatable), matched like --include.')
+    parser.add_argument(
+        '--did-names', choices=('relative', 'basename'), default='relative',
+        help='Name each DID by its path below the target directory, or by the file name alone (files with a name seen before are then skipped). Default: relative')
+    parser.add_argument(
+        '--batch-size', type=int, default=100,
+        help='Files per ingest call. Default: 100')
 
     args = parser.parse_args()
     return args
@@ -6,22 +6,30 @@
 # use ndrseipi.py for nondeterministic storage elements
 
 import argparse
+import fcntl
 import logging
 import os
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
-import multiprocessing as mp
-
-from rucio.client import Client as RucioClient
 
 from rucio.client.replicaclient import ReplicaClient
 from rucio.client.didclient import DIDClient
-from rucio.common.exception import DataIdentifierAlreadyExists
+from rucio.common.exception import DataIdentifierAlreadyExists, Duplicate, FileAlreadyExists, FileReplicaAlreadyExists
 import rucio.rse.rsemanager as rsemgr
 
+from clientfactory import ClientFactory
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'general'))
+from scheduler import WorkScheduler, chunked, read_items
+
 logging.basicConfig(format='%(asctime)-15s %(name)s %(levelname)s %(message)s', level=logging.INFO)
 logger = logging.getLogger('rbipi')
 
+SIDE_OUTPUT_SUFFIXES = ('.bad', '.mismatch', '.committed') # Written next to each filelist, never ingested themselves
+
 class Registrar:
     def __init__(self, args):
         self.just_say = args.just_say
@@ -29,47 +37,91 @@ class Registrar:
         self.scope = args.scope if args.scope is not None else f'user.{self.rucio_account}'
         self.dataset_name = args.dataset_name
         self.rse = args.rse
+        self.batch_size = args.batch_size
+        self.max_in_flight = args.max_in_flight
+        self.max_retries = args.max_retries
+        self.retry_backoff = args.retry_backoff
 
-    def do_processing(self, tid, files, R, D, badlist):
-        logger.info(f'(tid:{tid}) There are {len(files)} LFNs to process.')
-        registration_items, contents  = self.prepare_items(files, D, badlist)
-        if not self.just_say:
-            logger.info(f'(tid:{tid}) Registering {len(registration_items)} LFNs to {self.rse}.')
-            if len(registration_items) > 0 :
-                logger.info(f'Adding them to the dataset {self.scope}:{self.dataset_name}')
-                try:
-                    R.add_replicas(rse=self.rse, files=registration_items)
-                    attachments=[{'scope': self.scope, 'name': self.dataset_name, 'dids':contents }]
-                    D.add_files_to_datasets(attachments, ignore_duplicate=True)
-                    logger.info(f'ingested {len(registration_items)} LFNs.\n\t ALL DONE!')
-                except Exception as ex:
-                    logger.error(ex) 
-                    logger.info("First registering to REPLICAS and DIDS failed! Will try again after 0.05 second.")
-                    sleep(0.05)
-                    logger.info("Second try to register to REPLICAS and DIDS!" )
-                    R.add_replicas(rse=self.rse, files=registration_items)
-                    attachments=[{'scope': self.scope, 'name': self.dataset_name, 'dids':contents }]
-                    D.add_files_to_datasets(attachments, ignore_duplicate=True)
-                    logger.info(f'ingested {len(registration_items)} LFNs.\n\t ALL DONE!')
-            else:
-                logger.info("No LFNs registered, They already in Rucio. \n\t ALL DONE!")
-        else:
-            logger.info(f'(tid:{tid}) Would have registered {len(registration_items)} LFNs to {self.rse}.\
+    def do_processing(self, tid, files, clients, badlist, index, mismatchlist, ledger):
+        # Stream the worker's lines through fixed-size batches, keeping at most max_in_flight batches in flight
+        logger.info(f'(tid:{tid}) Registering LFNs to {self.rse} in batches of {self.batch_size}, '
+                f'{self.max_in_flight} in flight.\n\tAdding them to the dataset {self.scope}:{self.dataset_name}')
+        in_flight = threading.BoundedSemaphore(self.max_in_flight)
+        futures = []
+        num_items = 0
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            for batch_num, lines in enumerate(chunked(files, self.batch_size)):
+                registration_items = self.prepare_items(lines, index, ledger, badlist, mismatchlist, verbose=(batch_num == 0))
+                num_items += len(registration_items)
+                if len(registration_items) == 0 or self.just_say:
+                    continue
+                in_flight.acquire()
+                future = executor.submit(self.register_batch, tid, batch_num, registration_items, clients, ledger)
+                future.add_done_callback(lambda _: in_flight.release())
+                futures.append(future)
+        if self.just_say:
+            logger.info(f'(tid:{tid}) Would have registered {num_items} LFNs to {self.rse}.\
                     \n\tWould have added them to the dataset {self.scope}:{self.dataset_name}')
+            return
+        failed = sum(1 for future in futures if not future.result())
+        if num_items == 0:
+            logger.info(f'(tid:{tid}) No LFNs registered, They already in Rucio. \n\t ALL DONE!')
+        elif failed:
+            logger.error(f'(tid:{tid}) {failed} of {len(futures)} batches failed. Rerun to register the remaining LFNs.')
+        else:
+            logger.info(f'(tid:{tid}) ingested {num_items} LFNs in {len(futures)} batches.\n\t ALL DONE!')
 
-    def prepare_items(self, files, D, badlist):
-        items = []
-        contents = []
-        count = 0
+    def register_batch(self, tid, batch_num, items, clients, ledger):
+        # Register one batch, retrying only the stage that failed with exponential backoff
+        R = clients.get(ReplicaClient) # This thread's own clients, built after the fork
+        D = clients.get(DIDClient)
+        contents = [{'scope': item['scope'], 'name': item['name']} for item in items]
+        attachments = [{'scope': self.scope, 'name': self.dataset_name, 'dids': contents}]
+        replicas_added = False
+        for attempt in range(self.max_retries + 1):
+            start = time.monotonic()
+            try:
+                if not replicas_added:
+                    try:
+                        R.add_replicas(rse=self.rse, files=items)
+                    except (Duplicate, FileAlreadyExists, FileReplicaAlreadyExists):
+                        # Most likely an earlier attempt committed but its response was lost; if some replicas
+                        #     are really missing, attaching them fails and the batch is reported then
+                        logger.info(f'(tid:{tid}) Batch {batch_num}: replicas already registered')
+                    replicas_added = True
+                D.add_files_to_datasets(attachments, ignore_duplicate=True)
+            except Exception as ex:
+                delay = self.retry_backoff * 2 ** attempt
+                logger.error(f'(tid:{tid}) Batch {batch_num} attempt {attempt + 1}/{self.max_retries + 1} failed: {ex}')
+                if attempt < self.max_retries:
+                    logger.info(f'(tid:{tid}) Retrying batch {batch_num} in {delay:.2f} seconds.')
+                    sleep(delay)
+                continue
+            elapsed = time.monotonic() - start
+            ledger.record(f"{item['scope']}:{item['name']}" for item in items)
+            logger.info(f'(tid:{tid}) Batch {batch_num}: registered {len(items)} LFNs in {elapsed:.2f}s '
+                    f'({len(items) / max(elapsed, 1e-6):.1f} DIDs/sec)')
+            return True
+        logger.error(f'(tid:{tid}) Giving up on batch {batch_num} ({len(items)} LFNs) after {self.max_retries + 1} attempts.')
+        return False
+
+    def build_index(self, D):
+        # Fetch the dataset contents once per run; every worker filters against the same index
         try:
-            ds = list(D.list_content(self.scope, self.dataset_name))
+            index = DatasetIndex(D.list_content(self.scope, self.dataset_name))
         except Exception as ex:
             logger.error(ex) 
             logger.error("First try to connect to Rucio failed ! Will try again after 0.05 second.")
             sleep(0.05)
-            ds = list(D.list_content(self.scope, self.dataset_name))
+            index = DatasetIndex(D.list_content(self.scope, self.dataset_name))
             logger.info("Sucessfully connected to Rucio! Get contents from Rucio.")
+        logger.info(f'(Main) Indexed {len(index)} DIDs already in {self.scope}:{self.dataset_name}')
+        return index
+
+    def prepare_items(self, files, index, ledger, badlist, mismatchlist, verbose=False):
+        items = []
         bad =  open(badlist, 'a')
+        mismatch = open(mismatchlist, 'a')
         np = 0
         for fileinfo_raw in files:
             try:
@@ -79,7 +131,7 @@ class Registrar:
 #               md5 = fileinfo[2]
                 nbytes = int(fileinfo[2])
                 np += 1
-                if np < 3 :
+                if verbose and np < 3 :
                     logger.info(f'Create new item for registration: {self.scope}, {name}, {adler}, {nbytes}')
                 replica = {
                  'scope': self.scope,
@@ -88,35 +140,91 @@ class Registrar:
                  'adler32': adler,
 #                'md5': md5,
                 }
-                if {'scope': self.scope, 'name': name, 'type': 'FILE', 'bytes': nbytes, 'adler32': adler, 'md5': None} not in ds:
+                if f'{self.scope}:{name}' in ledger:
+                    continue # Committed by an earlier run
+                status = index.lookup(self.scope, name, nbytes, adler)
+                if status == DatasetIndex.MISSING:
                     items.append(replica)
-                    contents.append({'scope': self.scope, 'name': name})
+                elif status == DatasetIndex.MISMATCH:
+                    registered_bytes, registered_adler = index.get(self.scope, name)
+                    logger.warning(f'{self.scope}:{name} is already in the dataset with bytes={registered_bytes} adler32={registered_adler}, '
+                            f'but the file list says bytes={nbytes} adler32={adler}. Not re-registering it.')
+                    mismatch.write(f'{fileinfo_raw} {registered_adler} {registered_bytes}\n')
             except IndexError:
                 bad.write(fileinfo_raw + '\n')
                 pass
         bad.close()
-        return items, contents
-
-def get_file_queues(num_procs, f):
-    # Splits the list of files into (almost) equal buckets of work per proc
-    queues = [ [] for i in range(num_procs) ]
-    num_files = 0
-    for filename in f:
-        which_queue = num_files % num_procs
-        queues[which_queue].append(filename.strip())
-        num_files += 1
-    logger.info(f'(Main) Total LFNs: {num_files}\n\t~{num_files/num_procs} allocated per worker')
-    return queues
+        mismatch.close()
+        return items
+
+
+class DatasetIndex:
+    # Hashed view of a dataset's contents keyed on (scope, name), holding only (bytes, adler32)
+    MISSING = 0
+    PRESENT = 1
+    MISMATCH = 2
+
+    def __init__(self, contents):
+        self.entries = {}
+        for did in contents:
+            adler = did.get('adler32')
+            self.entries[(did['scope'], did['name'])] = (did.get('bytes'), adler.lower() if adler else None)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, scope, name):
+        return self.entries.get((scope, name), (None, None))
+
+    def lookup(self, scope, name, nbytes, adler):
+        entry = self.entries.get((scope, name))
+        if entry is None:
+            return DatasetIndex.MISSING
+        if entry == (nbytes, adler.lower()):
+            return DatasetIndex.PRESENT
+        return DatasetIndex.MISMATCH
+
+
+class CommitLedger:
+    # Append-only record of the DIDs in every committed batch, so a rerun into the same dataset skips them.
+    #     Lines are "<dataset scope:name> <file scope:name>"; lines for other datasets are ignored, so the
+    #     same filelist can be ingested again with another scope or dataset.
+    def __init__(self, path, dataset_did):
+        self.path = path
+        self.dataset_did = dataset_did
+        self.committed = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) == 2 and fields[0] == dataset_did:
+                        self.committed.add(fields[1])
+
+    def __contains__(self, did):
+        return did in self.committed
+
+    def __len__(self):
+        return len(self.committed)
+
+    def record(self, dids):
+        # Workers in several processes append to the same file; lock so batches don't interleave
+        data = ''.join(f'{self.dataset_did} {did}\n' for did in dids)
+        with open(self.path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            fcntl.flock(f, fcntl.LOCK_UN)
+
 
 def main():
     args = get_program_arguments()
     registrar = Registrar(args)
 
-    procs = []
     logger.info(f'(Main) Starting up {args.num_procs} worker processes')
-    registrar.rucio_client = RucioClient(account=args.rucio_account)
-    R = ReplicaClient()
-    D = DIDClient()
+    clients = ClientFactory(account=args.rucio_account)
+    clients.prime() # One token request; the workers read the token from the cache
+    D = clients.get(DIDClient)
     logger.info(f'Creating dataset {args.scope}:{args.dataset_name}')
     try:
         D.add_did(
@@ -130,29 +238,35 @@ def main():
     except DataIdentifierAlreadyExists:
         pass # This is fine, we might want to add more files to the same dataset
 
+    index = registrar.build_index(D)
+
     path = '.'
     for fl in os.listdir(path):
-        if args.filelist in fl :
+        if args.filelist in fl and not fl.endswith(SIDE_OUTPUT_SUFFIXES):
             badlist = fl + '.bad'
+            mismatchlist = fl + '.mismatch'
+            ledger = CommitLedger(fl + '.committed', f'{registrar.scope}:{registrar.dataset_name}')
+            if len(ledger) > 0:
+                logger.info(f'(Main) Skipping {len(ledger)} LFNs committed to {ledger.dataset_did} by a previous run of {fl}')
             logger.info(f'(Main)Starting to process file: {fl}')
-            with open(fl) as f: # Obtain the work distribution and hand it to the procs
-                file_queues =  get_file_queues(args.num_procs, f)
-                for i in range(args.num_procs):
-                    p = mp.Process(target=registrar.do_processing, args=(i, file_queues[i], R, D, badlist))
-                    p.start()
-                    procs.append(p)
-            logger.info(f'(Main) Processing file:  {fl}.')
-        for t in procs:
-            t.join()
+            with open(fl) as f: # Stream the lines to whichever worker is free
+                with WorkScheduler(registrar.do_processing, args.num_procs, processes=True,
+                        args=(clients, badlist, index, mismatchlist, ledger)) as scheduler:
+                    num_files = scheduler.feed(read_items(f))
+            logger.info(f'(Main) Processed {num_files} LFNs from file: {fl}.')
 
 def get_program_arguments():
     parser = argparse.ArgumentParser(description='Rucio Bulk In-Place Ingest: Register files with the Rucio DB without transferring them.')
     parser.add_argument('dataset_name', help='Name of the dataset to be created that all ingested files are to be attached to.')
     parser.add_argument('rse', help='Rucio Storage Element that the files will be ingested to.')
     parser.add_argument('filelist', help='Text file name in the directoy with information for one file per line of the files to be registered.\\n\tLine Format: <name> <Adler32 checksum> <size in bytes>. \\n\tIf one want to covery all the files, one can use partial name. Ex: if one wants to ingest all datafile[0-9][0-9].txt, the filelist will be datafile.\\n\tThe data should be placed at a location in the RSE dependent on the MD5 checksum of the scope:name LFN. The Adler32 used in this --filelist argument concerns long-term data verification rather than data location.')
-    parser.add_argument('--num-procs', type=int, default=1, help='Number of processes to divy up filelist between.')
+    parser.add_argument('--num-procs', type=int, default=1, help='Number of worker processes pulling lines from the filelist.')
     parser.add_argument('--rucio-account', default="root", help='Rucio account to be used.')
     parser.add_argument('--scope', help='Rucio scope that the files are to be placed in. Default: user.{rucio-account}')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Number of LFNs sent per add_replicas/add_files_to_datasets call. Default: 1000')
+    parser.add_argument('--max-in-flight', type=int, default=2, help='Number of batches each worker process keeps in flight at once. Default: 2')
+    parser.add_argument('--max-retries', type=int, default=5, help='Number of times a failed batch is retried before giving up on it. Default: 5')
+    parser.add_argument('--retry-backoff', type=float, default=0.5, help='Seconds to wait before the first retry of a batch, doubled on every further retry. Default: 0.5')
     parser.add_argument('--just-say', type=bool, default=False, help='For testing. Do not actually ingest files if True. Default: False')
 
     args = parser.parse_args()
@@ -2,79 +2,366 @@
 # Given a list of files, upload them to Rucio
 # Brandon White, 2022
 
+# Files stream from the filelist to a bounded pool of upload threads, each with its own Rucio
+#     and upload clients (their HTTP sessions are not shared between threads).
+# Uploaded files are attached to the dataset in batches instead of one attach call per file,
+#     and failed uploads and attachments are retried with exponential backoff.
+#
+# With --manifest, every file's outcome goes to an SQLite database: path, size, checksums and state
+#     (uploaded: on the RSE, registered: with a replica in the catalog too, attached: also in the dataset,
+#     failed). Files are then uploaded unregistered and registered here, with the size and checksums the
+#     upload computed, so each step is recorded as it completes. A rerun with the same manifest skips
+#     attached files, only attaches registered ones and only registers uploaded ones, without asking the
+#     catalog about any of them. Totals per state:
+#         sqlite3 <manifest> "SELECT state, COUNT(*), SUM(bytes) FROM files GROUP BY state"
+
 import argparse
+import json
 import logging
 import os
 import rucio
+import sqlite3
 import subprocess
+import sys
+import tempfile
 import threading
+import time
+from time import sleep
 
 from rucio.client import Client as RucioClient
 from rucio.client.uploadclient import UploadClient as RucioUploadClient
+from rucio.common.exception import DataIdentifierAlreadyExists, Duplicate, DuplicateRule, FileReplicaAlreadyExists, NoFilesUploaded
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'general'))
+from scheduler import WorkScheduler, read_items
+from checksums import checksum_file
 
 
 logging.basicConfig(format='%(asctime)-15s %(name)s %(levelname)s %(message)s', level=logging.INFO)
 logger = logging.getLogger('rbu')
 
+REPORT_SECONDS = 30 # Seconds between progress lines
+
+
+def with_retries(tid, description, max_retries, retry_backoff, func, *args, **kwargs):
+    # Calls func, retrying with exponential backoff; the last failure is raised
+    for attempt in range(max_retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except Exception as ex:
+            if attempt == max_retries:
+                raise
+            delay = retry_backoff * 2 ** attempt
+            logger.warning(f'(tid:{tid}) {description} attempt {attempt + 1}/{max_retries + 1} failed: {ex}. '
+                    f'Retrying in {delay:.2f} seconds.')
+            sleep(delay)
+
+
+def file_size(path):
+    # Weight for the lookahead reordering; a file that can't be stat'ed fails in its worker instead
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+class UploadStats:
+    # Totals across all upload threads, with a periodic aggregate progress line
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {True: 0, False: 0}
+        self.bytes = 0
+        self.start = time.monotonic()
+        self.next_report = self.start + REPORT_SECONDS
+
+    def add(self, ok, nbytes=0):
+        with self.lock:
+            self.files[ok] += 1
+            self.bytes += nbytes
+            if time.monotonic() < self.next_report:
+                return
+            self.next_report = time.monotonic() + REPORT_SECONDS
+            line = self.summary()
+        logger.info(f'(Main) Progress: {line}')
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self.start, 1e-6)
+        return (f'{self.files[True]} files uploaded ({self.files[False]} failed), {self.bytes / 1e6:.1f} MB '
+                f'in {elapsed:.1f}s, {self.bytes / elapsed / 1e6:.1f} MB/s, {self.files[True] / elapsed:.1f} files/s')
+
+
+class UploadManifest:
+    # Per-file upload state in SQLite, shared by the upload threads through one locked connection
+    UPLOADED = 'uploaded'
+    REGISTERED = 'registered'
+    ATTACHED = 'attached'
+    FAILED = 'failed'
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL') # Commits append to the log instead of rewriting pages
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, bytes INTEGER, adler32 TEXT, md5 TEXT, scope TEXT, name TEXT,
+                state TEXT NOT NULL, error TEXT, updated REAL)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS files_did ON files (scope, name)')
+        self.db.commit()
+
+    def state(self, path):
+        # (state, scope, name, bytes, adler32, md5), all None for a file not seen yet
+        with self.lock:
+            row = self.db.execute('SELECT state, scope, name, bytes, adler32, md5 FROM files WHERE path = ?', (path,)).fetchone()
+        return row if row is not None else (None,) * 6
+
+    def uploaded(self, path, nbytes, adler32, md5, scope, name):
+        with self.lock, self.db:
+            self.db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, NULL, ?)',
+                    (path, nbytes, adler32, md5, scope, name, self.UPLOADED, time.time()))
+
+    def registered(self, path):
+        with self.lock, self.db:
+            self.db.execute('UPDATE files SET state = ?, error = NULL, updated = ? WHERE path = ?', (self.REGISTERED, time.time(), path))
+
+    def register_failed(self, path, error):
+        # The file stays uploaded, so a rerun only retries the registration
+        with self.lock, self.db:
+            self.db.execute('UPDATE files SET error = ?, updated = ? WHERE path = ?', (error, time.time(), path))
+
+    def failed(self, path, error):
+        with self.lock, self.db:
+            self.db.execute('INSERT INTO files (path, state, error, updated) VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT (path) DO UPDATE SET state = excluded.state, error = excluded.error, updated = excluded.updated',
+                    (path, self.FAILED, error, time.time()))
+
+    def attached(self, dids):
+        with self.lock, self.db:
+            self.db.executemany('UPDATE files SET state = ?, updated = ? WHERE scope = ? AND name = ?',
+                    [(self.ATTACHED, time.time(), did['scope'], did['name']) for did in dids])
+
+    def summary(self):
+        # {state: (files, bytes)}
+        with self.lock:
+            rows = self.db.execute('SELECT state, COUNT(*), SUM(bytes) FROM files GROUP BY state').fetchall()
+        return {state: (count, nbytes or 0) for state, count, nbytes in rows}
+
+    def close(self):
+        self.db.close()
+
+
+class DatasetAttacher:
+    # Collects uploaded DIDs from every thread and attaches them to the dataset batch_size at a time
+    def __init__(self, scope, name, batch_size, max_retries, retry_backoff, manifest=None):
+        self.scope = scope
+        self.name = name
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.manifest = manifest
+        self.lock = threading.Lock()
+        self.pending = []
+        self.attached = 0
+        self.failed = []
+
+    def add(self, tid, client, did):
+        with self.lock:
+            self.pending.append(did)
+            if len(self.pending) < self.batch_size:
+                return
+            batch, self.pending = self.pending, []
+        self.attach(tid, client, batch) # Outside the lock, so the other threads keep adding
+
+    def flush(self, tid, client):
+        with self.lock:
+            batch, self.pending = self.pending, []
+        if batch:
+            self.attach(tid, client, batch)
+
+    def attach(self, tid, client, dids):
+        attachments = [{'scope': self.scope, 'name': self.name, 'dids': dids}]
+        try:
+            with_retries(tid, f'Attaching {len(dids)} files to {self.scope}:{self.name}', self.max_retries, self.retry_backoff,
+                    client.add_files_to_datasets, attachments, ignore_duplicate=True)
+        except Exception as ex:
+            logger.error(f'(tid:{tid}) Giving up attaching {len(dids)} files to {self.scope}:{self.name}: {ex}')
+            with self.lock:
+                self.failed.extend(dids)
+            return
+        if self.manifest is not None:
+            self.manifest.attached(dids)
+        with self.lock:
+            self.attached += len(dids)
+
 
 class RucioUploader:
     def __init__(self, args):
         self.just_say = args.just_say
         self.rucio_account = args.rucio_account
-        self.scope = args.scope
+        self.scope = args.scope if args.scope is not None else f'user.{self.rucio_account}'
         self.dataset_name = args.dataset_name
-        self.rse = args.rse 
+        self.rse = args.rse
         self.register_after_upload = args.register_after_upload
+        self.max_retries = args.max_retries
+        self.retry_backoff = args.retry_backoff
         self.rucio_client = RucioClient(account=self.rucio_account)
-        self.rucio_upload_client = RucioUploadClient(_client=self.rucio_client, logger=logger)
+        self.manifest = UploadManifest(args.manifest) if args.manifest and not self.just_say else None
+        self.attacher = DatasetAttacher(self.scope, self.dataset_name, args.attach_batch_size, self.max_retries, self.retry_backoff,
+                self.manifest)
+        self.stats = UploadStats()
+        self.summary_dir = None
 
     def do_processing(self, tid, files):
-        logger.info(f'(tid:{tid}) Preparing {len(files)} files for upload')
-        upload_items = prepare_items(files)
-        if not self.just_say:
-            logger.info(f'(tid:{tid}) Uploading {len(files)} files to {self.rse}.\n\tAdding them to the dataset {self.scope}:{self.dataset_name}')
-            self.rucio_upload_client.upload(items)
-        else:
-            logger.info(f'(tid:{tid}) Would have uploaded {len(files)} files to {self.rse}.\n\tWould have added them to the dataset {self.scope}:{self.dataset_name}')
+        # One client pair per thread, created in the thread that uses it
+        client = RucioClient(account=self.rucio_account)
+        upload_client = RucioUploadClient(_client=client, logger=logger)
+        for f in files:
+            item = self.prepare_item(f)
+            if self.just_say:
+                logger.info(f'(tid:{tid}) Would have uploaded {f} to {self.rse}.\n\tWould have added it to the dataset {self.scope}:{self.dataset_name}')
+                continue
+            try:
+                start = time.monotonic()
+                if self.manifest is not None:
+                    info = with_retries(tid, f'Upload of {f}', self.max_retries, self.retry_backoff, self.upload_unregistered,
+                            tid, upload_client, item)
+                    nbytes = info['bytes']
+                else:
+                    nbytes = os.path.getsize(f)
+                    with_retries(tid, f'Upload of {f}', self.max_retries, self.retry_backoff, upload_client.upload, [item])
+            except Exception as ex:
+                logger.error(f'(tid:{tid}) Giving up on {f}: {ex}')
+                self.stats.add(False)
+                if self.manifest is not None:
+                    self.manifest.failed(f, str(ex))
+                continue
+            logger.debug(f'(tid:{tid}) Uploaded {f} to {self.rse} in {time.monotonic() - start:.2f}s')
+            if self.manifest is not None:
+                self.manifest.uploaded(f, nbytes, info['adler32'], info.get('md5'), self.scope, item['did_name'])
+                if not self.register(tid, client, f, item['did_name'], info):
+                    self.stats.add(False)
+                    continue
+            self.stats.add(True, nbytes)
+            self.attacher.add(tid, client, {'scope': self.scope, 'name': item['did_name']})
 
+    def upload_unregistered(self, tid, upload_client, item):
+        """
+        Uploads a file without registering it, taking its size and checksums from the upload summary
+        rather than reading the file again.
 
-    def prepare_items(self, files):
-        items = []
-        for f in files:
-            item = {
-                'path': f,
-                'rse': self.start_rse,
-                'did_scope': self.rucio_scope,
-                'dataset_scope': self.rucio_scope,
-                'dataset_name': self.dataset_name,
-                'register_after_upload': self.register_after_upload
-            }
-            items.append(item)
-        return items
+        :returns: dict with bytes, adler32 and, when the upload computed them, md5 and guid
+        """
+        summary_path = os.path.join(self.summary_dir, f'{tid}.json')
+        traces = []
+        try:
+            upload_client.upload([dict(item, no_register=True)], summary_file_path=summary_path, traces_copy_out=traces)
+        except NoFilesUploaded:
+            # Already on the RSE (uploaded by a run that died before recording it); read the file instead
+            if [trace.get('stateReason') for trace in traces] != ['File already exists']:
+                raise
+            return checksum_file(item['path'], ('adler32', 'md5'))
+        with open(summary_path) as summary_f:
+            return json.load(summary_f)[f'{self.scope}:{item["did_name"]}']
+
+    def register(self, tid, client, path, name, info):
+        """
+        Registers an uploaded file as UploadClient would: its replica, then a rule since it has no dataset.
+        Either call may find its work already done, by an attempt whose response was lost or by an earlier run.
+
+        :returns: whether the file is registered; if not, the manifest keeps it as uploaded
+        """
+        did = {'scope': self.scope, 'name': name}
+        replica = dict(did, bytes=info['bytes'], adler32=info['adler32'])
+        if info.get('md5'):
+            replica['md5'] = info['md5']
+        if info.get('guid'):
+            replica['meta'] = {'guid': info['guid']}
+
+        def add_replica():
+            try:
+                client.add_replicas(rse=self.rse, files=[replica])
+            except (Duplicate, FileReplicaAlreadyExists):
+                pass
+
+        def add_rule():
+            try:
+                client.add_replication_rule([did], copies=1, rse_expression=self.rse)
+            except DuplicateRule:
+                pass
+
+        try:
+            with_retries(tid, f'Registration of {path}', self.max_retries, self.retry_backoff, add_replica)
+            with_retries(tid, f'Replication rule for {path}', self.max_retries, self.retry_backoff, add_rule)
+        except Exception as ex:
+            logger.error(f'(tid:{tid}) Giving up registering {path}: {ex}')
+            self.manifest.register_failed(path, str(ex))
+            return False
+        self.manifest.registered(path)
+        return True
+
+    def prepare_item(self, f):
+        # No dataset in the item: the upload client would attach every file with its own call
+        return {
+            'path': f,
+            'rse': self.rse,
+            'did_scope': self.scope,
+            'did_name': os.path.basename(f),
+            'register_after_upload': self.register_after_upload
+        }
 
     def rucio_create_dataset(self):
         logger.info(f'Creating Rucio dataset')
         if not self.just_say:
             logger.info(f'(Main) Creating dataset {self.scope}:{self.dataset_name}')
-            rc = self.rucio_client.add_dataset(
-                    self.test_params.rucio_scope,
-                    dataset_name,
-                    rse=self.rse
-            )
+            try:
+                self.rucio_client.add_dataset(self.scope, self.dataset_name, rse=self.rse)
+            except DataIdentifierAlreadyExists:
+                pass # This is fine, we might want to add more files to the same dataset
         else:
             logger.info(f'(Main) Would created the dataset {self.scope}:{self.dataset_name}')
 
+    def unfinished(self, files):
+        # Files the manifest has no success for. Uploaded files only still need registering and registered ones
+        #     attaching, which is done here.
+        skipped = 0
+        for f in files:
+            state, scope, name, nbytes, adler32, md5 = self.manifest.state(f)
+            if state == UploadManifest.ATTACHED:
+                skipped += 1
+            elif state == UploadManifest.UPLOADED:
+                skipped += 1
+                if self.register('Main', self.rucio_client, f, name, {'bytes': nbytes, 'adler32': adler32, 'md5': md5}):
+                    self.attacher.add('Main', self.rucio_client, {'scope': scope, 'name': name})
+            elif state == UploadManifest.REGISTERED:
+                skipped += 1
+                self.attacher.add('Main', self.rucio_client, {'scope': scope, 'name': name})
+            else:
+                yield f
+        logger.info(f'(Main) Skipped {skipped} files uploaded by a previous run')
+
+    def upload(self, files, num_threads, lookahead=1):
+        """
+        Uploads every file in files over num_threads threads and attaches them to the dataset.
 
-def get_file_queues(num_threads, f):
-    # Splits the list of files into (almost) equal buckets of work per thread
-    queues = [ [] for i in range(num_threads) ]
-    num_files = 0
-    for filename in f:
-        which_queue = num_files % num_threads
-        queues[which_queue].append(filename.strip())
-        num_files += 1
-    logger.info(f'(Main) Total files: {num_files}\n\t~{num_files/num_threads} allocated per worker')
-    return queues
+        :returns: the number of files fed to the threads
+        """
+        logger.info(f'(Main) Starting up {num_threads} worker threads')
+        if self.manifest is not None:
+            files = self.unfinished(files)
+        weight = file_size if lookahead > 1 else None
+        with tempfile.TemporaryDirectory(prefix='rbu-') as summary_dir: # Upload summaries, one file per thread
+            self.summary_dir = summary_dir
+            with WorkScheduler(self.do_processing, num_threads) as scheduler:
+                num_files = scheduler.feed(files, weight=weight, window=lookahead)
+        self.attacher.flush('Main', self.rucio_client)
+        logger.info(f'(Main) {self.stats.summary()}')
+        if self.manifest is not None:
+            totals = self.manifest.summary()
+            logger.info('(Main) Manifest: ' + ', '.join(f'{state} {count} files ({nbytes / 1e6:.1f} MB)'
+                    for state, (count, nbytes) in sorted(totals.items())))
+        if self.attacher.failed:
+            logger.error(f'(Main) {len(self.attacher.failed)} uploaded files could not be attached to {self.scope}:{self.dataset_name}: '
+                    + ', '.join(did['name'] for did in self.attacher.failed))
+        return num_files
 
 
 def main():
@@ -82,17 +369,11 @@ def main():
     uploader = RucioUploader(args)
     uploader.rucio_create_dataset()
 
-    threads = []
-    logger.info(f'(Main) Starting up {args.num_threads} worker threads')
-    with open(args.filelist) as f: # Obtain the work distribution and hand it to the threads
-        file_queues =  get_file_queues(args.num_threads, f)
-        for i in range(args.num_threads):
-            t = threading.Thread(target=uploader.do_processing, args=(i, file_queues[i]))
-            t.start()
-            threads.append(t)
-    for t in threads:
-        t.join()
-    logger.info(f'(Main) Uploads complete.')
+    with open(args.filelist) as f: # Stream the files to whichever thread is free
+        num_files = uploader.upload(read_items(f), args.num_threads, args.lookahead)
+    if uploader.manifest is not None:
+        uploader.manifest.close()
+    logger.info(f'(Main) Uploads complete. Total files: {num_files}')
 
 
 def get_program_arguments():
@@ -100,10 +381,15 @@ def get_program_arguments():
     parser.add_argument('dataset_name', help='Name of the dataset to be created that all uploaded files are to be attached to.')
     parser.add_argument('rse', help='Rucio Storage Element that the files will be uploaded to.')
     parser.add_argument('filelist', help='Text file with one file name per line of the files to be uploaded.')
-    parser.add_argument('--num-threads', type=int, default=1, help='Number of threads to divy up filelist between.')
+    parser.add_argument('--num-threads', type=int, default=1, help='Number of upload threads pulling files from the filelist.')
+    parser.add_argument('--lookahead', type=int, default=1, help='Read this many files ahead and upload the largest first, so big files do not straggle at the end. Default: 1 (input order)')
     parser.add_argument('--rucio-account', default=os.getlogin(), help='Rucio account to be used.')
     parser.add_argument('--scope', help='Rucio scope that the files are to be placed in. Default: user.{rucio-account}')
-    parser.add_argument('--register-after-upload', type=bool, default=False, help='Passed to Rucio upload(). Default: False')
+    parser.add_argument('--attach-batch-size', type=int, default=500, help='Number of uploaded files attached to the dataset per call. Default: 500')
+    parser.add_argument('--max-retries', type=int, default=3, help='Number of times a failed upload or attachment is retried before giving up on it. Default: 3')
+    parser.add_argument('--retry-backoff', type=float, default=1.0, help='Seconds to wait before the first retry, doubled on every further retry. Default: 1.0')
+    parser.add_argument('--manifest', type=str, default=None, help='SQLite file recording each file\'s upload state; a rerun with it skips finished files. Default: none')
+    parser.add_argument('--register-after-upload', type=bool, default=False, help='Passed to Rucio upload(); with --manifest files are always registered after upload. Default: False')
     parser.add_argument('--just-say', type=bool, default=False, help='For testing. Do not actually upload files if True. Default: False')
 
     args = parser.parse_args()
@@ -9,12 +9,36 @@ rucio database url. One way is to copy this script to a running rucio server
 instance.
 
 An example dids_template.json shows how the metadata is loaded into the script.
+The input can also be JSON Lines, one record per line.
+
+With --bulk, records are streamed and updated in chunks: one bulk read to find
+what actually differs, one set_dids_metadata_bulk for the chunk, and one bulk
+read to check the result, with chunks spread over a pool of worker threads.
+--dry-run prints what would change without writing anything.
+
+Records are checked and coerced as they are read: bytes (filesize) becomes an
+int, adler32 lowercase 8-digit hex and md5 lowercase 32-digit hex. Records that
+do not pass are skipped and, with --reject-file, written there as JSON Lines
+with their line number in the input, so they can be fixed and fed back in.
 """
+import argparse
 import json
+import re
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
 from rucio.core import did
 from rucio.common.types import InternalScope
 
+METADATA_KEYS = ('adler32', 'bytes', 'md5')
+READ_SIZE = 1024 * 1024
+MAX_RECORD_SIZE = READ_SIZE # An array element not parsed within this many characters is malformed
+ADLER32_RE = re.compile(r'[0-9a-f]{1,8}')
+MD5_RE = re.compile(r'[0-9a-f]{32}')
+SIZE_RE = re.compile(r'[0-9]+')
+
 
 def update_did(scope, name, adler32, md5, filesize):
     """
@@ -36,16 +60,281 @@ def get_metadata(scope, name):
     return current
 
 
+def element_end(buf, pos):
+    # Index of the "," or "]" ending the array element that starts at pos, skipping over strings and
+    #     nested brackets, or None if it isn't in buf yet
+    depth = 0
+    in_string = escaped = False
+    for i in range(pos, len(buf)):
+        c = buf[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif c == '\\':
+                escaped = True
+            elif c == '"':
+                in_string = False
+        elif c == '"':
+            in_string = True
+        elif c in '[{':
+            depth += 1
+        elif c in ']}' and depth:
+            depth -= 1
+        elif c in ',]' and not depth:
+            return i
+    return None
+
+
+def iter_json_array(f):
+    """
+    Yields (line number, object, error) for the elements of a JSON array, reading the file in chunks.
+
+    A malformed element is yielded as its raw text with the parse error, and reading carries on from
+    the next element; only a truncated array raises ValueError.
+    """
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    line = 1 # Line of buf[pos]
+    started = False
+    for data in iter(lambda: f.read(READ_SIZE), ''):
+        buf = buf[pos:] + data
+        pos = 0
+        while True:
+            start = pos
+            while pos < len(buf) and (buf[pos].isspace() or (started and buf[pos] == ',')):
+                pos += 1
+            line += buf.count('\n', start, pos)
+            if pos == len(buf):
+                break
+            if not started:
+                if buf[pos] != '[':
+                    raise ValueError(f'line {line}: expected a JSON array')
+                started = True
+                pos += 1
+                continue
+            if buf[pos] == ']':
+                return
+            try:
+                record, end = decoder.raw_decode(buf, pos)
+                error = None
+                if end == len(buf):
+                    break # Possibly cut short (e.g. a number) by the end of the buffer; read more
+            except json.JSONDecodeError as decode_error:
+                end = element_end(buf, pos)
+                if end is None:
+                    if len(buf) - pos > MAX_RECORD_SIZE:
+                        raise ValueError(f'line {line}: element not terminated within {MAX_RECORD_SIZE} characters') from None
+                    break # The record runs past the end of the buffer; read more
+                record, error = buf[pos:end].strip(), decode_error.msg
+            yield line, record, error
+            line += buf.count('\n', pos, end)
+            pos = end
+    if buf[pos:].strip():
+        raise ValueError(f'line {line}: truncated JSON array')
+
+
+def iter_records(path):
+    """
+    Yields (line number, record, error) from a JSON array (like dids.json) or JSON Lines,
+    told apart by the first character. error is None, or why the line could not be parsed.
+    """
+    with open(path, 'r') as f:
+        first = f.read(1)
+        while first.isspace():
+            first = f.read(1)
+        f.seek(0)
+        if first == '[':
+            yield from iter_json_array(f)
+        else:
+            for line, text in enumerate(f, 1):
+                if not text.strip():
+                    continue
+                try:
+                    yield line, json.loads(text), None
+                except json.JSONDecodeError as error:
+                    yield line, text.rstrip('\n'), error.msg
+
+
+def coerce_record(record):
+    """
+    Checks a DID record and returns (scope, name, meta) with bytes as an int and lowercase hex checksums
+
+    :raises ValueError: saying why the record is unusable
+    """
+    if not isinstance(record, dict):
+        raise ValueError('not a JSON object')
+    for key in ('scope', 'name'):
+        if not isinstance(record.get(key), str) or not record[key].strip():
+            raise ValueError(f'missing {key}')
+    filesize = record.get('filesize', record.get('bytes'))
+    if isinstance(filesize, str) and SIZE_RE.fullmatch(filesize.strip()):
+        filesize = int(filesize)
+    if not isinstance(filesize, int) or isinstance(filesize, bool) or filesize < 0:
+        raise ValueError(f'bad filesize {filesize!r}')
+    adler32 = record.get('adler32')
+    if not isinstance(adler32, str) or not ADLER32_RE.fullmatch(adler32.strip().lower()):
+        raise ValueError(f'bad adler32 {adler32!r}')
+    md5 = record.get('md5')
+    if not isinstance(md5, str) or not MD5_RE.fullmatch(md5.strip().lower()):
+        raise ValueError(f'bad md5 {md5!r}')
+    meta = {
+        'adler32': adler32.strip().lower().zfill(8), # Leading zeros are often lost along the way
+        'bytes': filesize,
+        'md5': md5.strip().lower(),
+    }
+    return record['scope'].strip(), record['name'].strip(), meta
+
+
+class Rejects:
+    """
+    Counts bad records and writes them, with their line number, to a JSON Lines reject file if there is one
+    """
+    def __init__(self, path=None):
+        self.f = open(path, 'w') if path else None
+        self.count = 0
+
+    def __call__(self, line, error, record):
+        self.count += 1
+        if self.f is None:
+            print(f'line {line}: {error}', file=sys.stderr)
+            return
+        self.f.write(json.dumps({'line': line, 'error': error, 'record': record}) + '\n')
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+
+
+def iter_dids(path, reject):
+    """
+    Yields (scope, name, meta) for every usable record in path; the others go to reject(line, error, record)
+    """
+    for line, record, error in iter_records(path):
+        if error is None:
+            try:
+                yield coerce_record(record)
+                continue
+            except ValueError as e:
+                error = str(e)
+        reject(line, error, record)
+
+
+def current_meta(meta):
+    return {
+        'adler32': meta['adler32'].lower() if meta.get('adler32') else None,
+        'bytes': meta.get('bytes'),
+        'md5': meta.get('md5').lower() if meta.get('md5') else None,
+    }
+
+
+def read_chunk_metadata(dids):
+    # {(scope, name): metadata} in one bulk read
+    return {(str(meta['scope']), meta['name']): current_meta(meta) for meta in did.get_metadata_bulk(dids)}
+
+
+def update_chunk(dids, dry_run=False):
+    """
+    Brings one chunk of (scope, name, meta) to that metadata, skipping DIDs that already match
+
+    :returns: dict of counts: updated, unchanged, missing, failed
+    """
+    counts = {'updated': 0, 'unchanged': 0, 'missing': 0, 'failed': 0}
+    wanted = {(scope, name): meta for scope, name, meta in dids}
+    dids = [{'scope': InternalScope(scope=scope), 'name': name} for scope, name in wanted]
+    current = read_chunk_metadata(dids)
+
+    changes = []
+    for (scope, name), meta in wanted.items():
+        if (scope, name) not in current:
+            print(f'{scope}:{name}: not found')
+            counts['missing'] += 1
+        elif current[(scope, name)] == meta:
+            counts['unchanged'] += 1
+        else:
+            if dry_run:
+                old = current[(scope, name)]
+                diff = ', '.join(f'{key} {old[key]} -> {meta[key]}' for key in METADATA_KEYS if old[key] != meta[key])
+                print(f'{scope}:{name}: {diff}')
+            changes.append({'scope': InternalScope(scope=scope), 'name': name, 'meta': meta})
+    if dry_run or not changes:
+        counts['updated'] += len(changes)
+        return counts
+
+    did.set_dids_metadata_bulk(dids=changes)
+    after = read_chunk_metadata([{'scope': change['scope'], 'name': change['name']} for change in changes])
+    for change in changes:
+        key = (str(change['scope']), change['name'])
+        if after.get(key) == change['meta']:
+            counts['updated'] += 1
+        else:
+            print(f'{key[0]}:{key[1]}: metadata did not take, now {after.get(key)}')
+            counts['failed'] += 1
+    return counts
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def bulk_update(path, chunk_size, workers, dry_run, reject):
+    totals = {'updated': 0, 'unchanged': 0, 'missing': 0, 'failed': 0}
+
+    def add(counts):
+        for key, n in counts.items():
+            totals[key] += n
+
+    # Only a few chunks per worker are read ahead, so memory stays flat however long the input is
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        in_flight = deque()
+        for chunk in chunked(iter_dids(path, reject), chunk_size):
+            in_flight.append(executor.submit(update_chunk, chunk, dry_run))
+            if len(in_flight) >= workers * 2:
+                add(in_flight.popleft().result())
+        while in_flight:
+            add(in_flight.popleft().result())
+    label = 'Would update' if dry_run else 'Updated'
+    print(f"{label} {totals['updated']}, unchanged {totals['unchanged']}, "
+          f"not found {totals['missing']}, failed {totals['failed']}, rejected {reject.count}")
+
+
+def get_program_arguments():
+    parser = argparse.ArgumentParser(description='Update the adler32, bytes and md5 of DIDs')
+    parser.add_argument('input', nargs='?', default='dids.json', help='JSON array or JSON Lines of DIDs. Default: dids.json')
+    parser.add_argument('--bulk', action='store_true', help='Update in chunks over a pool of workers.')
+    parser.add_argument('--chunk-size', type=int, default=500, help='DIDs per bulk update. Default: 500')
+    parser.add_argument('--workers', type=int, default=4, help='Chunks updated at once. Default: 4')
+    parser.add_argument('--dry-run', action='store_true', help='Print the changes without making them.')
+    parser.add_argument('--reject-file', type=str, default=None, help='Write records that fail validation here as JSON Lines. Default: report them on stderr')
+    args = parser.parse_args()
+    return args
+
+
 def main():
-    with open('dids.json', 'r') as f:
-        dids = json.load(f)
-
-    for file in dids:
-        scope = InternalScope(scope=file['scope'])
-        print("Current metadata: ", get_metadata(scope, file['name']))
-        update_did(scope, file['name'], file['adler32'], file['md5'],
-                   file['filesize'])
-        print("Updated metadata: ", get_metadata(scope, file['name']))
+    args = get_program_arguments()
+    reject = Rejects(args.reject_file)
+    try:
+        if args.bulk:
+            bulk_update(args.input, args.chunk_size, args.workers, args.dry_run, reject)
+            return
+
+        for scope, name, meta in iter_dids(args.input, reject):
+            scope = InternalScope(scope=scope)
+            print("Current metadata: ", get_metadata(scope, name))
+            if args.dry_run:
+                print("Would update to: ", meta)
+                continue
+            update_did(scope, name, meta['adler32'], meta['md5'], meta['bytes'])
+            print("Updated metadata: ", get_metadata(scope, name))
+        if reject.count:
+            print(f'Rejected {reject.count}')
+    finally:
+        reject.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,60 @@
+# dCache locality lookups over persistent HTTPS sessions
+# Each thread keeps its own keep-alive session to the dCache REST frontend, so a lookup
+#     costs one request on an open connection instead of a fresh TLS handshake.
+#     Results are cached per path for the life of the client.
+
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DCACHE_NAMESPACE_URL = 'https://fndca.fnal.gov:3880/api/v1/namespace/pnfs/fnal.gov/usr'
+TAPE_LOCALITIES = ('NEARLINE', 'ONLINE_AND_NEARLINE')
+
+
+class LocalityClient:
+    def __init__(self, experiment, base_url=DCACHE_NAMESPACE_URL, max_concurrency=8, timeout=60, verify=False):
+        self.prefix = f'{base_url}/{experiment}'
+        self.timeout = timeout
+        self.verify = verify
+        self.limiter = threading.BoundedSemaphore(max_concurrency)
+        self.local = threading.local()
+        self.cache = {}
+        self.cache_lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+
+    def session(self):
+        # One session (and so one kept-alive connection) per thread; sessions are not shared across threads
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.verify = self.verify
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=3)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self.local.session = session
+        return session
+
+    def locality(self, path):
+        """
+        Returns the dCache fileLocality of path (relative to the experiment's namespace root),
+        or None if dCache does not report one.
+        """
+        with self.cache_lock:
+            self.lookups += 1
+            if path in self.cache:
+                self.hits += 1
+                return self.cache[path]
+        with self.limiter:
+            resp = self.session().get(self.prefix + path, params={'locality': 'true'}, timeout=self.timeout)
+        try:
+            locality = resp.json()['fileLocality']
+        except (KeyError, ValueError):
+            locality = None
+        with self.cache_lock:
+            self.cache[path] = locality
+        return locality
+
+    def is_on_tape(self, path):
+        return self.locality(path) in TAPE_LOCALITIES
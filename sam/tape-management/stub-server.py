@@ -0,0 +1,163 @@
+# Local stand-in for SAMweb and the dCache REST frontend
+# Serves just enough of both APIs to exercise update_tape_locations_to_unavailable.py
+#     without touching production, with an optional artificial per-request latency.
+#
+#   python3 stub-server.py --port 8480 --latency-ms 20 &
+#   python3 update_tape_locations_to_unavailable.py nova files.txt --bulk \
+#       --samweb-url http://localhost:8480/sam \
+#       --dcache-url http://localhost:8480/api/v1/namespace/pnfs/fnal.gov/usr
+#
+# Location updates are applied, so a later lookup shows them, and every request is counted by kind
+#     (locateFile, locateFiles, update, locality); test_update_tape_locations.py checks both.
+
+import argparse
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+LOCALITIES = ('NEARLINE', 'ONLINE_AND_NEARLINE', 'ONLINE')
+
+LOCATE_ONE = re.compile(r'^/sam/(?P<experiment>[^/]+)/api/files/name/(?P<filename>[^/]+)/locations$')
+LOCATE_MANY = re.compile(r'^/sam/(?P<experiment>[^/]+)/api/files/locations$')
+NAMESPACE = re.compile(r'^/api/v1/namespace/pnfs/fnal.gov/usr/(?P<experiment>[^/]+)(?P<path>/.*)$')
+
+
+def digest(value):
+    return int(hashlib.md5(value.encode()).hexdigest(), 16)
+
+
+def sam_locations(experiment, filename):
+    # Every file gets one tape location and, for a third of them, a disk location too
+    h = digest(filename)
+    locations = [{
+        'location_type': 'tape',
+        'location': f'enstore:/pnfs/{experiment}/stub/{h % 100:02d}(VR{h % 1000:04d}M8)',
+        'full_path': f'enstore:/pnfs/{experiment}/stub/{h % 100:02d}',
+    }]
+    if h % 3 == 0:
+        locations.append({
+            'location_type': 'disk',
+            'location': f'dcache:/pnfs/{experiment}/scratch',
+            'full_path': f'dcache:/pnfs/{experiment}/scratch',
+        })
+    return locations
+
+
+def dcache_locality(path):
+    return LOCALITIES[digest(path) % len(LOCALITIES)]
+
+
+class StubState:
+    # SAM locations as the PUTs left them, and the number of requests of each kind
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.files = {}
+
+    def count(self, kind):
+        with self.lock:
+            self.calls[kind] += 1
+
+    def locations(self, experiment, filename):
+        with self.lock:
+            locations = self.files.setdefault((experiment, filename), sam_locations(experiment, filename))
+            return [dict(location) for location in locations]
+
+    def set_label(self, experiment, filename, full_path, label):
+        # :returns: whether the file has a location at full_path
+        self.locations(experiment, filename)
+        with self.lock:
+            for location in self.files[(experiment, filename)]:
+                if location['full_path'] == full_path:
+                    location['label'] = label
+                    return True
+        return False
+
+
+def make_server(port=8480, latency=0, quiet=False):
+    server = ThreadingHTTPServer(('localhost', port), StubHandler)
+    server.latency = latency
+    server.quiet = quiet
+    server.state = StubState()
+    return server
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # Keep connections alive like the real services
+    disable_nagle_algorithm = True # Headers and body go out in separate writes
+
+    def send_json(self, body, status=200):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_form(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return parse_qs(self.rfile.read(length).decode()) if length else {}
+
+    def handle_request(self, method):
+        time.sleep(self.server.latency)
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        state = self.server.state
+        match = NAMESPACE.match(url.path)
+        if match and method == 'GET':
+            state.count('locality')
+            return self.send_json({'fileLocality': dcache_locality(match['path'])})
+        match = LOCATE_ONE.match(url.path)
+        if match and method == 'GET':
+            state.count('locateFile')
+            return self.send_json(state.locations(match['experiment'], match['filename']))
+        if match and method == 'PUT':
+            state.count('update')
+            label = self.read_form().get('label', [None])[0]
+            if not state.set_label(match['experiment'], match['filename'], query.get('location', [None])[0], label):
+                return self.send_json({'error': 'no such location'}, status=404)
+            return self.send_json({'status': 'ok'})
+        match = LOCATE_MANY.match(url.path)
+        if match:
+            state.count('locateFiles')
+            names = query.get('file_name', []) + self.read_form().get('file_name', [])
+            return self.send_json({name: state.locations(match['experiment'], name) for name in names})
+        self.send_json({'error': f'no stub for {method} {url.path}'}, status=404)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+def get_program_arguments():
+    parser = argparse.ArgumentParser(description='Serve stub SAMweb and dCache endpoints for local testing.')
+    parser.add_argument('--port', type=int, default=8480, help='Port to listen on. Default: 8480')
+    parser.add_argument('--latency-ms', type=float, default=0, help='Artificial delay added to every request. Default: 0')
+    parser.add_argument('--quiet', default=False, action='store_true', help='Do not log every request.')
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = get_program_arguments()
+    server = make_server(args.port, args.latency_ms / 1000, args.quiet)
+    print(f'Serving stub SAMweb and dCache on http://localhost:{args.port}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# Runs update_tape_locations_to_unavailable.py --bulk against stub-server.py on an ephemeral port
+#     and checks the requests it made and the SAM locations it left behind.
+#
+#   python3 -m pytest sam/tape-management
+
+import importlib.util
+import math
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+pytest.importorskip('samweb_client') # Imported by the script under test
+pytest.importorskip('requests')
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+EXPERIMENT = 'nova' # dcache_path assumes the 'enstore:/pnfs/nova' prefix
+NUM_FILES = 120
+BATCH_SIZE = 50
+
+
+def load_stub():
+    spec = importlib.util.spec_from_file_location('stub_server', os.path.join(HERE, 'stub-server.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def stub():
+    module = load_stub()
+    server = module.make_server(port=0, quiet=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield module, server
+    server.shutdown()
+    server.server_close()
+
+
+def run_bulk(tmp_path, port, filenames, *extra):
+    filelist = tmp_path / 'files.txt'
+    filelist.write_text(''.join(f'{name}\n' for name in filenames))
+    base_url = f'http://localhost:{port}'
+    return subprocess.run([sys.executable, os.path.join(HERE, 'update_tape_locations_to_unavailable.py'), EXPERIMENT, str(filelist),
+                           '--bulk', '--batch-size', str(BATCH_SIZE), '--num-threads', '4', '--cert', '', '--max-retries', '0',
+                           '--samweb-url', f'{base_url}/sam', '--dcache-url', f'{base_url}/api/v1/namespace/pnfs/fnal.gov/usr', *extra],
+                          capture_output=True, text=True, timeout=120)
+
+
+def on_tape(module, filename, location):
+    path = location['full_path'][len(f'enstore:/pnfs/{EXPERIMENT}'):] + '/' + filename
+    return module.dcache_locality(path) in ('NEARLINE', 'ONLINE_AND_NEARLINE')
+
+
+def test_bulk_marks_tape_locations_unavailable(stub, tmp_path):
+    module, server = stub
+    filenames = [f'stub_file_{i:04d}.root' for i in range(NUM_FILES)]
+    result = run_bulk(tmp_path, server.server_address[1], filenames)
+    assert result.returncode == 0, result.stderr
+
+    expected = {}
+    for name in filenames:
+        for location in module.sam_locations(EXPERIMENT, name):
+            if location['location_type'] == 'tape':
+                expected[name] = on_tape(module, name, location)
+    calls = server.state.calls
+    assert calls['locateFiles'] == math.ceil(NUM_FILES / BATCH_SIZE)
+    assert calls['locateFile'] == 0
+    assert calls['update'] == sum(expected.values())
+    assert 0 < calls['update'] < NUM_FILES # The stub puts some files on tape and some not
+
+    for name in filenames:
+        for location in server.state.locations(EXPERIMENT, name):
+            if location['location_type'] == 'tape' and expected[name]:
+                assert location.get('label') == 'unavailable', name
+            else:
+                assert 'label' not in location, name
+
@@ -0,0 +1,94 @@
+# Per-phase latency histograms and counters for the tape-management tools
+# Thread-safe; workers record into a shared PhaseStats and the main thread prints the summary.
+
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the histogram buckets, in milliseconds. The last bucket is open-ended.
+BUCKET_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000)
+BAR_WIDTH = 40
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        ms = seconds * 1000
+        for i, bound in enumerate(BUCKET_BOUNDS_MS):
+            if ms < bound:
+                break
+        else:
+            i = len(BUCKET_BOUNDS_MS)
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, pct):
+        # Upper bound of the bucket holding the pct-th percentile, in milliseconds
+        target = self.count * pct / 100
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= target:
+                return BUCKET_BOUNDS_MS[i] if i < len(BUCKET_BOUNDS_MS) else self.max * 1000
+        return 0.0
+
+    def format(self):
+        lines = []
+        if self.count == 0:
+            return '    (no samples)'
+        lines.append(f'    n={self.count} mean={self.total / self.count * 1000:.1f}ms max={self.max * 1000:.1f}ms '
+                f'p50<={self.percentile(50):.0f}ms p95<={self.percentile(95):.0f}ms p99<={self.percentile(99):.0f}ms')
+        peak = max(self.buckets)
+        lower = 0
+        for i, n in enumerate(self.buckets):
+            upper = BUCKET_BOUNDS_MS[i] if i < len(BUCKET_BOUNDS_MS) else None
+            if n:
+                label = f'{lower}-{upper}ms' if upper is not None else f'>={lower}ms'
+                bar = '#' * max(1, round(BAR_WIDTH * n / peak))
+                lines.append(f'    {label:>14} {n:>9} {bar}')
+            lower = upper
+        return '\n'.join(lines)
+
+
+class PhaseStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.phases = {}
+        self.counters = {}
+        self.start = time.monotonic()
+
+    @contextmanager
+    def time(self, phase):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(phase, time.monotonic() - start)
+
+    def record(self, phase, seconds):
+        with self.lock:
+            self.phases.setdefault(phase, LatencyHistogram()).record(seconds)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self, rate_counter='files'):
+        elapsed = time.monotonic() - self.start
+        with self.lock:
+            lines = [f'Elapsed: {elapsed:.1f}s']
+            for name, n in self.counters.items():
+                lines.append(f'{name}: {n}')
+            processed = self.counters.get(rate_counter, 0)
+            lines.append(f'{rate_counter}/sec: {processed / max(elapsed, 1e-6):.1f}')
+            for phase, histogram in self.phases.items():
+                lines.append(f'{phase} latency:')
+                lines.append(histogram.format())
+        return '\n'.join(lines)
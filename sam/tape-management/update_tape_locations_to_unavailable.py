@@ -5,85 +5,158 @@ import os
 import sys
 import pprint
 import argparse
-import threading
 import collections
+import threading
 import time
-import urllib2
 import shlex
 import re
 import subprocess
 import requests
-import json
 import samweb_client
-import threading
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, os.pardir, 'general'))
+from scheduler import WorkScheduler, chunked, read_items
+from locality import LocalityClient, DCACHE_NAMESPACE_URL
+from timing import PhaseStats
+
+SAMWEB_URL = 'https://samweb.fnal.gov:8483/sam'
+RETRY_BACKOFF = 1.0 # Seconds before the first retry of a failed update, doubled each time
 
-def file_is_on_tape(experiment, filename, sam_location):
-    prefix = 'https://fndca.fnal.gov:3880/api/v1/namespace/pnfs/fnal.gov/usr/%s' % experiment
-    suffix = '?locality=true'
+def dcache_path(filename, sam_location):
+    # Path of the file below the experiment's dCache namespace root
     full_path = sam_location['full_path'][18:] # Trim 'enstore:/pnfs/nova'
-    url = prefix + full_path + '/' + filename + suffix
-    resp = requests.get(url, verify=False)
-    resp_d = json.loads(resp.text)
-    try:
-        on_tape = resp_d['fileLocality'] in ['NEARLINE', 'ONLINE_AND_NEARLINE']
-    except KeyError:
-        on_tape = False
-    return on_tape 
-
-def set_file_volume_unavailable(samweb, filename, sam_location):
-    # Sets the tape location to unavailable in SAM
-    body = {'label': 'unavailable', 'sequence': '-1'}
-    url = 'https://samweb.fnal.gov:8483/sam/nova/api/files/name/%s/locations?location=%s' % ( filename, sam_location['full_path'] )
-    resp = requests.put(url, data=body, verify='/etc/grid-security/certificates', cert='/tmp/x509up_u51660')
-    if resp.status_code == 200:
-        return True
-    else:
+    return full_path + '/' + filename
+
+def is_enstore_tape(sam_location):
+    return sam_location['location_type'] == 'tape' and sam_location['location'].startswith('enstore:')
+
+class UnavailableUpdater:
+    # Sends the UNAVAILABLE location updates to SAM through a bounded pool of threads,
+    #     each with its own keep-alive session, retrying failed updates with backoff
+    def __init__(self, args, stats):
+        self.url = '%s/%s/api/files/name/%%s/locations' % (args.samweb_url, args.experiment)
+        self.verify = args.ca_path
+        self.cert = args.cert
+        self.max_retries = args.max_retries
+        self.stats = stats
+        self.local = threading.local()
+        self.pending = threading.BoundedSemaphore(2 * args.update_concurrency)
+        self.executor = ThreadPoolExecutor(max_workers=args.update_concurrency)
+
+    def session(self):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.verify = self.verify
+            session.cert = self.cert
+            self.local.session = session
+        return session
+
+    def submit(self, tid, filename, sam_location):
+        # Blocks while the pool already has 2x its size of updates queued
+        self.pending.acquire()
+        future = self.executor.submit(self.set_file_volume_unavailable, tid, filename, sam_location)
+        future.add_done_callback(lambda _: self.pending.release())
+        return future
+
+    def set_file_volume_unavailable(self, tid, filename, sam_location):
+        # Sets the tape location to unavailable in SAM
+        body = {'label': 'unavailable', 'sequence': '-1'}
+        params = {'location': sam_location['full_path']}
+        for attempt in range(self.max_retries + 1):
+            try:
+                with self.stats.time('update'):
+                    resp = self.session().put(self.url % filename, params=params, data=body)
+                if resp.status_code == 200:
+                    self.stats.count('updated')
+                    print('Thread %s: %s' % (tid, filename))
+                    return True
+                error = 'HTTP %s' % resp.status_code
+                if resp.status_code < 500:
+                    break # The request itself is wrong, retrying won't help
+            except requests.RequestException as ex:
+                error = str(ex)
+            if attempt < self.max_retries:
+                time.sleep(RETRY_BACKOFF * 2 ** attempt)
+        print('Failed to set %s UNAVAILABLE at %s: %s' % (filename, sam_location['full_path'], error))
+        self.stats.count('update_failed')
         return False
-    
-def do_processing(tid, f, args):
-    # Kick off set_file_volume_unavailble for each file if needed
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+def make_samweb(args):
     samweb = samweb_client.SAMWebClient(experiment=args.experiment)
+    if args.samweb_url != SAMWEB_URL:
+        samweb.baseurl = '%s/%s/api' % (args.samweb_url, args.experiment)
+    return samweb
+
+def check_locations(tid, filename, sam_locations, locality, updater, stats):
+    for sam_location in sam_locations:
+        if is_enstore_tape(sam_location):
+            # check if the file is NEARLINE or ONLINE AND NEARLINE
+            with stats.time('locality'):
+                on_tape = locality.is_on_tape(dcache_path(filename, sam_location))
+            if on_tape:
+                # Set SAM tape status to "unavailable"
+                updater.submit(tid, filename, sam_location)
+
+def do_processing(tid, f, args, locality, updater, stats):
+    # Kick off set_file_volume_unavailble for each file if needed
+    samweb = make_samweb(args)
     for filename in f:
-        sam_locations = samweb.locateFile(filename)
-        for sam_location in sam_locations:
-            if sam_location['location_type'] == 'tape' and sam_location['location'].startswith('enstore:'):
-                # check if the file is NEARLINE or ONLINE AND NEARLINE
-                if file_is_on_tape(args.experiment, filename, sam_location):
-                    # Set SAM tape status to "unavailable"
-                    success = set_file_volume_unavailable(samweb, filename, sam_location)
-                    print('Thread %s: %s' % (tid, filename))
-                    
-def get_file_queues(num_threads, f):
-    # Splits the list of files into (almost) equal buckets of work per thread
-    queues = [ [] for i in range(num_threads) ]
-    i = 0
-    for filename in f:
-        which_queue = i % num_threads
-        queues[which_queue].append(filename.strip())
-        i += 1
-    if num_threads == 1:
-        return queues[0]
-    return queues
+        with stats.time('locate'):
+            sam_locations = samweb.locateFile(filename)
+        stats.count('files')
+        check_locations(tid, filename, sam_locations, locality, updater, stats)
+
+def do_bulk_processing(tid, batches, args, locality, updater, stats):
+    # Same as do_processing, but resolves the SAM locations of a whole batch of files in one query
+    samweb = make_samweb(args)
+    for batch in batches:
+        with stats.time('locate'):
+            batch_locations = samweb.locateFiles(batch)
+        stats.count('files', len(batch))
+        for filename in batch:
+            sam_locations = [l for l in batch_locations.get(filename, []) if is_enstore_tape(l)]
+            check_locations(tid, filename, sam_locations, locality, updater, stats)
 
 def get_program_arguments():
     parser = argparse.ArgumentParser(description="Fix SAM tape locations for the provided list of files.")
     parser.add_argument('experiment', help='SAM Experiment')
     parser.add_argument('filelist', help='Text file with one file name per line of the files to be repaired.')
+    parser.add_argument('--num-threads', type=int, default=8, help='Number of threads pulling files from the filelist. Default: 8')
+    parser.add_argument('--dcache-concurrency', type=int, default=None, help='Maximum number of dCache locality lookups in flight at once; lookups run in the worker threads, so at most --num-threads. Default: --num-threads')
+    parser.add_argument('--bulk', default=False, action='store_true', help='Resolve SAM locations for --batch-size files per query instead of one file at a time.')
+    parser.add_argument('--batch-size', type=int, default=500, help='Files per SAM location query in --bulk mode. Default: 500')
+    parser.add_argument('--update-concurrency', type=int, default=8, help='Maximum number of SAM location updates in flight at once. Default: 8')
+    parser.add_argument('--max-retries', type=int, default=3, help='Times a failed SAM location update is retried. Default: 3')
+    parser.add_argument('--samweb-url', default=SAMWEB_URL, help='SAMweb base URL, without the experiment. Default: %(default)s')
+    parser.add_argument('--cert', default='/tmp/x509up_u51660', help='X.509 proxy used for SAM location updates. Default: %(default)s')
+    parser.add_argument('--ca-path', default='/etc/grid-security/certificates', help='CA directory used to verify SAMweb. Default: %(default)s')
+    parser.add_argument('--dcache-url', default=DCACHE_NAMESPACE_URL, help='dCache REST namespace URL, without the experiment. Default: %(default)s')
     args = parser.parse_args()
     return args
 
 def main():
     args = get_program_arguments()
-    threads = []
-    num_threads = 8 
-    with open(args.filelist) as f:
-        file_queues =  get_file_queues(num_threads, f)
-        for i in range(num_threads):
-            t = threading.Thread(target=do_processing, args=(i, file_queues[i], args))
-            t.start()
-            threads.append(t)
-    for t in threads:
-        t.join()
+    # Each worker thread makes its own lookups, so there are never more than num_threads in flight
+    locality = LocalityClient(args.experiment, base_url=args.dcache_url,
+            max_concurrency=min(args.dcache_concurrency or args.num_threads, args.num_threads))
+    stats = PhaseStats()
+    updater = UnavailableUpdater(args, stats)
+    worker_args = (args, locality, updater, stats)
+    with open(args.filelist) as f: # Stream the files to whichever thread is free
+        if args.bulk:
+            with WorkScheduler(do_bulk_processing, args.num_threads, args=worker_args) as scheduler:
+                scheduler.feed(chunked(read_items(f), args.batch_size))
+        else:
+            with WorkScheduler(do_processing, args.num_threads, args=worker_args) as scheduler:
+                scheduler.feed(read_items(f))
+    updater.close()
+    print('dCache locality lookups: %s (%s answered from cache)' % (locality.lookups, locality.hits))
+    print(stats.summary())
 
 if __name__ == "__main__":
     main()